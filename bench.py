@@ -0,0 +1,220 @@
+"""Micro-benchmarks for maxbot hot paths.
+
+Usage: python bench.py [name ...]   (runs everything when no name is given)
+"""
+import asyncio
+import json
+import logging
+import sys
+import time
+import tracemalloc
+
+from maxbot import Bot, Dispatcher, Payload, State, StateFilter, configure_logging
+from maxbot._types import CallbackQuery, Chat, InlineKeyboardButton, InlineKeyboardMarkup, Message, Update, User
+from maxbot.codec import CODECS, get_codec
+from maxbot.filters import Filter
+
+PREFIXES = [f"action{i}" for i in range(30)]
+
+
+def _callback_update(payload: str) -> Update:
+    return Update(
+        update_id=1,
+        update_type="message_callback",
+        timestamp=0,
+        callback_query=CallbackQuery(
+            callback_id="1",
+            from_user=User(user_id=1, first_name="Bench"),
+            payload=payload
+        )
+    )
+
+
+def _timeit(label: str, func, number: int):
+    start = time.perf_counter()
+    asyncio.run(func(number))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / number * 1e6:8.2f} us/update")
+
+
+async def _noop(update, bot):
+    pass
+
+
+def bench_dispatch(number: int = 20000):
+    """Callback dispatch cost: linear filter scan vs payload index"""
+    def filter_for(prefix):
+        async def check(update):
+            return update.callback_query.payload.split(":")[0] == prefix
+        return check
+
+    scan = Dispatcher(Bot("bench"))
+    indexed = Dispatcher(Bot("bench"))
+    for prefix in PREFIXES:
+        scan.callback_query_handler(filter_for(prefix))(_noop)
+        indexed.callback_query_handler(Payload(f"{prefix}:*"))(_noop)
+
+    for position in (0, len(PREFIXES) - 1):
+        update = _callback_update(f"{PREFIXES[position]}:next:42")
+
+        async def run(n, dispatcher):
+            for _ in range(n):
+                await dispatcher.process_update(update)
+
+        _timeit(f"scan, handler #{position + 1}", lambda n: run(n, scan), number)
+        _timeit(f"index, handler #{position + 1}", lambda n: run(n, indexed), number)
+
+
+def bench_state_dispatch(number: int = 20000):
+    """Message dispatch in the last of 30 FSM states: StateFilter scan vs state index"""
+    states = [State() for _ in PREFIXES]
+    scan = Dispatcher(Bot("bench"))
+    indexed = Dispatcher(Bot("bench"))
+    for state in states:
+        # An extra no-op filter keeps the handler out of the index
+        scan.message_handler(StateFilter(state), Filter())(_noop)
+        indexed.message_handler(StateFilter(state))(_noop)
+
+    update = Update(
+        update_id=1,
+        update_type="message_created",
+        timestamp=0,
+        message=Message(
+            message_id="1",
+            chat=Chat(chat_id=-1, type="dialog", status="active"),
+            from_user=User(user_id=1, first_name="Bench"),
+            text="text"
+        )
+    )
+
+    async def run(n, dispatcher):
+        await dispatcher.stateManager.set_state(-1, states[-1])
+        for _ in range(n):
+            await dispatcher.process_update(update)
+        await dispatcher.stateManager.erase_state(-1)
+
+    _timeit("scan, state #30", lambda n: run(n, scan), number)
+    _timeit("index, state #30", lambda n: run(n, indexed), number)
+
+
+def _raw_update(index: int) -> dict:
+    """Message update as sent by /updates"""
+    return {
+        "update_type": "message_created",
+        "timestamp": 1700000000000 + index,
+        "message": {
+            "sender": {"user_id": 1000 + index, "first_name": "Иван", "last_name": "Петров",
+                       "username": "ivan", "is_bot": False, "last_activity_time": 1700000000000},
+            "recipient": {"chat_id": 2000 + index, "chat_type": "dialog", "user_id": 1},
+            "timestamp": 1700000000000 + index,
+            "body": {"mid": f"mid.{index:016x}", "seq": index, "text": "Привет! Хочу взять кота из приюта",
+                     "attachments": [{"type": "image", "payload": {"token": "x" * 64, "url": "https://i.oneme.ru/i?r=" + "y" * 80}}]},
+        },
+        "user_locale": "ru",
+    }
+
+
+def _raw_callback(index: int) -> dict:
+    """Callback update as sent by /updates"""
+    message = _raw_update(index)["message"]
+    return {
+        "update_type": "message_callback",
+        "timestamp": 1700000000000 + index,
+        "callback": {"callback_id": f"cb.{index:016x}", "payload": f"search:next:cat:{index}",
+                     "timestamp": 1700000000000 + index,
+                     "user": {"user_id": 1000 + index, "first_name": "Иван", "username": "ivan", "is_bot": False}},
+        "message": message,
+    }
+
+
+def bench_parse(number: int = 2000):
+    """Parse time and allocations per batch of 100 updates, with nested objects untouched and touched"""
+    dispatcher = Dispatcher(Bot("bench"))
+    batches = {
+        "messages": [_raw_update(i) for i in range(100)],
+        "callbacks": [_raw_callback(i) for i in range(100)],
+    }
+
+    def touch(update):
+        update.effective_chat
+        update.effective_user
+
+    for name, batch in batches.items():
+        for touched in (False, True):
+            start = time.perf_counter()
+            for _ in range(number):
+                for raw in batch:
+                    update = dispatcher._parse_update(raw)
+                    if touched:
+                        touch(update)
+            elapsed = time.perf_counter() - start
+
+            tracemalloc.start()
+            snapshot = tracemalloc.take_snapshot()
+            parsed = [dispatcher._parse_update(raw) for raw in batch]
+            if touched:
+                for update in parsed:
+                    touch(update)
+            stats = tracemalloc.take_snapshot().compare_to(snapshot, "filename")
+            tracemalloc.stop()
+            blocks = sum(stat.count_diff for stat in stats)
+            size = sum(stat.size_diff for stat in stats)
+            del parsed
+
+            label = f"{name}, {'touched' if touched else 'untouched'}"
+            print(f"{label:<40} {elapsed / number * 1e6:8.2f} us/batch {blocks:6d} blocks {size / 1024:8.1f} KiB/batch")
+
+
+def bench_json(number: int = 2000):
+    """Per-codec cost of a 100-update /updates batch and of a keyboard payload"""
+    batch = json.dumps({"updates": [_raw_update(i) for i in range(100)], "marker": 1}).encode()
+    keyboard = {
+        "text": "Кот Барсик, 2 года",
+        "attachments": [InlineKeyboardMarkup([
+            [InlineKeyboardButton("Назад", f"search:back:cat:{i}"), InlineKeyboardButton("Дальше", f"search:next:cat:{i}")]
+            for i in range(4)
+        ]).to_dict()],
+        "notify": True,
+    }
+    dispatcher = Dispatcher(Bot("bench"))
+
+    for name in CODECS:
+        codec = get_codec(name)
+
+        def loads(n, codec=codec):
+            start = time.perf_counter()
+            for _ in range(n):
+                codec.loads(batch)
+            return time.perf_counter() - start
+
+        def parse(n, codec=codec):
+            start = time.perf_counter()
+            for _ in range(n):
+                for update in codec.loads(batch)["updates"]:
+                    dispatcher._parse_update(update)
+            return time.perf_counter() - start
+
+        def dumps(n, codec=codec):
+            start = time.perf_counter()
+            for _ in range(n):
+                codec.dumps(keyboard)
+            return time.perf_counter() - start
+
+        print(f"{name + ', loads 100 updates':<40} {loads(number) / number * 1e6:8.2f} us/batch")
+        print(f"{name + ', loads + parse 100 updates':<40} {parse(number // 10) / (number // 10) * 1e6:8.2f} us/batch")
+        print(f"{name + ', dumps keyboard':<40} {dumps(number * 10) / (number * 10) * 1e6:8.2f} us/payload")
+
+
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "state_dispatch": bench_state_dispatch,
+    "json": bench_json,
+    "parse": bench_parse,
+}
+
+
+if __name__ == "__main__":
+    configure_logging(logging.WARNING)
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -1,13 +1,68 @@
 from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine, create_async_engine, async_sessionmaker
-from sqlalchemy import select
+from sqlalchemy import delete, event, insert, inspect, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import joinedload, selectinload
+from dataclasses import dataclass
 import tracemalloc  # отслеживание ошибок связанных с памятью
 import asyncio
+import logging
+import sys
 from models import Base, User, Shelter, Pet, Photo
+from maxbot.tracing import instrument_engine
+
+
+logger = logging.getLogger("create_db")
+
+
+@dataclass
+class SQLiteProfile:
+    """PRAGMA, выставляемые на каждое новое соединение SQLite"""
+    journal_mode: str = "WAL"  # читатели не блокируются писателем
+    synchronous: str = "NORMAL"  # в режиме WAL без fsync на каждый коммит
+    cache_size: int = -64000  # отрицательное значение — в КиБ (64 МиБ)
+    mmap_size: int = 256 * 1024 * 1024
+    temp_store: str = "MEMORY"
+    busy_timeout: int = 5000  # мс ожидания блокировки вместо "database is locked"
+
+    def pragmas(self) -> list[str]:
+        return [
+            f"PRAGMA journal_mode={self.journal_mode}",
+            f"PRAGMA synchronous={self.synchronous}",
+            f"PRAGMA cache_size={self.cache_size}",
+            f"PRAGMA mmap_size={self.mmap_size}",
+            f"PRAGMA temp_store={self.temp_store}",
+            f"PRAGMA busy_timeout={self.busy_timeout}",
+        ]
+
+
+def apply_sqlite_profile(engine: AsyncEngine, profile: SQLiteProfile) -> None:
+    """Выставлять PRAGMA профиля при открытии каждого соединения пула"""
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in profile.pragmas():
+            cursor.execute(pragma)
+        cursor.close()
 
 
 async def create_tables(engine: AsyncEngine) -> None:
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_missing_indexes)
+
+
+def create_missing_indexes(conn) -> list[str]:
+    """Создание индексов из models.py, которых ещё нет в существующей БД"""
+    created = []
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+                created.append(index.name)
+    return created
 
 
 async def create_user(db: AsyncSession, max_id: int, location: str, url: str):
@@ -98,6 +153,22 @@ async def get_pets_by_location(db: AsyncSession, location: str):
     return pets.all()
 
 
+async def get_pets_page(db: AsyncSession, after_id: int = 0, limit: int = 10, location: str = None,
+                        pet_type: str = None, shelter_id: int = None) -> list[Pet]:
+    """Следующая страница питомцев после after_id (keyset-пагинация по id) вместе с приютом и фото"""
+    stmt = select(Pet).options(joinedload(Pet.shelter), selectinload(Pet.photos)).where(Pet.id > after_id)
+    if location is not None:
+        stmt = stmt.where(Pet.location == location)
+    if pet_type is not None:
+        stmt = stmt.where(Pet.type == pet_type)
+    if shelter_id is not None:
+        stmt = stmt.where(Pet.shelter_id == shelter_id)
+    stmt = stmt.order_by(Pet.id).limit(limit)
+    result = await db.execute(stmt)
+    pets = result.scalars()
+    return pets.all()
+
+
 async def update_pet(db: AsyncSession, sql_id: int, shelter_id: int = None, pet_type: str = None,
                      name: str = None, age: int = None, location: str = None, gender: bool = None,
                      description: str = None):
@@ -236,6 +307,30 @@ async def create_photo(db: AsyncSession, pet_id: int, token: str):
     return db_photo
 
 
+async def create_photos_bulk(db: AsyncSession, pet_id: int, tokens: list[str]) -> int:
+    """Добавление всех фото животного одним INSERT и одним коммитом"""
+    if tokens:
+        await db.execute(insert(Photo), [{"pet_id": pet_id, "token": token} for token in tokens])
+        await db.commit()
+    return len(tokens)
+
+
+async def replace_pet_photos(db: AsyncSession, pet_id: int, tokens: list[str]) -> int:
+    """Замена всех фото животного: DELETE + INSERT в одной транзакции"""
+    await db.execute(delete(Photo).where(Photo.pet_id == pet_id))
+    if tokens:
+        await db.execute(insert(Photo), [{"pet_id": pet_id, "token": token} for token in tokens])
+    await db.commit()
+    return len(tokens)
+
+
+async def delete_photos_by_pet_id(db: AsyncSession, pet_id: int) -> int:
+    """Удаление всех фото животного одним DELETE"""
+    result = await db.execute(delete(Photo).where(Photo.pet_id == pet_id))
+    await db.commit()
+    return result.rowcount
+
+
 async def get_photo_by_token(db: AsyncSession, token: str):
     stmt = select(Photo).where(Photo.token == token)
     result = await db.execute(stmt)
@@ -251,7 +346,7 @@ async def get_photos_by_pet_id(db: AsyncSession, pet_id: int):
 
 
 async def delete_photo_by_token(db: AsyncSession, token: str) -> bool:
-    photo = get_photo_by_token(db, token)
+    photo = await get_photo_by_token(db, token)
     if photo:
         await db.delete(photo)
         await db.commit()
@@ -259,14 +354,28 @@ async def delete_photo_by_token(db: AsyncSession, token: str) -> bool:
     return False
 
 
-async def create_db() -> int:
-    db_url = 'sqlite+aiosqlite:///database.db'
+def pool_options(db_url: str, pool_size: int, max_overflow: int, pool_timeout: float) -> dict:
+    """Параметры пула, если диалект URL использует QueuePool (у SQLite в памяти — StaticPool без них)"""
+    url = make_url(db_url)
+    if issubclass(url.get_dialect(_is_async=True).get_pool_class(url), QueuePool):
+        return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout}
+    return {}
+
+
+async def create_db(db_url: str = 'sqlite+aiosqlite:///database.db', pool_size: int = 5, max_overflow: int = 10,
+                    pool_timeout: float = 30, echo: bool = False,
+                    profile: SQLiteProfile | None = SQLiteProfile()) -> async_sessionmaker[AsyncSession]:
+    """Создание движка и фабрики сессий (одна сессия на апдейт)"""
     tracemalloc.start()
-    engine: AsyncEngine = create_async_engine(db_url, echo=True, future=True)
+    engine: AsyncEngine = create_async_engine(db_url, echo=echo, future=True,
+                                              **pool_options(db_url, pool_size, max_overflow, pool_timeout))
+    if profile is not None and engine.dialect.name == "sqlite":
+        apply_sqlite_profile(engine, profile)
+    instrument_engine(engine)  # спаны SQL-запросов в трассировке апдейта (если она включена)
     async_session_local = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
     await create_tables(engine)
 
-    return async_session_local()
+    return async_session_local
     # async with async_session_local() as session:
     #     """Тесты на будущее"""
     # user = await create_user(session, 'Artem', 777, 'Moscow Ramenki')
@@ -283,5 +392,76 @@ async def create_db() -> int:
     # return 0
 
 
+async def maintain_db(session_maker: async_sessionmaker[AsyncSession], analyze: bool = False,
+                      checkpoint: str = "PASSIVE") -> None:
+    """Обслуживание SQLite: ANALYZE (по запросу), PRAGMA optimize и чекпоинт WAL"""
+    async with session_maker() as db:
+        conn = await db.connection()
+        if analyze:
+            await conn.exec_driver_sql("ANALYZE")
+        await conn.exec_driver_sql("PRAGMA optimize")
+        await conn.exec_driver_sql(f"PRAGMA wal_checkpoint({checkpoint})")
+        await db.commit()
+
+
+async def maintenance_loop(session_maker: async_sessionmaker[AsyncSession], interval: float = 3600,
+                           analyze_every: int = 24) -> None:
+    """Периодическое обслуживание БД: каждые interval секунд, полный ANALYZE — каждый analyze_every запуск"""
+    runs = 0
+    while True:
+        await asyncio.sleep(interval)
+        runs += 1
+        try:
+            await maintain_db(session_maker, analyze=runs % analyze_every == 0)
+        except Exception as e:
+            logger.error(f"Обслуживание БД не удалось: {e}", exc_info=True)
+
+
+def hot_queries() -> dict:
+    """Запросы из этого модуля, для которых нужен индекс (для EXPLAIN QUERY PLAN)"""
+    return {
+        "get_user_by_max_id": select(User).where(User.max_id == 0),
+        "get_pets_by_shelter_id": select(Pet).where(Pet.shelter_id == 0),
+        "get_pets_by_location": select(Pet).where(Pet.location == ""),
+        "get_pets_page(location)": select(Pet).where(Pet.id > 0, Pet.location == "").order_by(Pet.id).limit(1),
+        "get_pets_page(location, type)": select(Pet).where(Pet.id > 0, Pet.location == "", Pet.type == "")
+        .order_by(Pet.id).limit(1),
+        "get_pets_page(shelter)": select(Pet).where(Pet.id > 0, Pet.shelter_id == 0).order_by(Pet.id).limit(1),
+        "get_shelter_by_max_id": select(Shelter).where(Shelter.max_id == 0),
+        "get_shelters_by_location": select(Shelter).where(Shelter.location == ""),
+        "get_shelters_without_verification": select(Shelter).where(Shelter.verified == 0),
+        "get_photo_by_token": select(Photo).where(Photo.token == ""),
+        "get_photos_by_pet_id": select(Photo).where(Photo.pet_id == 0),
+    }
+
+
+async def explain_queries(engine: AsyncEngine) -> dict[str, list[str]]:
+    """EXPLAIN QUERY PLAN для каждого запроса из hot_queries()"""
+    plans = {}
+    async with engine.connect() as conn:
+        for name, stmt in hot_queries().items():
+            sql = stmt.compile(engine.sync_engine, compile_kwargs={"literal_binds": True})
+            result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")
+            plans[name] = [row[-1] for row in result]
+    return plans
+
+
+async def migrate(db_url: str = 'sqlite+aiosqlite:///database.db') -> None:
+    """Миграция живой БД: недостающие таблицы и индексы, затем отчёт о планах запросов"""
+    engine: AsyncEngine = create_async_engine(db_url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        created = await conn.run_sync(create_missing_indexes)
+    print(f"Созданы индексы: {', '.join(created)}" if created else "Все индексы уже есть")
+
+    for name, plan in (await explain_queries(engine)).items():
+        full_scan = any(step.startswith("SCAN") for step in plan)
+        print(f"{'!' if full_scan else ' '} {name}: {'; '.join(plan)}")
+    await engine.dispose()
+
+
 if __name__ == "__main__":
-    asyncio.run(create_db())
+    if sys.argv[1:2] == ["migrate"]:
+        asyncio.run(migrate(*sys.argv[2:3]))
+    else:
+        asyncio.run(create_db())
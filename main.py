@@ -1,34 +1,49 @@
 import asyncio
 from dataclasses import dataclass
 import logging
+import multiprocessing
 import os
+from typing import Optional
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from create_db import update_pet, delete_photo_by_token, delete_pet_by_id, get_shelters_without_verification, \
+from create_db import update_pet, delete_photos_by_pet_id, replace_pet_photos, delete_pet_by_id, get_shelters_without_verification, \
     delete_shelter_by_max_id
 
-from create_db import create_db, get_pet_by_id, get_pets_by_location, get_photos_by_pet_id, get_shelter_by_max_id, \
-    create_shelter, create_pet, create_photo, update_shelter, \
-    get_shelter_by_id, get_shelters_by_location, get_user_by_max_id, create_user, get_pets_by_shelter_id, update_user
-from maxbot import Bot, Dispatcher, Update, StateManager, State, configure_logging, StateFilter
+from create_db import create_db, get_pet_by_id, get_pets_page, get_shelter_by_max_id, \
+    maintenance_loop, create_shelter, create_pet, create_photos_bulk, update_shelter, \
+    get_shelter_by_id, get_shelters_by_location, get_user_by_max_id, create_user, update_user
+from maxbot import Bot, TransportConfig, RateLimiter, SQLiteOutboxStore, MemoryOutboxStore, MarkerStore, SQLiteStorage, EvictionPolicy, Tracer, JSONLSink, Dispatcher, Update, StateManager, State, configure_logging, StateFilter, CallbackData
 from maxbot._types import InlineKeyboardButton, InlineKeyboardMarkup
-from maxbot.filters import Command
+from maxbot.filters import Command, Payload
 from models import Pet, Shelter, User
 from string_token import token_str
 
 configure_logging(level=logging.DEBUG)
 
-bot = Bot(token_str if token_str else os.getenv('BOT_TOKEN'))
+bot = Bot(token_str if token_str else os.getenv('BOT_TOKEN'),
+          transport=TransportConfig(warm_up=os.getenv('BOT_WARM_UP') == '1'),
+          rate_limiter=RateLimiter(rate=float(os.getenv('BOT_RATE_LIMIT', 30)),
+                                   chat_rate=float(os.getenv('BOT_CHAT_RATE_LIMIT', 1))))
+if os.getenv('BOT_OUTBOX') == 'sqlite':
+    bot.enable_outbox(SQLiteOutboxStore(os.getenv('BOT_OUTBOX_PATH', 'outbox.db')),
+                      senders=int(os.getenv('BOT_OUTBOX_SENDERS', 4)))
+elif os.getenv('BOT_OUTBOX') == 'memory':
+    bot.enable_outbox(MemoryOutboxStore(), senders=int(os.getenv('BOT_OUTBOX_SENDERS', 4)))
 dp = Dispatcher(bot)
-city = State()
-user_url = State()
-volunteer_city = State()
-shelters = State()
-search = State()
-warn = State()
-moderation = State()
-pets_state = State()
+if os.getenv('FSM_STORAGE') in ('sqlite', 'snapshot'):
+    dp.stateManager.use_storage(SQLiteStorage(os.getenv('FSM_STORAGE_PATH', 'states.db'),
+                                              snapshot=os.getenv('FSM_STORAGE') == 'snapshot'))
+if float(os.getenv('TRACE_SAMPLE_RATE', 0)) > 0:
+    dp.tracer = Tracer(JSONLSink(os.getenv('TRACE_PATH', 'traces.jsonl')), float(os.getenv('TRACE_SAMPLE_RATE')))
+city = State("city")
+user_url = State("user_url")
+volunteer_city = State("volunteer_city")
+shelters = State("shelters")
+search = State("search")
+warn = State("warn")
+moderation = State("moderation")
+pets_state = State("pets_state")
 
 moderators: list[int] = [3502432, 6070005, 8513914]
 
@@ -74,6 +89,89 @@ class AnimalChange:
     media = State()
 
 
+@dataclass
+class ShelterSearchCb(CallbackData, prefix="shelter_search"):
+    action: str
+    shelter_id: Optional[int] = None
+
+
+@dataclass
+class AnimalCb(CallbackData, prefix="animal"):
+    kind: str
+
+
+@dataclass
+class SearchCb(CallbackData, prefix="search"):
+    action: str
+    kind: str
+    pet_id: Optional[int] = None
+
+
+@dataclass
+class AcceptCb(CallbackData, prefix="accept"):
+    user_id: int
+    pet_id: int
+
+
+@dataclass
+class ModerationCb(CallbackData, prefix="moderation"):
+    moderator_id: int
+    action: str
+    shelter_id: Optional[int] = None
+
+
+@dataclass
+class WarnCb(CallbackData, prefix="warn"):
+    shelter_id: int
+
+
+@dataclass
+class ShelterChangeCb(CallbackData, prefix="shelter-change"):
+    command: str
+
+
+@dataclass
+class GetMessagesChangeCb(CallbackData, prefix="get_messages-change"):
+    get_messages: int
+
+
+@dataclass
+class PetTypeCb(CallbackData, prefix="pet"):
+    pet_type: str
+
+
+@dataclass
+class PetGenderCb(CallbackData, prefix="pet_gender"):
+    gender: bool
+
+
+@dataclass
+class PetChangeCb(CallbackData, prefix="pet_change"):
+    command: str
+    value: Optional[str] = None
+
+
+def image_tokens(message) -> list[str]:
+    """Токены всех изображений во вложениях сообщения"""
+    return [attachment["payload"]["token"] for attachment in message.attachments or []
+            if attachment["type"] == "image"]
+
+
+async def on_session_evicted(chat_id: int, record: list, reason: str):
+    """Предупредить пользователя, если брошенная регистрация удалена по таймауту"""
+    state = record[0]
+    if reason == "ttl" and isinstance(state, State) and \
+            state.uuid.startswith(("ShelterRegistration.", "AnimalRegistration.")):
+        await bot.send_message(chat_id=chat_id,
+                               text="Регистрация отменена из-за неактивности. Чтобы начать заново, введите /start .")
+
+
+dp.stateManager.use_eviction(EvictionPolicy(ttl=float(os.getenv('FSM_TTL', 24 * 3600)),
+                                            max_entries=int(os.getenv('FSM_MAX_ENTRIES', 100000)),
+                                            max_bytes=int(os.getenv('FSM_MAX_BYTES', 256 * 1024 * 1024)),
+                                            on_evict=on_session_evicted))
+
+
 @dp.message_handler(Command("start"))
 @dp.bot_started_handler()
 async def start(update: Update, bot: Bot, stateManager: StateManager, session):
@@ -99,23 +197,7 @@ async def start(update: Update, bot: Bot, stateManager: StateManager, session):
                                                                            "new_shelter")]]).to_dict()])
 
 
-async def new_user_callback(update: Update):
-    return update.callback_query.payload == "get_animal"
-
-
-async def shelter_search_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "shelter_search"
-
-
-async def volunteer_callback(update: Update):
-    return update.callback_query.payload == "volunteer"
-
-
-async def new_shelter_callback(update: Update):
-    return update.callback_query.payload == "new_shelter"
-
-
-@dp.callback_query_handler(volunteer_callback)
+@dp.callback_query_handler(Payload("volunteer"))
 async def volunteer_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await bot.send_message(chat_id=update.callback_query.message.chat_id, text="Назовите город, в котором вы сейчас.")
     await stateManager.set_state(update.callback_query.message.chat_id, volunteer_city)
@@ -129,55 +211,57 @@ async def volunteer_search_hanlder(update: Update, bot: Bot, stateManager: State
     await bot.send_message(chat_id=update.message.chat_id,
                               text="Теперь я могу приступить к поиску приюта! Начнём?",
                               attachments=[InlineKeyboardMarkup(
-                                  [[InlineKeyboardButton("Поехали!", "shelter_search:_")]]).to_dict()])
+                                  [[InlineKeyboardButton("Поехали!", ShelterSearchCb("_").pack())]]).to_dict()])
 
 
-@dp.callback_query_handler(shelter_search_callback)
+@dp.callback_query_handler(ShelterSearchCb.filter())
 async def shelter_search_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    if update.callback_query.payload.split(":")[1] == "_":
+    callback_data: ShelterSearchCb = update.callback_query.data
+    # Транзакция не даст двойному нажатию «Дальше» пропустить или повторить анкету
+    async with stateManager.transaction(update.callback_query.message.chat_id) as st:
+        if callback_data.action == "_":
+
+            location: str = st["city"]
+            shelters: list[Shelter] = await get_shelters_by_location(session, location.lower())
+
+            st.update(shelters=[s for s in shelters if s.verified == 1 and (s.dobro_rf or s.get_messages)],
+                      shelters_index=0)
+        elif callback_data.action == "like":
+            shelter: Shelter = await get_shelter_by_id(session, callback_data.shelter_id)
+            await bot.send_message(chat_id=update.callback_query.message.chat_id,
+                                   text=f"Свяжитесь с приютом {f"через его страницу на dobro.ru: {shelter.dobro_rf}" if shelter.dobro_rf else f"через его профиль в MAX: https://max.ru/{shelter.max_id}"}")
 
-        location: str = await stateManager.get_data(update.callback_query.message.chat_id, "city")
-        shelters: list[Shelter] = await get_shelters_by_location(session, location.lower())
+        shelter_index: int = st["shelters_index"]
+        shelters: list[Shelter] = st["shelters"]
 
-        await stateManager.set_data(update.callback_query.message.chat_id, "shelters",
-                                    [s for s in shelters if s.verified == 1 and (s.dobro_rf or s.get_messages)])
-        await stateManager.set_data(update.callback_query.message.chat_id, "shelters_index", 0)
-    elif update.callback_query.payload.split(":")[1] == "like":
-        shelter: Shelter = await get_shelter_by_id(session, int(update.callback_query.payload.split(":")[2]))
-        await bot.send_message(chat_id=update.callback_query.message.chat_id,
-                               text=f"Свяжитесь с приютом {f"через его страницу на dobro.ru: {shelter.dobro_rf}" if shelter.dobro_rf else f"через его профиль в MAX: https://max.ru/{shelter.max_id}"}")
+        if shelter_index < len(shelters):
+            shelter: Shelter = shelters[shelter_index]
+        else:
+            await bot.answer_callback(
+                update.callback_query.callback_id,
+                "Больше нет подтверждённых приютов в этом городе.")
+            st.erase()
+            return
 
-    shelter_index: int = await stateManager.get_data(update.callback_query.message.chat_id, "shelters_index")
-    shelters: list[Shelter] = await stateManager.get_data(update.callback_query.message.chat_id, "shelters")
+        # anketa: dict[str, str] = {
+        #     "id": 1234,
+        #     "name": "Сокольнический",
+        #     "address": "Москва, метро Сокольники, ...",
+        #     "description": "VIP Приют города",
+        #     "get_messages": 1,
+        #     "url": "https://dobro.ru"
+        # }
 
-    if shelter_index < len(shelters):
-        shelter: Shelter = shelters[shelter_index]
-    else:
         await bot.answer_callback(
             update.callback_query.callback_id,
-            "Больше нет подтверждённых приютов в этом городе.")
-        await stateManager.erase_state(update.callback_query.message.chat_id)
-        return
-
-    # anketa: dict[str, str] = {
-    #     "id": 1234,
-    #     "name": "Сокольнический",
-    #     "address": "Москва, метро Сокольники, ...",
-    #     "description": "VIP Приют города",
-    #     "get_messages": 1,
-    #     "url": "https://dobro.ru"
-    # }
-
-    await bot.answer_callback(
-        update.callback_query.callback_id,
-        f"Приют {shelter.name}, {shelter.address}\n" \
-        f"{shelter.description if shelter.description else ""}",
-        [InlineKeyboardMarkup([[InlineKeyboardButton("Откликнуться", f"shelter_search:like:{shelter.id}"),
-                                InlineKeyboardButton("Дальше", f"shelter_search:next:{shelter.id}")]]).to_dict()])
-    await stateManager.set_data(update.callback_query.message.chat_id, "shelters_index", shelter_index + 1)
-
-
-@dp.callback_query_handler(new_shelter_callback)
+            f"Приют {shelter.name}, {shelter.address}\n" \
+            f"{shelter.description if shelter.description else ""}",
+            [InlineKeyboardMarkup([[InlineKeyboardButton("Откликнуться", ShelterSearchCb("like", shelter.id).pack()),
+                                    InlineKeyboardButton("Дальше", ShelterSearchCb("next", shelter.id).pack())]]).to_dict()])
+        st.set("shelters_index", shelter_index + 1)
+
+
+@dp.callback_query_handler(Payload("new_shelter"))
 async def new_shelter_handler(update: Update, bot: Bot, stateManager: StateManager, session: AsyncSession):
     is_exist: bool = await get_shelter_by_max_id(session, update.callback_query.from_user.user_id) is not None
     if is_exist:
@@ -213,11 +297,7 @@ async def shelter_address_handler(update: Update, bot: Bot, stateManager: StateM
     await stateManager.set_state(update.message.chat_id, ShelterRegistration.url)
 
 
-async def skip_url_callback(update: Update):
-    return update.callback_query.payload == "skip_url"
-
-
-@dp.callback_query_handler(skip_url_callback)
+@dp.callback_query_handler(Payload("skip_url"))
 async def shelter_skip_url_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await bot.answer_callback(update.callback_query.callback_id, notification="Ссылка пропущена.")
     await bot.send_message(chat_id=update.callback_query.message.chat_id,
@@ -241,11 +321,7 @@ async def shelter_url_handler(update: Update, bot: Bot, stateManager: StateManag
     await stateManager.set_state(update.message.chat_id, ShelterRegistration.description)
 
 
-async def skip_description_callback(update: Update):
-    return update.callback_query.payload == "skip_description"
-
-
-@dp.callback_query_handler(skip_description_callback)
+@dp.callback_query_handler(Payload("skip_description"))
 async def shelter_skip_description_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await bot.answer_callback(update.callback_query.callback_id, notification="Описание пропущено.")
     await bot.send_message(chat_id=update.callback_query.message.chat_id,
@@ -267,20 +343,13 @@ async def shelter_get_messages_handler(update: Update, bot: Bot, stateManager: S
     await stateManager.set_state(update.chat_id, ShelterRegistration.get_messages)
 
 
-async def get_messages1_callback(update: Update):
-    return update.callback_query.payload == "get_messages:1"
-
-
-async def get_messages0_callback(update: Update):
-    return update.callback_query.payload == "get_messages:0"
-
-@dp.callback_query_handler(get_messages1_callback)
+@dp.callback_query_handler(Payload("get_messages:1"))
 async def add_contact_url_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await bot.send_message(chat_id=update.callback_query.message.chat_id, text="Отправьте вашу пригласительную ссылку, которую можно получить, отсканировав ваш пригласительный QR-код (вкладка профиль, верхний левый угол).")
     await stateManager.set_state(update.callback_query.message.chat_id, ShelterRegistration.contact_url)
 
 @dp.message_handler(StateFilter(ShelterRegistration.contact_url))
-@dp.callback_query_handler(get_messages0_callback)
+@dp.callback_query_handler(Payload("get_messages:0"))
 async def shelter_finish_reg_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     update.chat_id = update.message.chat_id if update.message else update.callback_query.message.chat_id
     user_id: int = update.message.from_user.user_id if update.message else update.callback_query.from_user.user_id
@@ -304,7 +373,7 @@ async def shelter_finish_reg_handler(update: Update, bot: Bot, stateManager: Sta
     await stateManager.erase_state(update.chat_id)
 
 
-@dp.callback_query_handler(new_user_callback)
+@dp.callback_query_handler(Payload("get_animal"))
 async def new_user_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     user = get_user_by_max_id(session, update.callback_query.from_user.user_id) is not None
     if user is None:
@@ -345,105 +414,88 @@ async def city_handler(update: Update, bot: Bot, stateManager: StateManager, ses
                                         user.location)
     await bot.send_message(chat_id=update.message.chat_id,
                            text="Какое животное вы бы хотели забрать?",
-                           attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Собаку", "animal:dog"),
-                                                               InlineKeyboardButton("Кошку", "animal:cat"),
-                                                               InlineKeyboardButton("Другое", "animal:other")], [
+                           attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Собаку", AnimalCb("dog").pack()),
+                                                               InlineKeyboardButton("Кошку", AnimalCb("cat").pack()),
+                                                               InlineKeyboardButton("Другое", AnimalCb("other").pack())], [
                                                                   InlineKeyboardButton("Любое",
-                                                                                       "animal:any")]]).to_dict()])
+                                                                                       AnimalCb("any").pack())]]).to_dict()])
 
 
-async def animal_choose_callback(update: Update):
-    return update.callback_query.payload[:6] == "animal"
-
-
-@dp.callback_query_handler(animal_choose_callback)
+@dp.callback_query_handler(AnimalCb.filter())
 async def search_start_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    animal_type: str = update.callback_query.payload[7:]
+    animal_type: str = update.callback_query.data.kind
     if animal_type == "any":
         await bot.answer_callback(update.callback_query.callback_id,
                                   "Теперь я могу приступить к поиску! Начнём?",
                                   [InlineKeyboardMarkup(
-                                      [[InlineKeyboardButton("Поехали!", "search:_:any")]]).to_dict()])
-        pets: list[Pet] = await get_pets_by_location(session,
-                                                     await stateManager.get_data(update.callback_query.message.chat_id,
-                                                                                 "city"))
-        await stateManager.set_data(update.callback_query.message.chat_id, "pets", pets)
-        await stateManager.set_data(update.callback_query.message.chat_id, "pets_index", 0)
+                                      [[InlineKeyboardButton("Поехали!", SearchCb("_", "any").pack())]]).to_dict()])
+        await stateManager.set_data(update.callback_query.message.chat_id, "pets_cursor", 0)
     else:
         await bot.answer_callback(update.callback_query.callback_id,
                                   "Теперь я могу приступить к поиску! Начнём?",
                                   [InlineKeyboardMarkup(
-                                      [[InlineKeyboardButton("Поехали!", f"search:_:{animal_type}")]]).to_dict()])
-        pets: list[Pet] = await get_pets_by_location(session,
-                                                     await stateManager.get_data(update.callback_query.message.chat_id,
-                                                                                 "city"))
-        await stateManager.set_data(update.callback_query.message.chat_id, "pets",
-                                    [pet for pet in pets if pet.type == animal_type])
-        await stateManager.set_data(update.callback_query.message.chat_id, "pets_index", 0)
-
+                                      [[InlineKeyboardButton("Поехали!", SearchCb("_", animal_type).pack())]]).to_dict()])
+        await stateManager.set_data(update.callback_query.message.chat_id, "pets_cursor", 0)
 
-async def search_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "search"
 
-
-@dp.callback_query_handler(search_callback)
+@dp.callback_query_handler(SearchCb.filter())
 async def search_callback_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    if update.callback_query.payload.split(":")[1] == "like":
-
-        pet: Pet = await get_pet_by_id(session, int(update.callback_query.payload.split(":")[3]))
-        shelter: Shelter = await get_shelter_by_id(session, pet.shelter_id)
-        user: User = await get_user_by_max_id(session, update.callback_query.from_user.user_id)
-        await bot.send_message(user_id=shelter.max_id,
-                               text=f"Пользователь по ссылке {user.url} заинтересовался {pet.name}.\n\nЯ отправил ему ваш адрес{" и контакт" if shelter.get_messages else ""}.\nНажмите принять, чтобы отправить согласие на посещение, или проигнорируйте, если вы не согласны.",
-                               attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("принять",
-                                                                                        f"accept:{update.callback_query.from_user.user_id}:{pet.id}")]]).to_dict()])
-    pets: list[Pet] = await stateManager.get_data(update.callback_query.message.chat_id, "pets")
-    pets_index: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_index")
-
-    if pets_index < len(pets):
-        pet: Pet = pets[pets_index]
-
-        animal_types: dict[str, str] = {
-            "dog": "Собака",
-            "cat": "Кошка",
-            "other": "Животное"
-        }
-        search_type: str = update.callback_query.payload.split(":")[2]
-
-        # anketa = {"id": 123,
-        #           "gender": 0,
-        #           "animal": "Cобака",
-        #           "name": "Бобик",
-        #           "city": "Москва",
-        #           "shelter": "Сокольнический",
-        #           "img_token": "g4v4v45vvn4vgrgh3t3gri",
-        #           "age": 16,
-        #           "description": "Хорошая собачка"}
+    callback_data: SearchCb = update.callback_query.data
+    async with stateManager.transaction(update.callback_query.message.chat_id) as st:
+        if callback_data.action == "like":
+
+            pet: Pet = await get_pet_by_id(session, callback_data.pet_id)
+            shelter: Shelter = await get_shelter_by_id(session, pet.shelter_id)
+            user: User = await get_user_by_max_id(session, update.callback_query.from_user.user_id)
+            await bot.send_message(user_id=shelter.max_id,
+                                   text=f"Пользователь по ссылке {user.url} заинтересовался {pet.name}.\n\nЯ отправил ему ваш адрес{" и контакт" if shelter.get_messages else ""}.\nНажмите принять, чтобы отправить согласие на посещение, или проигнорируйте, если вы не согласны.",
+                                   attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("принять",
+                                                                                            AcceptCb(update.callback_query.from_user.user_id, pet.id).pack())]]).to_dict()])
+        pets_cursor: int = st["pets_cursor"]
+        pets: list[Pet] = await get_pets_page(session, after_id=pets_cursor, limit=1, location=st["city"],
+                                              pet_type=None if callback_data.kind == "any" else callback_data.kind)
+
+        if pets:
+            pet: Pet = pets[0]
 
-        await bot.answer_callback(
-            update.callback_query.callback_id,
-            f"{animal_types[pet.type]} {"Девочка" if not pet.gender else "Мальчик"} {pet.name}, {pet.age} - {pet.location}, приют {(await get_shelter_by_id(session, pet.shelter_id)).name}\n" \
-            f"{pet.description if pet.description else ""}",
-            [{"type": "image", "payload": {"token": pet.token}} for pet in (await get_photos_by_pet_id(session, pet.id))] + [
-                InlineKeyboardMarkup([[InlineKeyboardButton("Лайк", f"search:like:{search_type}:{pet.id}"),
-                                       InlineKeyboardButton("Дальше",
-                                                            f"search:next:{search_type}:{pet.id}")]]).to_dict()])
-        await stateManager.set_data(update.callback_query.message.chat_id, "pets_index", pets_index + 1)
-    else:
-        await bot.send_message(chat_id=update.callback_query.message.chat_id,
-                               text="Животные кончились в вашем городе. Пожалуйста, попробуйте позднее или выберите другой город, зарегистрировавшись заного через /start .")
-        await stateManager.erase_state(update.callback_query.message.chat_id)
+            animal_types: dict[str, str] = {
+                "dog": "Собака",
+                "cat": "Кошка",
+                "other": "Животное"
+            }
+            search_type: str = callback_data.kind
 
+            # anketa = {"id": 123,
+            #           "gender": 0,
+            #           "animal": "Cобака",
+            #           "name": "Бобик",
+            #           "city": "Москва",
+            #           "shelter": "Сокольнический",
+            #           "img_token": "g4v4v45vvn4vgrgh3t3gri",
+            #           "age": 16,
+            #           "description": "Хорошая собачка"}
 
-async def accept_user_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "accept"
+            await bot.answer_callback(
+                update.callback_query.callback_id,
+                f"{animal_types[pet.type]} {"Девочка" if not pet.gender else "Мальчик"} {pet.name}, {pet.age} - {pet.location}, приют {pet.shelter.name}\n" \
+                f"{pet.description if pet.description else ""}",
+                [{"type": "image", "payload": {"token": photo.token}} for photo in pet.photos] + [
+                    InlineKeyboardMarkup([[InlineKeyboardButton("Лайк", SearchCb("like", search_type, pet.id).pack()),
+                                           InlineKeyboardButton("Дальше",
+                                                                SearchCb("next", search_type, pet.id).pack())]]).to_dict()])
+            st.set("pets_cursor", pet.id)
+        else:
+            await bot.send_message(chat_id=update.callback_query.message.chat_id,
+                                   text="Животные кончились в вашем городе. Пожалуйста, попробуйте позднее или выберите другой город, зарегистрировавшись заного через /start .")
+            st.erase()
 
 
-@dp.callback_query_handler(accept_user_callback)
+@dp.callback_query_handler(AcceptCb.filter())
 async def accept_handler(update: Update, bot: Bot, stateManager: StateManager, session):
+    callback_data: AcceptCb = update.callback_query.data
     shelter: Shelter = await get_shelter_by_max_id(session, update.callback_query.from_user.user_id)
-    pet: Pet = await get_pet_by_id(session, int(update.callback_query.payload.split(":")[2]))
-    await bot.send_message(user_id=int(update.callback_query.payload.split(":")[1]),
+    pet: Pet = await get_pet_by_id(session, callback_data.pet_id)
+    await bot.send_message(user_id=callback_data.user_id,
                            text=f"Вы можете встретиться с вашим будущим лучшим другом {pet.name} по адресу:\n{shelter.address}\n\nМы оповестили приют о вашей заинтересованности. Ссылка на ваш профиль была отправлена ему.{f"\n\nТакже, вы можете сами связаться с приютом по ссылке: {shelter.contact_url}" if shelter.get_messages else ""}"
                            )
 
@@ -454,57 +506,60 @@ async def start_moderation_handler(update: Update, bot: Bot, stateManager: State
         await bot.send_message(chat_id=update.message.chat_id,
                                text="Ваш статус модератора подтверждён. Приступаем к модерации?",
                                attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Поехали",
-                                                                                        f"moderation-{update.message.from_user.user_id}:_")]]).to_dict()])
+                                                                                        ModerationCb(update.message.from_user.user_id, "_").pack())]]).to_dict()])
         await stateManager.set_state(update.message.chat_id, moderation)
 
 
 async def moderation_callback(update: Update):
-    return (update.callback_query.payload.split(":")[0].split("-")[0] == "moderation") and (
-            int(update.callback_query.payload.split(":")[0].split("-")[1]) in moderators)
+    return update.callback_query.data is not None and update.callback_query.data.moderator_id in moderators
 
 
-@dp.callback_query_handler(moderation_callback)
+@dp.callback_query_handler(ModerationCb.filter(), moderation_callback)
 async def moderaion_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    if update.callback_query.payload.split(":")[1] == "_":
-        shelters: list[Shelter] = await get_shelters_without_verification(session)
-        await stateManager.set_data(update.callback_query.message.chat_id, "shelters",
-                                    [s for s in shelters if s.verified == 0 and (s.dobro_rf or s.get_messages)])
-        await stateManager.set_data(update.callback_query.message.chat_id, "shelters_index", 0)
-    elif update.callback_query.payload.split(":")[1] == "like":
-        shelter: Shelter = await get_shelter_by_id(session, int(update.callback_query.payload.split(":")[2]))
-        await update_shelter(session, shelter.id, verified=1)
-        await bot.send_message(chat_id=update.callback_query.message.chat_id,
-                               text="Приют верифицирован.")
-        await bot.send_message(user_id=shelter.max_id, text="Ваш приют верифицирован.")
-
-    shelters: list[Shelter] = await stateManager.get_data(update.callback_query.message.chat_id, "shelters")
-    shelters_index: int = await stateManager.get_data(update.callback_query.message.chat_id, "shelters_index")
-    if shelters_index < len(shelters):
-        moderator_id: int = int(update.callback_query.payload.split(":")[0].split("-")[1])
-        shelter: Shelter = shelters[shelters_index]
-
-        await bot.answer_callback(
-            update.callback_query.callback_id,
-            f"Приют {shelter.name}, {shelter.address}\n" \
-            f"{shelter.description if shelter.description else ""}\n{f"url: {shelter.dobro_rf}" if shelter.dobro_rf else ""}",
-            [InlineKeyboardMarkup([[InlineKeyboardButton("Одобрить", f"moderation-{moderator_id}:like:{shelter.id}"),
-                                    InlineKeyboardButton("Отправить замечание", f"warn:{shelter.id}")]]).to_dict()])
-    else:
-        await bot.send_message(chat_id=update.callback_query.message.chat_id,
-                               text="Все приюты верифицированы.")
+    callback_data: ModerationCb = update.callback_query.data
+    # Транзакция не даст двойному нажатию «Одобрить» одобрить или пропустить не тот приют
+    async with stateManager.transaction(update.callback_query.message.chat_id) as st:
+        if callback_data.action == "_":
+            shelters: list[Shelter] = await get_shelters_without_verification(session)
+            st.update(shelters=[s for s in shelters if s.verified == 0 and (s.dobro_rf or s.get_messages)],
+                      shelters_index=0)
+        elif callback_data.action == "like":
+            shown: list[Shelter] = st.get("shelters", [])[:st.get("shelters_index", 0)]
+            if not shown or shown[-1].id != callback_data.shelter_id:
+                # Повторное нажатие на уже обработанной анкете
+                await bot.answer_callback(update.callback_query.callback_id, notification="Приют уже обработан.")
+                return
+            shelter: Shelter = await get_shelter_by_id(session, callback_data.shelter_id)
+            await update_shelter(session, shelter.id, verified=1)
+            await bot.send_message(chat_id=update.callback_query.message.chat_id,
+                                   text="Приют верифицирован.")
+            await bot.send_message(user_id=shelter.max_id, text="Ваш приют верифицирован.")
 
+        shelters: list[Shelter] = st["shelters"]
+        shelters_index: int = st["shelters_index"]
+        if shelters_index < len(shelters):
+            moderator_id: int = callback_data.moderator_id
+            shelter: Shelter = shelters[shelters_index]
 
-async def moderation_warn_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "warn"
+            await bot.answer_callback(
+                update.callback_query.callback_id,
+                f"Приют {shelter.name}, {shelter.address}\n" \
+                f"{shelter.description if shelter.description else ""}\n{f"url: {shelter.dobro_rf}" if shelter.dobro_rf else ""}",
+                [InlineKeyboardMarkup([[InlineKeyboardButton("Одобрить", ModerationCb(moderator_id, "like", shelter.id).pack()),
+                                        InlineKeyboardButton("Отправить замечание", WarnCb(shelter.id).pack())]]).to_dict()])
+            st.set("shelters_index", shelters_index + 1)
+        else:
+            await bot.send_message(chat_id=update.callback_query.message.chat_id,
+                                   text="Все приюты верифицированы.")
 
 
-@dp.callback_query_handler(moderation_warn_callback)
+@dp.callback_query_handler(WarnCb.filter())
 async def warn_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await bot.send_message(chat_id=update.callback_query.message.chat_id,
                            text="Напишите замечание, которое будет отправлено приюту.")
     await stateManager.set_state(update.callback_query.message.chat_id, warn)
     await stateManager.set_data(update.callback_query.message.chat_id, "shelter_id",
-                                update.callback_query.payload.split(":")[1])
+                                update.callback_query.data.shelter_id)
 
 
 @dp.message_handler(StateFilter(warn))
@@ -517,7 +572,7 @@ async def send_warn_handler(update: Update, bot: Bot, stateManager: StateManager
     await bot.send_message(chat_id=update.message.chat_id,
                            text="Сообщение отправлено приюту. Перейти к верификации приютов?",
                            attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Да",
-                                                                                    f"moderation-{update.message.from_user.user_id}:next")]]).to_dict()])
+                                                                                    ModerationCb(update.message.from_user.user_id, "next").pack())]]).to_dict()])
 
 
 @dp.message_handler(Command("shelter"))
@@ -530,25 +585,21 @@ async def shelter_settings_handler(update: Update, bot: Bot, stateManager: State
         await bot.send_message(chat_id=update.message.chat_id,
                                text="Настройки приюта",
                                attachments=[InlineKeyboardMarkup(
-                                   [[InlineKeyboardButton("Изменить описание", "shelter-change:description")],
-                                    [InlineKeyboardButton("Изменить название", "shelter-change:name")],
-                                    [InlineKeyboardButton("Изменить адрес", "shelter-change:address")],
-                                    [InlineKeyboardButton("Изменить ссылку", "shelter-change:url")],
-                                    [InlineKeyboardButton("Отправка профиля", "shelter-change:get_messages")],
-                                    # [InlineKeyboardButton("Изменить город", "shelter-change:city")],
+                                   [[InlineKeyboardButton("Изменить описание", ShelterChangeCb("description").pack())],
+                                    [InlineKeyboardButton("Изменить название", ShelterChangeCb("name").pack())],
+                                    [InlineKeyboardButton("Изменить адрес", ShelterChangeCb("address").pack())],
+                                    [InlineKeyboardButton("Изменить ссылку", ShelterChangeCb("url").pack())],
+                                    [InlineKeyboardButton("Отправка профиля", ShelterChangeCb("get_messages").pack())],
+                                    # [InlineKeyboardButton("Изменить город", ShelterChangeCb("city").pack())],
                                     [InlineKeyboardButton("Добавить животное", "add_pet")],
-                                    [InlineKeyboardButton("Проверить верификацию", "shelter-change:verification")],
-                                    [InlineKeyboardButton("Удалить приют", "shelter-change:delete")]]
+                                    [InlineKeyboardButton("Проверить верификацию", ShelterChangeCb("verification").pack())],
+                                    [InlineKeyboardButton("Удалить приют", ShelterChangeCb("delete").pack())]]
                                ).to_dict()])
 
 
-async def shelter_change_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "shelter-change"
-
-
-@dp.callback_query_handler(shelter_change_callback)
+@dp.callback_query_handler(ShelterChangeCb.filter())
 async def shelter_change_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    command: str = update.callback_query.payload.split(":")[1]
+    command: str = update.callback_query.data.command
 
     match command:
         case "description":
@@ -575,9 +626,9 @@ async def shelter_change_handler(update: Update, bot: Bot, stateManager: StateMa
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Давать ли ссылку на ваш аккаунт в MAX человеку, который захочет забрать животное?",
                                    attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Нет",
-                                                                                            "get_messages-change:0"),
+                                                                                            GetMessagesChangeCb(0).pack()),
                                                                        InlineKeyboardButton("Да",
-                                                                                            "get_messages-change:1")]]).to_dict()])
+                                                                                            GetMessagesChangeCb(1).pack())]]).to_dict()])
             await stateManager.set_state(update.callback_query.message.chat_id, ShelterChange.get_messages)
 
         case "delete":
@@ -622,11 +673,7 @@ async def change_shelter_address_handler(update: Update, bot: Bot, stateManager:
     await stateManager.erase_state(update.message.chat_id)
 
 
-async def desc_change_callback(update: Update):
-    return update.callback_query.payload == "desc-change"
-
-
-@dp.callback_query_handler(desc_change_callback)
+@dp.callback_query_handler(Payload("desc-change"))
 async def desc_null_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     shelter = await get_shelter_by_max_id(session, update.callback_query.from_user.user_id)
     if shelter is not None:
@@ -637,11 +684,7 @@ async def desc_null_handler(update: Update, bot: Bot, stateManager: StateManager
     await stateManager.erase_state(update.callback_query.message.chat_id)
 
 
-async def url_change_callback(update: Update):
-    return update.callback_query.payload == "url-change"
-
-
-@dp.callback_query_handler(url_change_callback)
+@dp.callback_query_handler(Payload("url-change"))
 async def url_null_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     shelter = await get_shelter_by_max_id(session, update.callback_query.from_user.user_id)
     if shelter is not None:
@@ -677,13 +720,9 @@ async def url_null_st_handler(update: Update, bot: Bot, stateManager: StateManag
         await stateManager.erase_state(update.message.chat_id)
 
 
-async def change_get_messages_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "get_messages-change"
-
-
-@dp.callback_query_handler(change_get_messages_callback)
+@dp.callback_query_handler(GetMessagesChangeCb.filter())
 async def get_messages_change_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    get_messages: int = int(update.callback_query.payload.split(":")[1])
+    get_messages: int = update.callback_query.data.get_messages
 
 
     shelter = await get_shelter_by_max_id(session, update.callback_query.from_user.user_id)
@@ -715,12 +754,8 @@ async def shelter_contact_url_update_handler(update: Update, bot: Bot, stateMana
     await stateManager.erase_state(update.message.chat_id)
 
 
-async def add_pet_callback(update: Update):
-    return update.callback_query.payload == "add_pet"
-
-
 @dp.message_handler(Command("add"))
-@dp.callback_query_handler(add_pet_callback)
+@dp.callback_query_handler(Payload("add_pet"))
 async def add_pet_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     update.chat_id = update.message.chat_id if update.message else update.callback_query.message.chat_id
     user_id: int = update.message.from_user.user_id if update.message else update.callback_query.from_user.user_id
@@ -732,19 +767,15 @@ async def add_pet_handler(update: Update, bot: Bot, stateManager: StateManager,
         await bot.send_message(chat_id=update.chat_id,
                             text="Выберите тип животного.",
                             attachments=[InlineKeyboardMarkup(
-                                [[InlineKeyboardButton("Собака", "pet:dog"), InlineKeyboardButton("Кошка", "pet:cat")],
-                                    [InlineKeyboardButton("Другой", "pet:other")]]).to_dict()])
+                                [[InlineKeyboardButton("Собака", PetTypeCb("dog").pack()), InlineKeyboardButton("Кошка", PetTypeCb("cat").pack())],
+                                    [InlineKeyboardButton("Другой", PetTypeCb("other").pack())]]).to_dict()])
         await stateManager.set_state(update.chat_id, AnimalRegistration._type)
 
 
-async def add_pet_type_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "pet"
-
-
-@dp.callback_query_handler(add_pet_type_callback)
+@dp.callback_query_handler(PetTypeCb.filter())
 async def add_pet_type_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await stateManager.set_data(update.callback_query.message.chat_id, "pet_type",
-                                update.callback_query.payload.split(":")[1])
+                                update.callback_query.data.pet_type)
 
     await bot.send_message(chat_id=update.callback_query.message.chat_id,
                            text="Отправьте имя животного.")
@@ -767,21 +798,17 @@ async def add_pet_age_handler(update: Update, bot: Bot, stateManager: StateManag
     await bot.send_message(chat_id=update.message.chat_id,
                            text="Выберите пол животного.",
                            attachments=[InlineKeyboardMarkup([[
-                               InlineKeyboardButton("Мужской", "pet_gender:1"),
-                               InlineKeyboardButton("Женский", "pet_gender:0"),
+                               InlineKeyboardButton("Мужской", PetGenderCb(True).pack()),
+                               InlineKeyboardButton("Женский", PetGenderCb(False).pack()),
                            ]]).to_dict()])
     # await stateManager.set_state(update.message.chat_id, AnimalRegistration.gender)
 
 
-async def pet_gender_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "pet_gender"
-
-
 # @dp.message_handler(StateFilter(AnimalRegistration.gender))
-@dp.callback_query_handler(pet_gender_callback)
+@dp.callback_query_handler(PetGenderCb.filter())
 async def add_pet_gender_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await stateManager.set_data(update.callback_query.message.chat_id, "pet_gender",
-                                bool(int(update.callback_query.payload.split(":")[1])))
+                                update.callback_query.data.gender)
 
     await bot.send_message(chat_id=update.callback_query.message.chat_id,
                            text="Отправьте описание животного. Если вы не хотите его добавлять, нажмите нет.",
@@ -789,11 +816,7 @@ async def add_pet_gender_handler(update: Update, bot: Bot, stateManager: StateMa
     await stateManager.set_state(update.callback_query.message.chat_id, AnimalRegistration.description)
 
 
-async def add_null_pet_desc_callback(update: Update):
-    return update.callback_query.payload == "pet-desc"
-
-
-@dp.callback_query_handler(add_null_pet_desc_callback)
+@dp.callback_query_handler(Payload("pet-desc"))
 async def add_null_pet_desc_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await bot.send_message(chat_id=update.callback_query.message.chat_id,
                            text="Отправьте изображения животного. (Максимум 12). Если не будете прикреплять изображения, нажмите нет.",
@@ -826,20 +849,14 @@ async def add_media_handler(update: Update, bot: Bot, stateManager: StateManager
 
         pet_id = (await create_pet(session, shelter_id=shelter_id, location=location, **data)).id
 
-        for image in update.message.attachments:
-            if image["type"] == "image":
-                await create_photo(session, pet_id=pet_id, token=image["payload"]["token"])
+        await create_photos_bulk(session, pet_id, image_tokens(update.message))
 
         await bot.send_message(chat_id=update.message.chat_id,
                                text="Животное добавлено.")
     await stateManager.erase_state(update.message.chat_id)
 
 
-async def add_none_media_callback(update: Update):
-    return update.callback_query.payload == "pet-media"
-
-
-@dp.callback_query_handler(add_none_media_callback)
+@dp.callback_query_handler(Payload("pet-media"))
 async def add_none_media_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     shelter_id = (await get_shelter_by_max_id(session, update.callback_query.from_user.user_id)).id
     if shelter_id is None:
@@ -865,11 +882,9 @@ async def pets_handler(update: Update, bot: Bot, stateManager: StateManager, ses
     shelter: Shelter = (await get_shelter_by_max_id(session, update.message.from_user.user_id))
     if shelter is not None:
         if shelter.verified == 1:
-            pets: list[Pet] = await get_pets_by_shelter_id(session, shelter.id)
             if not (await stateManager.get_state(update.message.chat_id)):
                 await stateManager.set_state(update.message.chat_id, pets_state)
-            await stateManager.set_data(update.message.chat_id, "pets", pets)
-            await stateManager.set_data(update.message.chat_id, "pets_index", 0)
+            await stateManager.set_data(update.message.chat_id, "pets_cursor", 0)
             await bot.send_message(chat_id=update.message.chat_id,
                                    text="Что вы хотите сделать с питомцами?",
                                    attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Добавить", "add_pet"),
@@ -884,18 +899,14 @@ async def pets_handler(update: Update, bot: Bot, stateManager: StateManager, ses
                                text="Вы не зарегистрированы как приют. Зарегистрируйтесь по команде /start .")
 
 
-async def pet_change_next_callback(update: Update):
-    return update.callback_query.payload == "pet_change_next"
-
-
-@dp.callback_query_handler(pet_change_next_callback)
+@dp.callback_query_handler(Payload("pet_change_next"))
 async def pets_change_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     shelter = await get_shelter_by_max_id(session, update.callback_query.from_user.user_id)
     if shelter and shelter.verified:
-        pets_index: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_index")
-        pets: list[Pet] = await stateManager.get_data(update.callback_query.message.chat_id, "pets")
-        if pets_index < len(pets):
-            pet: Pet = pets[pets_index]
+        pets_cursor: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_cursor")
+        pets: list[Pet] = await get_pets_page(session, after_id=pets_cursor, limit=1, shelter_id=shelter.id)
+        if pets:
+            pet: Pet = pets[0]
             animal_types: dict[str, str] = {
                 "dog": "Собака",
                 "cat": "Кошка",
@@ -913,14 +924,14 @@ async def pets_change_handler(update: Update, bot: Bot, stateManager: StateManag
 
             await bot.answer_callback(
                 callback_id=update.callback_query.callback_id,
-                text=f"{animal_types[pet.type]} {"Девочка" if not pet.gender else "Мальчик"} {pet.name}, {pet.age} - {pet.location}, приют {(await get_shelter_by_id(session, pet.shelter_id)).name}\n" \
+                text=f"{animal_types[pet.type]} {"Девочка" if not pet.gender else "Мальчик"} {pet.name}, {pet.age} - {pet.location}, приют {pet.shelter.name}\n" \
                      f"{pet.description if pet.description else ""}",
-                attachments=[{"type": "image", "payload": {"token": pet.token}} for pet in
-                             (await get_photos_by_pet_id(session, pet.id))] + [InlineKeyboardMarkup([
+                attachments=[{"type": "image", "payload": {"token": photo.token}} for photo in
+                             pet.photos] + [InlineKeyboardMarkup([
                     [InlineKeyboardButton("Следующее животное", "pet_change_next")],
-                    [InlineKeyboardButton("Изменить животное", "pet_change:start")],
-                    [InlineKeyboardButton("Удалить животное", "pet_change:delete")]]).to_dict()])
-            await stateManager.set_data(update.callback_query.message.chat_id, "pets_index", pets_index + 1)
+                    [InlineKeyboardButton("Изменить животное", PetChangeCb("start").pack())],
+                    [InlineKeyboardButton("Удалить животное", PetChangeCb("delete").pack())]]).to_dict()])
+            await stateManager.set_data(update.callback_query.message.chat_id, "pets_cursor", pet.id)
         else:
             await bot.answer_callback(chat_id=update.callback_query.message.chat_id,
                                       text="Вы просмотрели всех животных.")
@@ -930,33 +941,27 @@ async def pets_change_handler(update: Update, bot: Bot, stateManager: StateManag
                                text="Ваш приют ещё не верифицирован. Проверьте статус верификации в настройках по команде /shelter.")
 
 
-async def pet_change_callback(update: Update):
-    return update.callback_query.payload.split(":")[0] == "pet_change"
-
-
-@dp.callback_query_handler(pet_change_callback)
+@dp.callback_query_handler(PetChangeCb.filter())
 async def pet_change_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    command: str = update.callback_query.payload.split(":")[1]
+    callback_data: PetChangeCb = update.callback_query.data
+    command: str = callback_data.command
 
     match command:
         case "start":
             await bot.answer_callback(update.callback_query.callback_id,
                                       attachments=[InlineKeyboardMarkup([
-                                          [InlineKeyboardButton("Изменить описание", "pet_change:description")],
-                                          [InlineKeyboardButton("Изменить имя", "pet_change:name")],
-                                          [InlineKeyboardButton("Изменить возраст", "pet_change:age")],
-                                          [InlineKeyboardButton("Изменить тип животного", "pet_change:type")],
-                                          [InlineKeyboardButton("Изменить пол", "pet_change:gender")],
-                                          [InlineKeyboardButton("Изменить фото", "pet_change:media")],
-                                          # [InlineKeyboardButton("Изменить город", "shelter-change:city")]
-                                          [InlineKeyboardButton("Удалить животное", "pet_change:delete")]]
+                                          [InlineKeyboardButton("Изменить описание", PetChangeCb("description").pack())],
+                                          [InlineKeyboardButton("Изменить имя", PetChangeCb("name").pack())],
+                                          [InlineKeyboardButton("Изменить возраст", PetChangeCb("age").pack())],
+                                          [InlineKeyboardButton("Изменить тип животного", PetChangeCb("type").pack())],
+                                          [InlineKeyboardButton("Изменить пол", PetChangeCb("gender").pack())],
+                                          [InlineKeyboardButton("Изменить фото", PetChangeCb("media").pack())],
+                                          # [InlineKeyboardButton("Изменить город", ShelterChangeCb("city").pack())]
+                                          [InlineKeyboardButton("Удалить животное", PetChangeCb("delete").pack())]]
                                       ).to_dict()])
         case "delete":
-            data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-            pets: list[Pet] = data["pets"]
-            pets_index: int = data["pets_index"]
-            pet: Pet = pets[pets_index - 1]
-            await delete_pet_by_id(session, pet.id)
+            pet_id: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_cursor")
+            await delete_pet_by_id(session, pet_id)
 
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Животное удалено.")
@@ -965,18 +970,15 @@ async def pet_change_handler(update: Update, bot: Bot, stateManager: StateManage
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Выберите новый тип животного.",
                                    attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Собака",
-                                                                                            "pet_change:new_type:dog"),
+                                                                                            PetChangeCb("new_type", "dog").pack()),
                                                                        InlineKeyboardButton("Кошка",
-                                                                                            "pet_change:new_type:cat")],
+                                                                                            PetChangeCb("new_type", "cat").pack())],
                                                                       [InlineKeyboardButton("Другой",
-                                                                                            "pet_change:new_type:other")]]).to_dict()])
+                                                                                            PetChangeCb("new_type", "other").pack())]]).to_dict()])
 
         case "new_type":
-            data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-            pets: list[Pet] = data["pets"]
-            pets_index: int = data["pets_index"]
-            pet: Pet = pets[pets_index - 1]
-            await update_pet(session, pet.id, pet_type=update.callback_query.payload.split(":")[2])
+            pet_id: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_cursor")
+            await update_pet(session, pet_id, pet_type=callback_data.value)
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Тип изменён.")
 
@@ -984,15 +986,12 @@ async def pet_change_handler(update: Update, bot: Bot, stateManager: StateManage
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Отправьте описание животного. Если вы хотите его убрать, нажмите нет.",
                                    attachments=[
-                                       InlineKeyboardMarkup([[InlineKeyboardButton("Нет", "pet_change:null_desc")]])])
+                                       InlineKeyboardMarkup([[InlineKeyboardButton("Нет", PetChangeCb("null_desc").pack())]])])
             await stateManager.set_state(update.callback_query.message.chat_id, AnimalChange.description)
 
         case "null_desc":
-            data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-            pets: list[Pet] = data["pets"]
-            pets_index: int = data["pets_index"]
-            pet: Pet = pets[pets_index - 1]
-            await update_pet(session, pet.id, description='')
+            pet_id: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_cursor")
+            await update_pet(session, pet_id, description='')
 
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Описание изменено.")
@@ -1012,18 +1011,12 @@ async def pet_change_handler(update: Update, bot: Bot, stateManager: StateManage
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Отправьте фотографии животного. Если вы хотите их убрать, нажмите нет.",
                                    attachments=[
-                                       InlineKeyboardMarkup([[InlineKeyboardButton("Нет", "pet_change:null_media")]])])
+                                       InlineKeyboardMarkup([[InlineKeyboardButton("Нет", PetChangeCb("null_media").pack())]]).to_dict()])
             await stateManager.set_state(update.callback_query.message.chat_id, AnimalChange.media)
 
         case "null_media":
-            data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-            pets: list[Pet] = data["pets"]
-            pets_index: int = data["pets_index"]
-            pet: Pet = pets[pets_index - 1]
-
-            photos = await get_photos_by_pet_id(session, pet.id)
-            for photo in photos:
-                await delete_photo_by_token(session, token=photo.token)
+            pet_id: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_cursor")
+            await delete_photos_by_pet_id(session, pet_id)
 
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Фотографии изменены.")
@@ -1034,16 +1027,13 @@ async def pet_change_handler(update: Update, bot: Bot, stateManager: StateManage
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Выберите новый пол животного.",
                                    attachments=[InlineKeyboardMarkup([[InlineKeyboardButton("Мужской",
-                                                                                            "pet_change:new_gender:1"),
+                                                                                            PetChangeCb("new_gender", "1").pack()),
                                                                        InlineKeyboardButton("Женский",
-                                                                                            "pet_change:new_gender:0")]]).to_dict()])
+                                                                                            PetChangeCb("new_gender", "0").pack())]]).to_dict()])
 
         case "new_gender":
-            data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-            pets: list[Pet] = data["pets"]
-            pets_index: int = data["pets_index"]
-            pet: Pet = pets[pets_index - 1]
-            await update_pet(session, pet.id, gender=bool(int(update.callback_query.payload.split(":")[2])))
+            pet_id: int = await stateManager.get_data(update.callback_query.message.chat_id, "pets_cursor")
+            await update_pet(session, pet_id, gender=bool(int(callback_data.value)))
 
             await bot.send_message(chat_id=update.callback_query.message.chat_id,
                                    text="Пол изменён.")
@@ -1051,72 +1041,100 @@ async def pet_change_handler(update: Update, bot: Bot, stateManager: StateManage
 
 @dp.message_handler(StateFilter(AnimalChange.description))
 async def pet_change_description_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-    pets: list[Pet] = data["pets"]
-    pets_index: int = data["pets_index"]
-    pet: Pet = pets[pets_index - 1]
+    pet_id: int = await stateManager.get_data(update.message.chat_id, "pets_cursor")
 
-    await update_pet(session, pet.id, description=update.message.text)
+    await update_pet(session, pet_id, description=update.message.text)
 
-    await bot.send_message(chat_id=update.callback_query.message.chat_id,
+    await bot.send_message(chat_id=update.message.chat_id,
                            text="Описание изменено.")
-    await stateManager.erase_state(update.callback_query.message.chat_id)
+    await stateManager.erase_state(update.message.chat_id)
 
 
 @dp.message_handler(StateFilter(AnimalChange.name))
 async def pet_change_name_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-    pets: list[Pet] = data["pets"]
-    pets_index: int = data["pets_index"]
-    pet: Pet = pets[pets_index - 1]
-    await update_pet(session, pet.id, name=update.message.text)
+    pet_id: int = await stateManager.get_data(update.message.chat_id, "pets_cursor")
+    await update_pet(session, pet_id, name=update.message.text)
 
-    await bot.send_message(chat_id=update.callback_query.message.chat_id,
+    await bot.send_message(chat_id=update.message.chat_id,
                            text="Имя изменено.")
-    await stateManager.erase_state(update.callback_query.message.chat_id)
+    await stateManager.erase_state(update.message.chat_id)
 
 
 @dp.message_handler(StateFilter(AnimalChange.age))
 async def pet_change_age_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-    pets: list[Pet] = data["pets"]
-    pets_index: int = data["pets_index"]
-    pet: Pet = pets[pets_index - 1]
+    pet_id: int = await stateManager.get_data(update.message.chat_id, "pets_cursor")
 
-    await update_pet(session, pet.id, age=data["age"])
+    await update_pet(session, pet_id, age=update.message.text)
 
-    await bot.send_message(chat_id=update.callback_query.message.chat_id,
+    await bot.send_message(chat_id=update.message.chat_id,
                            text="Возраст изменён.")
-    await stateManager.erase_state(update.callback_query.message.chat_id)
+    await stateManager.erase_state(update.message.chat_id)
 
 
 @dp.message_handler(StateFilter(AnimalChange.media))
 async def pet_change_media_handler(update: Update, bot: Bot, stateManager: StateManager, session):
-    data = await stateManager.get_all_data(update.callback_query.message.chat_id)
-    pets: list[Pet] = data["pets"]
-    pets_index: int = data["pets_index"]
-    pet: Pet = pets[pets_index - 1]
-    photos = await get_photos_by_pet_id(session, pet.id)
-    for photo in photos:
-        await delete_photo_by_token(session, token=photo.token)
-    for token in update.message.attachments:
-        await create_photo(session, pet.id, token=token)
+    pet_id: int = await stateManager.get_data(update.message.chat_id, "pets_cursor")
+    await replace_pet_photos(session, pet_id, image_tokens(update.message))
 
-    await bot.send_message(chat_id=update.callback_query.message.chat_id,
+    await bot.send_message(chat_id=update.message.chat_id,
                            text="Фотографии изменены.")
-    await stateManager.erase_state(update.callback_query.message.chat_id)
+    await stateManager.erase_state(update.message.chat_id)
 
 @dp.message_handler(Command("cancel"))
 async def cancel_handler(update: Update, bot: Bot, stateManager: StateManager, session):
     await stateManager.erase_state(update.message.chat_id)
     await bot.send_message(chat_id=update.message.chat_id, text="Все действия отменены.")
 
-async def main():
-    session = await create_db()
-    async with bot:
-        dp._session = session
-        await dp.start_polling()
+def webhook_processes() -> int:
+    """Число процессов вебхука; больше одного — только с общим между процессами хранилищем FSM"""
+    processes = int(os.getenv('WEBHOOK_PROCESSES', 1))
+    if processes > 1 and not dp.stateManager.storage.shared:
+        logging.error(f"WEBHOOK_PROCESSES={processes} требует общего хранилища состояний FSM (KVStorage с сетевым "
+                      f"клиентом), а настроено {type(dp.stateManager.storage).__name__}; запускается один процесс.")
+        return 1
+    return processes
+
+
+async def main(process_index: int = 0, processes: int = 1):
+    dp.sessionmaker = await create_db(pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+                                      pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+                                      echo=os.getenv('DB_ECHO') == '1')
+    maintenance = asyncio.create_task(maintenance_loop(dp.sessionmaker,
+                                                       interval=float(os.getenv('DB_MAINTENANCE_INTERVAL', 3600))))
+    if os.getenv('METRICS_PORT'):
+        # У каждого процесса свой порт: METRICS_PORT, METRICS_PORT + 1, ...
+        await dp.serve_metrics(host=os.getenv('METRICS_HOST', '127.0.0.1'),
+                               port=int(os.getenv('METRICS_PORT')) + process_index)
+    try:
+        async with bot:
+            if os.getenv('WEBHOOK_PORT'):
+                await dp.start_webhook(path=os.getenv('WEBHOOK_PATH', '/webhook'),
+                                       secret=os.getenv('WEBHOOK_SECRET'),
+                                       port=int(os.getenv('WEBHOOK_PORT')),
+                                       reuse_port=processes > 1,
+                                       url=os.getenv('WEBHOOK_URL'),
+                                       workers=int(os.getenv('WORKERS', 8)))
+            else:
+                await dp.start_polling(workers=int(os.getenv('WORKERS', 8)),
+                                       marker_store=MarkerStore(os.getenv('POLLING_MARKER_PATH',
+                                                                          'polling_marker.json')))
+    finally:
+        maintenance.cancel()
+        if dp.metrics_server is not None:
+            await dp.metrics_server.stop()
+
+
+def run(process_index: int = 0, processes: int = 1):
+    asyncio.run(main(process_index, processes))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    processes = webhook_processes() if os.getenv('WEBHOOK_PORT') else 1
+    if processes > 1:
+        children = [multiprocessing.Process(target=run, args=(index, processes)) for index in range(processes)]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+    else:
+        run()
@@ -2,10 +2,22 @@
 __version__ = "0.1.0"
 
 from .bot import Bot
+from .transport import TransportConfig
+from .ratelimit import RateLimiter
+from .retry import RetryPolicy
+from .outbox import Outbox, MemoryOutboxStore, SQLiteOutboxStore
+from .codec import JSONCodec, get_codec
+from .checkpoint import MarkerStore, UpdateDedup
+from .metrics import MetricsRegistry, MetricsServer
+from .tracing import Tracer, JSONLSink
 from .dispatcher import Dispatcher
 from .router import Router
-from .filters import StateFilter, CallbackQueryFilter
+from .pool import WorkerPool
+from .filters import StateFilter, CallbackQueryFilter, Payload
 from .state import StateManager, State
+from .storage import StateStorage, MemoryStorage, SQLiteStorage, KVStorage, LocalKV
+from .eviction import EvictionPolicy
+from .callback_data import CallbackData
 from ._types import (
     Message, User, Chat, Update, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton
@@ -16,12 +28,35 @@ from .log import configure_logging, get_logger
 
 __all__ = [
     'Bot',
+    'TransportConfig',
+    'RateLimiter',
+    'RetryPolicy',
+    'Outbox',
+    'MemoryOutboxStore',
+    'SQLiteOutboxStore',
+    'JSONCodec',
+    'get_codec',
+    'MarkerStore',
+    'UpdateDedup',
+    'MetricsRegistry',
+    'MetricsServer',
+    'Tracer',
+    'JSONLSink',
     'Dispatcher', 
     'Router', 
+    'WorkerPool',
     'StateFilter',
     'StateManager',
     'State',
+    'StateStorage',
+    'MemoryStorage',
+    'SQLiteStorage',
+    'KVStorage',
+    'LocalKV',
+    'EvictionPolicy',
     'CallbackQueryFilter',
+    'Payload',
+    'CallbackData',
     'Message',
     'User',
     'Chat', 
@@ -1,7 +1,10 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional, List, Dict, Any
 
-@dataclass
+_EMPTY: Dict[str, Any] = {}
+
+
+@dataclass(slots=True)
 class User:
     user_id: int
     first_name: str
@@ -10,7 +13,12 @@ class User:
     is_bot: bool = False
     last_activity_time: Optional[int] = None
 
-@dataclass
+    @classmethod
+    def from_raw(cls, data: Dict[str, Any]) -> "User":
+        return cls(data.get("user_id", 0), data.get("first_name", ""), data.get("last_name"),
+                   data.get("username"), data.get("is_bot", False), data.get("last_activity_time"))
+
+@dataclass(slots=True)
 class Chat:
     chat_id: int
     type: str
@@ -19,36 +27,113 @@ class Chat:
     participants_count: Optional[int] = None
     last_event_time: Optional[int] = None
 
-@dataclass
+    @classmethod
+    def from_recipient(cls, recipient: Dict[str, Any]) -> "Chat":
+        return cls(recipient.get("chat_id", 0), recipient.get("chat_type", "chat"), "active")
+
+@dataclass(init=False)
 class Message:
+    """Message; ``chat`` and ``from_user`` of a parsed message are built on first access.
+
+    The cached objects and raw dicts live in slots outside the dataclass
+    fields, so equality and repr don't depend on what was accessed;
+    ``dataclasses.replace`` copies the fields only.
+    """
+    # _chat, _from_user: built (or given) objects; _recipient, _sender: raw API dicts
+    __slots__ = ("message_id", "text", "timestamp", "attachments", "_chat", "_from_user", "_recipient", "_sender")
+
     message_id: str
-    chat: Chat
-    from_user: User
-    text: Optional[str] = None
-    timestamp: Optional[int] = None
-    attachments: Optional[List[Dict[str, Any]]] = None
-    
+    text: Optional[str]
+    timestamp: Optional[int]
+    attachments: Optional[List[Dict[str, Any]]]
+
+    def __init__(self, message_id: str, chat: Optional[Chat] = None, from_user: Optional[User] = None,
+                 text: Optional[str] = None, timestamp: Optional[int] = None,
+                 attachments: Optional[List[Dict[str, Any]]] = None):
+        self.message_id = message_id
+        self._chat = chat
+        self._from_user = from_user
+        self.text = text
+        self.timestamp = timestamp
+        self.attachments = attachments
+        self._recipient = _EMPTY
+        self._sender = _EMPTY
+
+    @classmethod
+    def from_raw(cls, data: Dict[str, Any]) -> "Message":
+        """Message from the API's message object; sender and recipient are kept raw until used"""
+        body = data.get("body") or _EMPTY
+        message = cls(body.get("mid", ""), None, None, body.get("text"), data.get("timestamp", 0),
+                      body.get("attachments"))
+        message._recipient = data.get("recipient") or _EMPTY
+        message._sender = data.get("sender") or _EMPTY
+        return message
+
+    @property
+    def chat(self) -> Chat:
+        if self._chat is None:
+            self._chat = Chat.from_recipient(self._recipient)
+        return self._chat
+
+    @property
+    def from_user(self) -> User:
+        if self._from_user is None:
+            self._from_user = User.from_raw(self._sender)
+        return self._from_user
+
     @property
     def chat_id(self) -> int:
-        return self.chat.chat_id
+        if self._chat is not None:
+            return self._chat.chat_id
+        return self._recipient.get("chat_id", 0)
     
     @property
     def from_id(self) -> int:
-        return self.from_user.user_id
+        if self._from_user is not None:
+            return self._from_user.user_id
+        return self._sender.get("user_id", 0)
     
     def to_dict(self) -> Dict[str, Any]:
         return {"text": self.text,
                 "attachments": self.attachments,}
 
-@dataclass
+@dataclass(init=False)
 class CallbackQuery:
+    """Callback query; ``from_user`` of a parsed callback is built on first access
+    (kept, with the raw user dict, in slots outside the dataclass fields like for Message)"""
+    __slots__ = ("callback_id", "message", "payload", "timestamp", "data", "_from_user", "_user")
+
     callback_id: str
-    from_user: User
-    message: Optional[Message] = None
-    payload: Optional[str] = None
-    timestamp: Optional[int] = None
+    message: Optional[Message]
+    payload: Optional[str]
+    timestamp: Optional[int]
+    data: Optional[Any]  # payload decoded by CallbackData, if its prefix is registered
+
+    def __init__(self, callback_id: str, from_user: Optional[User] = None, message: Optional[Message] = None,
+                 payload: Optional[str] = None, timestamp: Optional[int] = None, data: Optional[Any] = None):
+        self.callback_id = callback_id
+        self._from_user = from_user
+        self.message = message
+        self.payload = payload
+        self.timestamp = timestamp
+        self.data = data
+        self._user = _EMPTY
+
+    @classmethod
+    def from_raw(cls, data: Dict[str, Any], message: Optional[Message] = None,
+                 decoded: Optional[Any] = None) -> "CallbackQuery":
+        query = cls(data.get("callback_id", ""), None, message, data.get("payload"), data.get("timestamp", 0),
+                    decoded)
+        query._user = data.get("user") or _EMPTY
+        return query
 
-@dataclass
+    @property
+    def from_user(self) -> User:
+        if self._from_user is None:
+            self._from_user = User.from_raw(self._user)
+        return self._from_user
+
+@dataclass(slots=True)
 class Update:
     update_id: int
     update_type: str
@@ -57,6 +142,17 @@ class Update:
     callback_query: Optional[CallbackQuery] = None
     chat_id: Optional[int] = None
     payload: Optional[str] = None
+    trace: Optional[Any] = field(default=None, repr=False, compare=False)  # tracing.Trace, if sampled
+
+    @property
+    def key(self) -> str:
+        """Identity of the update: message id, callback id, or (without one) type, chat and timestamp"""
+        if self.message and self.message.message_id:
+            return f"message:{self.message.message_id}"
+        if self.callback_query and self.callback_query.callback_id:
+            return f"callback:{self.callback_query.callback_id}"
+        chat = self.effective_chat
+        return f"{self.update_type}:{chat.chat_id if chat is not None else self.chat_id}:{self.timestamp}"
     
     @property
     def effective_chat(self) -> Optional[Chat]:
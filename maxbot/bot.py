@@ -1,14 +1,84 @@
+import asyncio
+import functools
+import inspect
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
 import aiohttp
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, Callable
 from .log import get_logger
+from .transport import TransportConfig
+from .ratelimit import RateLimiter, parse_retry_after
+from .retry import RetryPolicy, DEFAULT_RETRY_POLICIES
+from .outbox import Outbox
+from .codec import get_codec
+from .telemetry import ApiTelemetry
+from . import tracing
 
 logger = get_logger("bot")
 
+# Set while the outbox delivers a call, so the call goes straight to the API
+_delivering: ContextVar[bool] = ContextVar("delivering", default=False)
+# Chat of the update being handled (set by the dispatcher), used to order queued calls
+handling_chat: ContextVar[Optional[int]] = ContextVar("handling_chat", default=None)
+
+
+def chat_key(call: Dict[str, Any], fallback: str) -> str:
+    """Ordering key of a queued call: its chat_id, else the chat of the update being handled"""
+    chat_id = call.get("chat_id") or handling_chat.get()
+    return f"chat:{chat_id}" if chat_id is not None else fallback
+
+
+def chat_rate_key(chat_id: Optional[int]) -> Optional[Tuple[str, int]]:
+    """Rate limiter key of a call: its chat_id, else the chat of the update being handled"""
+    chat_id = chat_id or handling_chat.get()
+    return ("chat", chat_id) if chat_id is not None else None
+
+
+def queued(key: Callable[[Dict[str, Any]], Optional[str]], dedup: bool = False):
+    """Bot method that is put into the outbox when one is enabled.
+
+    In outbox mode the method returns an ``asyncio.Future`` as soon as the
+    call is stored; await it for the API response. ``key`` maps the call's
+    arguments to its ordering key; with ``dedup`` a dedup key is generated
+    before storing, so a replayed entry is sent with the same key.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if self.outbox is None or _delivering.get():
+                return await func(self, *args, **kwargs)
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            del arguments["self"]
+            if dedup and not arguments.get("dedup_key"):
+                arguments["dedup_key"] = uuid.uuid4().hex
+            return await self.outbox.put(func.__name__, arguments, key(arguments))
+        return wrapper
+    return decorator
+
+
 class Bot:
-    def __init__(self, token: str, base_url: str = "https://platform-api.max.ru"):
+    def __init__(self, token: str, base_url: str = "https://platform-api.max.ru",
+                 transport: Optional[TransportConfig] = None, rate_limiter: Optional[RateLimiter] = None,
+                 retry_policies: Optional[Dict[str, RetryPolicy]] = None, dedup_cache_size: int = 1024,
+                 json_dumps: Optional[Callable[[Any], str]] = None, json_loads: Optional[Callable[[Any], Any]] = None):
         self.token = token
         self.base_url = base_url
+        self.transport = transport or TransportConfig()
+        self.rate_limiter = rate_limiter
+        self.retry_policies = {**DEFAULT_RETRY_POLICIES, **(retry_policies or {})}
+        self.default_retry_policy = self.retry_policies.pop("default", RetryPolicy())
+        self.dedup_cache_size = dedup_cache_size
+        self._delivered: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self.outbox: Optional[Outbox] = None
+        codec = get_codec() if json_dumps is None or json_loads is None else None
+        self.json_dumps = json_dumps or codec.dumps
+        self.json_loads = json_loads or codec.loads
         self.session: Optional[aiohttp.ClientSession] = None
+        self.poll_session: Optional[aiohttp.ClientSession] = None
+        self.telemetry = ApiTelemetry()
         self._logger = get_logger("bot")
         
     async def __aenter__(self):
@@ -23,28 +93,167 @@ class Bot:
         self._logger.debug("Setting up aiohttp session")
         self.session = aiohttp.ClientSession(
             base_url=self.base_url,
-            headers={"Content-Type": "application/json"}
+            headers={"Content-Type": "application/json"},
+            connector=self.transport.connector(),
+            json_serialize=self.json_dumps,
+            trace_configs=[self.telemetry.trace_config()]
         )
+        if self.transport.dedicated_poll_connection:
+            self.poll_session = aiohttp.ClientSession(
+                base_url=self.base_url,
+                headers={"Content-Type": "application/json"},
+                connector=self.transport.poll_connector(),
+                json_serialize=self.json_dumps,
+                trace_configs=[self.telemetry.trace_config()]
+            )
+        else:
+            self.poll_session = self.session
         self._logger.info("Bot session initialized")
+        if self.transport.warm_up:
+            await self.warm_up()
+        if self.outbox is not None:
+            await self.outbox.start()
         
     async def close(self):
         """Close aiohttp session"""
+        if self.outbox is not None and self.outbox.running:
+            await self.outbox.stop()
         if self.session:
             self._logger.debug("Closing aiohttp session")
+            if self.poll_session is not None and self.poll_session is not self.session:
+                await self.poll_session.close()
             await self.session.close()
             self._logger.info("Bot session closed")
+
+    async def warm_up(self):
+        """Open connections (DNS, TCP, TLS) ahead of the first update"""
+        sessions = {id(session): session for session in (self.session, self.poll_session)}.values()
+        results = await asyncio.gather(*(self._request("get", "get_me", "/me", session=session)
+                                         for session in sessions), return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        if failed:
+            self._logger.warning(f"Connection warm-up failed: {failed[0]}")
+        else:
+            self._logger.debug(f"Warmed up {len(results)} connections")
             
+    def enable_outbox(self, store=None, senders: int = 4, max_attempts: int = 5) -> Outbox:
+        """Deliver sends, callback answers, edits and deletes in the background.
+
+        ``store`` is a MemoryOutboxStore (default) or a SQLiteOutboxStore;
+        the outbox starts with ``setup`` and is drained by ``close``. A call
+        failing ``max_attempts`` times goes to the store's dead letters.
+        """
+        self.outbox = Outbox(self, store, senders, max_attempts)
+        return self.outbox
+
+    async def deliver(self, method: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Perform a stored call directly, bypassing the outbox"""
+        token = _delivering.set(True)
+        try:
+            return await getattr(self, method)(**kwargs)
+        finally:
+            _delivering.reset(token)
+
     def _build_url(self, method: str) -> str:
         """Build URL with access token"""
         return f"{method}?access_token={self.token}"
+
+    async def _request(self, http_method: str, method: str, path: str,
+                       session: Optional[aiohttp.ClientSession] = None,
+                       timeout: Optional[aiohttp.ClientTimeout] = None,
+                       rate_key: Any = None, dedup_key: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        """Perform API call with the transport's timeout budget for the Bot method.
+
+        Outbound methods go through the rate limiter when one is set:
+        ``rate_key`` orders sends per recipient, and a 429 pauses the
+        limiter for ``Retry-After`` before the call is repeated. Failures
+        are retried according to the method's RetryPolicy while the
+        recipient's slot is held, so a retry never overtakes later sends.
+        A ``dedup_key`` that this Bot already delivered returns the cached
+        response without another request; the outbox store keeps delivered
+        keys across restarts. The key also goes out as the Idempotency-Key
+        header, but the MAX API isn't known to honour it, so retries of a
+        non-idempotent call must not rely on it.
+        """
+        if dedup_key is not None:
+            if dedup_key in self._delivered:
+                self._logger.debug(f"{method} with dedup key {dedup_key} already delivered")
+                return self._delivered[dedup_key]
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Idempotency-Key": dedup_key}
+
+        request = getattr(session or self.session, http_method)
+        url = self._build_url(path)
+        timeout = timeout or self.transport.timeout_for(method)
+        limiter = self.rate_limiter if method != "get_updates" else None
+        if limiter is None:
+            status, data = await self._retrying(method, request, url, timeout, kwargs)
+        else:
+            async with limiter.slot(rate_key) as waited:
+                if waited >= 0.001:
+                    self._logger.debug(f"{method} queued for {waited * 1000:.1f}ms")
+                status, data = await self._retrying(method, request, url, timeout, kwargs)
+
+        if dedup_key is not None and status < 400:
+            self._delivered[dedup_key] = data
+            if len(self._delivered) > self.dedup_cache_size:
+                self._delivered.popitem(last=False)
+        return data
+
+    async def _retrying(self, method: str, request, url: str, timeout: aiohttp.ClientTimeout,
+                        kwargs: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Call _send until it succeeds, fails fatally or the policy runs out of attempts"""
+        policy = self.retry_policies.get(method, self.default_retry_policy)
+        attempt = 0
+        while True:
+            last_attempt = attempt + 1 >= policy.attempts
+            try:
+                status, response = await self._send(method, request, url, timeout, kwargs)
+            except Exception as e:
+                if last_attempt or not policy.retryable_error(e):
+                    raise
+                reason = f"{type(e).__name__}: {e}"
+            else:
+                if last_attempt or status not in policy.retry_statuses:
+                    return status, response
+                reason = f"HTTP {status}"
+            delay = policy.backoff(attempt)
+            attempt += 1
+            self.telemetry.retried(method)
+            self._logger.warning(f"{method} failed ({reason}), retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def _send(self, method: str, request, url: str, timeout: aiohttp.ClientTimeout,
+                    kwargs: Dict[str, Any]) -> Tuple[int, Any]:
+        """Single attempt; a 429 pauses the rate limiter and is repeated"""
+        limiter = self.rate_limiter
+        retries_429 = 0
+        while True:
+            timing = self.telemetry.started(method)
+            status = None
+            try:
+                with tracing.span("http", method=method) as span:
+                    async with request(url, timeout=timeout, trace_request_ctx=timing, **kwargs) as response:
+                        status = response.status
+                        span.set(status=status)
+                        if status != 429 or limiter is None or retries_429 >= limiter.max_retries:
+                            return status, await response.json(loads=self.json_loads)
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except BaseException as e:
+                status = e
+                raise
+            finally:
+                self.telemetry.finished(method, timing, status)
+            retries_429 += 1
+            self.telemetry.retried(method)
+            limiter.pause(retry_after)
+            await limiter.wait()
     
     async def get_me(self) -> Dict[str, Any]:
         """Get bot info"""
         self._logger.debug("Getting bot info")
-        async with self.session.get(self._build_url("/me")) as response:
-            data = await response.json()
-            self._logger.debug(f"Bot info received: {data}")
-            return data
+        data = await self._request("get", "get_me", "/me")
+        self._logger.debug(f"Bot info received: {data}")
+        return data
     
     async def get_updates(self, limit: int = 100, timeout: int = 30, 
                          marker: Optional[int] = None, types: Optional[list] = None) -> Dict[str, Any]:
@@ -57,20 +266,28 @@ class Bot:
             
         self._logger.debug(f"Getting updates with params: {params}")
         
-        async with self.session.get(self._build_url("/updates"), params=params) as response:
-            data = await response.json()
-            updates_count = len(data.get("updates", []))
-            self._logger.debug(f"Received {updates_count} updates")
-            return data
+        data = await self._request("get", "get_updates", "/updates", session=self.poll_session or self.session,
+                                   timeout=self.transport.poll_timeout(timeout), params=params)
+        updates_count = len(data.get("updates", []))
+        self._logger.debug(f"Received {updates_count} updates")
+        return data
     
+    @queued(lambda call: f"chat:{call['chat_id']}" if call.get("chat_id") else f"user:{call.get('user_id')}",
+            dedup=True)
     async def send_message(self,
                            chat_id: int | None = None,
                            user_id: int | None = None,
                            text: str | None = "",
                            attachments: Optional[list] = None,
                            format: Optional[str] = None,
-                           disable_link_preview: bool = False) -> Dict[str, Any]:
-        """Send message to chat"""
+                           disable_link_preview: bool = False,
+                           dedup_key: Optional[str] = None) -> Dict[str, Any]:
+        """Send message to chat.
+
+        A dedup key is generated once per call when not given and kept for
+        its retries and outbox replays; pass your own (e.g. derived from the
+        update) to make repeated sends of one message a no-op.
+        """
         payload = {
             "text": text,
             "attachments": attachments or [],
@@ -94,25 +311,29 @@ class Bot:
         
         self._logger.debug(f"Sending message to chat {chat_id}: {text[:50]}...")
         
-        async with self.session.post(
-            self._build_url("/messages"), 
-            params=params,
-            json=payload
-        ) as response:
-            data = await response.json()
-            message_id = data.get("message", {}).get("body", {}).get("mid", "unknown")
-            self._logger.info(f"Message sent to chat {chat_id}, message_id: {message_id}")
-            return data
+        rate_key = ("chat", chat_id) if chat_id else ("user", user_id)
+        data = await self._request("post", "send_message", "/messages", params=params, json=payload,
+                                   rate_key=rate_key, dedup_key=dedup_key or uuid.uuid4().hex)
+        message_id = data.get("message", {}).get("body", {}).get("mid", "unknown")
+        self._logger.info(f"Message sent to chat {chat_id}, message_id: {message_id}")
+        return data
     
+    @queued(lambda call: chat_key(call, f"callback:{call['callback_id']}"))
     async def answer_callback(
         self,
         callback_id: str,
         text: Optional[str] = None, 
         attachments: Optional[list] = None,
         format: Optional[str] = None,
-        notification: Optional[str] = None
+        notification: Optional[str] = None,
+        chat_id: Optional[int] = None
     ) -> Dict[str, Any]:
-        """Answer callback query and edit last message."""
+        """Answer callback query and edit last message.
+
+        ``chat_id`` (like for edits and deletes) orders the call with other
+        calls for the chat, in the outbox and the rate limiter's per-chat
+        bucket; by default it's the chat of the update being handled.
+        """
         payload = {}
 
         if text or attachments:
@@ -133,17 +354,14 @@ class Bot:
         
         self._logger.debug(f"Answering callback {callback_id}")
         
-        async with self.session.post(
-            self._build_url("/answers"),
-            params=params,
-            json=payload
-        ) as response:
-            data = await response.json()
-            self._logger.debug(f"Callback {callback_id} answered")
-            return data
+        data = await self._request("post", "answer_callback", "/answers", params=params, json=payload,
+                                   rate_key=chat_rate_key(chat_id))
+        self._logger.debug(f"Callback {callback_id} answered")
+        return data
     
+    @queued(lambda call: chat_key(call, f"message:{call['message_id']}"))
     async def edit_message(self, message_id: str, text: str,
-                          attachments: Optional[list] = None) -> Dict[str, Any]:
+                          attachments: Optional[list] = None, chat_id: Optional[int] = None) -> Dict[str, Any]:
         """Edit message"""
         payload = {
             "text": text,
@@ -154,39 +372,48 @@ class Bot:
         
         self._logger.debug(f"Editing message {message_id}")
         
-        async with self.session.put(
-            self._build_url("/messages"),
-            params=params,
-            json=payload
-        ) as response:
-            data = await response.json()
-            self._logger.info(f"Message {message_id} edited")
-            return data
+        data = await self._request("put", "edit_message", "/messages", params=params, json=payload,
+                                   rate_key=chat_rate_key(chat_id))
+        self._logger.info(f"Message {message_id} edited")
+        return data
     
-    async def delete_message(self, message_id: str) -> Dict[str, Any]:
+    @queued(lambda call: chat_key(call, f"message:{call['message_id']}"))
+    async def delete_message(self, message_id: str, chat_id: Optional[int] = None) -> Dict[str, Any]:
         """Delete message"""
         params = {"message_id": message_id}
         
         self._logger.debug(f"Deleting message {message_id}")
         
-        async with self.session.delete(
-            self._build_url("/messages"),
-            params=params
-        ) as response:
-            data = await response.json()
-            self._logger.info(f"Message {message_id} deleted")
-            return data
+        data = await self._request("delete", "delete_message", "/messages", params=params,
+                                   rate_key=chat_rate_key(chat_id))
+        self._logger.info(f"Message {message_id} deleted")
+        return data
     
+    async def subscribe(self, url: str, secret: Optional[str] = None,
+                        update_types: Optional[list] = None) -> Dict[str, Any]:
+        """Subscribe webhook url to updates"""
+        payload = {"url": url}
+        if secret:
+            payload["secret"] = secret
+        if update_types:
+            payload["update_types"] = update_types
+        data = await self._request("post", "subscribe", "/subscriptions", json=payload)
+        self._logger.info(f"Webhook subscribed: {url}")
+        return data
+
+    async def unsubscribe(self, url: str) -> Dict[str, Any]:
+        """Remove webhook subscription"""
+        data = await self._request("delete", "unsubscribe", "/subscriptions", params={"url": url})
+        self._logger.info(f"Webhook unsubscribed: {url}")
+        return data
+
     async def get_chat(self, chat_id: int) -> Dict[str, Any]:
         """Get chat info"""
         self._logger.debug(f"Getting chat info for {chat_id}")
         
-        async with self.session.get(
-            self._build_url(f"/chats/{chat_id}")
-        ) as response:
-            data = await response.json()
-            self._logger.debug(f"Chat info received for {chat_id}")
-            return data
+        data = await self._request("get", "get_chat", f"/chats/{chat_id}")
+        self._logger.debug(f"Chat info received for {chat_id}")
+        return data
 
     async def health_check(self) -> bool:
         """Perform health check by getting bot info"""
@@ -0,0 +1,117 @@
+import types
+import typing
+from dataclasses import fields
+from typing import Any, Callable, ClassVar, Dict, List, Optional, Tuple, Type
+
+from .filters import Payload
+
+SEPARATOR = ":"
+# Marks a packed string field, so "" isn't read back as None
+ESCAPE = "~"
+
+
+def _converter(annotation: Any) -> Callable[[str], Any]:
+    """String -> value converter for a field annotation"""
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        annotation = args[0] if len(args) == 1 else str
+    if annotation is bool:
+        return lambda raw: raw not in ("0", "false", "False")
+    if annotation in (int, float):
+        return annotation
+    return str
+
+
+class CallbackData:
+    """Base for typed callback payloads packed as ``prefix:field1:field2...``.
+
+    Subclasses are dataclasses declared with a prefix::
+
+        @dataclass
+        class SearchCb(CallbackData, prefix="search"):
+            action: str
+            kind: str
+            pet_id: Optional[int] = None
+
+    Every subclass is registered by prefix, so the dispatcher decodes a
+    payload once and stores the result in ``CallbackQuery.data``.
+    None packs as an empty field and trailing ones are omitted, but the
+    separator after the prefix never is. An empty string packs as ``~``
+    (a string starting with ``~`` gets one more).
+    """
+
+    prefix: ClassVar[str] = ""
+    _registry: ClassVar[Dict[str, Type["CallbackData"]]] = {}
+    _converters: ClassVar[Optional[List[Tuple[str, Callable[[str], Any]]]]] = None
+
+    def __init_subclass__(cls, prefix: Optional[str] = None, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if prefix is None:
+            return
+        if SEPARATOR in prefix:
+            raise ValueError(f"Callback prefix '{prefix}' must not contain '{SEPARATOR}'.")
+        if prefix in CallbackData._registry:
+            raise ValueError(f"Callback prefix '{prefix}' is already registered.")
+        cls.prefix = prefix
+        cls._converters = None
+        CallbackData._registry[prefix] = cls
+
+    @classmethod
+    def _get_converters(cls) -> List[Tuple[str, Callable[[str], Any]]]:
+        if cls._converters is None:
+            hints = typing.get_type_hints(cls)
+            cls._converters = [(field.name, _converter(hints.get(field.name, str))) for field in fields(cls)]
+        return cls._converters
+
+    def pack(self) -> str:
+        """Build payload string"""
+        parts = [self.prefix]
+        for name, _ in self._get_converters():
+            value = getattr(self, name)
+            if value is None:
+                value = ""
+            elif isinstance(value, bool):
+                value = int(value)
+            value = str(value)
+            if SEPARATOR in value:
+                raise ValueError(f"Callback field '{name}' must not contain '{SEPARATOR}'.")
+            if isinstance(getattr(self, name), str) and (not value or value.startswith(ESCAPE)):
+                value = ESCAPE + value
+            parts.append(value)
+        while len(parts) > 1 and parts[-1] == "":
+            parts.pop()
+        return SEPARATOR.join(parts) if len(parts) > 1 else self.prefix + SEPARATOR
+
+    @classmethod
+    def unpack(cls, payload: str) -> "CallbackData":
+        """Parse payload string, raising ValueError if it doesn't fit"""
+        prefix, *parts = payload.split(SEPARATOR)
+        if prefix != cls.prefix:
+            raise ValueError(f"Payload '{payload}' has no '{cls.prefix}' prefix.")
+        converters = cls._get_converters()
+        if len(parts) > len(converters):
+            raise ValueError(f"Payload '{payload}' has too many fields for {cls.__name__}.")
+        values = {name: None if raw == "" else convert(raw[1:] if raw.startswith(ESCAPE) else raw)
+                  for (name, convert), raw in zip(converters, parts)}
+        try:
+            return cls(**values)
+        except TypeError as e:
+            raise ValueError(f"Payload '{payload}' doesn't fit {cls.__name__}: {e}") from e
+
+    @classmethod
+    def filter(cls) -> Payload:
+        """Payload filter matching every payload of this class"""
+        return Payload(f"{cls.prefix}{SEPARATOR}*")
+
+
+def decode_payload(payload: Optional[str]) -> Optional[CallbackData]:
+    """Decode payload with the CallbackData class registered for its prefix"""
+    if not payload:
+        return None
+    cls = CallbackData._registry.get(payload.split(SEPARATOR, 1)[0])
+    if cls is None:
+        return None
+    try:
+        return cls.unpack(payload)
+    except ValueError:
+        return None
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Iterable, List, Optional, Tuple
+
+
+class UpdateDedup:
+    """Bounded LRU window of update keys already taken for processing"""
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self._keys: OrderedDict[str, None] = OrderedDict()
+        self.duplicates = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: str) -> bool:
+        """Remember key; False if it's already in the window"""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            self.duplicates += 1
+            return False
+        self._keys[key] = None
+        if len(self._keys) > self.size:
+            self._keys.popitem(last=False)
+        return True
+
+    def update(self, keys: Iterable[str]):
+        for key in keys:
+            self.add(key)
+
+
+class MarkerStore:
+    """Polling checkpoint in a JSON file: the marker of the last fully
+    processed batch and keys of updates processed after it was fetched.
+
+    The file is replaced atomically, so a crash leaves the previous
+    checkpoint intact.
+    """
+
+    def __init__(self, path: str = "polling_marker.json"):
+        self.path = path
+
+    def load(self) -> Tuple[Optional[Any], List[str]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None, []
+        return data.get("marker"), data.get("processed", [])
+
+    def _write(self, marker: Any, processed: List[str]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"marker": marker, "processed": processed}, f)
+        os.replace(tmp_path, self.path)
+
+    async def save(self, marker: Any, processed: List[str]):
+        await asyncio.to_thread(self._write, marker, processed)
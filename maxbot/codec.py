@@ -0,0 +1,51 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+@dataclass(frozen=True)
+class JSONCodec:
+    """dumps/loads pair used by Bot for request bodies and responses"""
+    name: str
+    dumps: Callable[[Any], str]
+    loads: Callable[[Union[str, bytes]], Any]
+
+
+def _stdlib_codec() -> JSONCodec:
+    return JSONCodec("json", lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")), json.loads)
+
+
+def _orjson_codec() -> JSONCodec:
+    return JSONCodec("orjson", lambda obj: orjson.dumps(obj).decode(), orjson.loads)
+
+
+def _msgspec_codec() -> JSONCodec:
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+    return JSONCodec("msgspec", lambda obj: encoder.encode(obj).decode(), decoder.decode)
+
+
+CODECS: Dict[str, Callable[[], JSONCodec]] = {"json": _stdlib_codec}
+if msgspec is not None:
+    CODECS["msgspec"] = _msgspec_codec
+if orjson is not None:
+    CODECS["orjson"] = _orjson_codec
+
+
+def get_codec(name: Optional[str] = None) -> JSONCodec:
+    """Codec by name; without a name the fastest installed one (orjson, msgspec, then stdlib json)"""
+    if name is None:
+        name = next(codec for codec in ("orjson", "msgspec", "json") if codec in CODECS)
+    if name not in CODECS:
+        raise ValueError(f"JSON codec '{name}' is not available, installed: {', '.join(CODECS)}.")
+    return CODECS[name]()
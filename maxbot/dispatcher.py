@@ -1,24 +1,63 @@
 import asyncio
+import inspect
 import time
-from typing import Callable, Dict, List, Any, Optional
+from collections import deque
+from itertools import count
+from typing import Callable, Deque, Dict, List, Any, Optional, Union
 
 from maxbot.state import StateManager
-from .bot import Bot
-from ._types import Update, Message, CallbackQuery, Chat, User
-from .filters import Filter
+from .bot import Bot, handling_chat
+from .callback_data import decode_payload
+from ._types import Update, Message, CallbackQuery
+from .filters import Filter, Command, Payload, StateFilter
 from .log import get_logger
+from .metrics import FILTER_BUCKETS, MetricsRegistry, MetricsServer
+from . import tracing
+from .tracing import Tracer
+from .pool import WorkerPool
+from .retry import RetryPolicy
+from .checkpoint import MarkerStore, UpdateDedup
+from .routing import MessageIndex, PayloadIndex
+from .webhook import WebhookServer
+from .state import State
 
 logger = get_logger("dispatcher")
 
+HANDLER_ARGS = 4  # update, bot, stateManager, session
+
+
+def _positional_arity(callback: Callable) -> int:
+    """Count positional arguments the handler accepts (at most HANDLER_ARGS)"""
+    try:
+        parameters = inspect.signature(callback).parameters.values()
+    except (TypeError, ValueError):
+        return HANDLER_ARGS
+
+    count = 0
+    for parameter in parameters:
+        if parameter.kind is parameter.VAR_POSITIONAL:
+            return HANDLER_ARGS
+        if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD):
+            count += 1
+    return min(count, HANDLER_ARGS)
+
+
 class Handler:
-    def __init__(self, callback: Callable, filters: List[Filter] = None):
+    def __init__(self, callback: Callable, filters: List[Filter] = None, order: int = 0,
+                 route: Optional[Filter] = None):
         self.callback = callback
         self.filters = filters or []
         self.name = callback.__name__
+        self.order = order
+        # Filter already satisfied by the dispatcher's routing index
+        self.route = route
+        self.arg_count = _positional_arity(callback)
+        self.uses_session = self.arg_count == HANDLER_ARGS
+        self.filter_names = [getattr(f, "__name__", type(f).__name__) for f in self.filters]
 
 class Dispatcher:
-    def __init__(self, bot: Bot):
-        self._session = None
+    def __init__(self, bot: Bot, sessionmaker: Optional[Callable[[], Any]] = None):
+        self.sessionmaker = sessionmaker
         self.stateManager = StateManager()
         self.bot = bot
         self.handlers: Dict[str, List[Handler]] = {
@@ -27,14 +66,47 @@ class Dispatcher:
             "my_chat_member": [],
             "bot_started": []
         }
+        self.pool: Optional[WorkerPool] = None
+        self._callback_index = PayloadIndex()
+        self._message_index = MessageIndex()
+        self._handlers_count = 0
         self._running = False
         self._processed_updates = 0
         self._start_time = None
+        self.metrics = MetricsRegistry()
+        self._updates_total = self.metrics.counter(
+            "maxbot_updates_total", "Updates processed, by type", ("type",))
+        self._unhandled_total = self.metrics.counter(
+            "maxbot_unhandled_updates_total", "Updates no handler accepted, by type", ("type",))
+        self._handler_seconds = self.metrics.histogram(
+            "maxbot_handler_seconds", "Handler run time", ("handler",))
+        self._handler_errors = self.metrics.counter(
+            "maxbot_handler_errors_total", "Exceptions raised by handlers and their filters", ("handler",))
+        self._filter_seconds = self.metrics.histogram(
+            "maxbot_filter_seconds", "Filter check time", ("handler", "filter"), FILTER_BUCKETS)
+        self.metrics.gauge("maxbot_queue_depth", "Updates waiting in the worker pool",
+                           function=lambda: self.pool.queue_depth if self.pool is not None else 0)
+        self.metrics.collector(self.bot.telemetry.metrics)
+        self.tracer = Tracer()
+        self.metrics_server: Optional[MetricsServer] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self.dedup = UpdateDedup()
+        self._update_ids = count(1)  # the API doesn't number updates
+        # Recently processed update keys, kept in the checkpoint to drop redeliveries of old batches
+        self._processed_keys: Deque[str] = deque(maxlen=1000)
+        # Processed keys of batches above the saved marker: all of them go into the checkpoint
+        self._unsaved_keys: Dict[str, None] = {}
+        self._track_keys = False
         self._logger = get_logger("dispatcher")
 
+    def _new_handler(self, callback: Callable, filters: List[Filter],
+                     route: Optional[Filter] = None) -> Handler:
+        self._handlers_count += 1
+        return Handler(callback, filters, order=self._handlers_count, route=route)
+
     def bot_started_handler(self, *filters: Filter):
         def decorator(callback: Callable):
-            handler = Handler(callback, list(filters))
+            handler = self._new_handler(callback, list(filters))
             self.handlers["bot_started"].append(handler)
             self._logger.debug(f"Registered message handler: {handler.name}")
             return callback
@@ -42,33 +114,74 @@ class Dispatcher:
 
     def message_handler(self, *filters: Filter):
         def decorator(callback: Callable):
-            handler = Handler(callback, list(filters))
+            # A sole StateFilter or Command is matched by the index instead of the filter loop
+            route = filters[0] if len(filters) == 1 else None
+            if isinstance(route, Command) or (isinstance(route, StateFilter) and type(route.state) is State):
+                handler = self._new_handler(callback, [], route)
+            else:
+                handler = self._new_handler(callback, list(filters))
             self.handlers["message"].append(handler)
+            self._message_index.add(handler)
             self._logger.debug(f"Registered message handler: {handler.name}")
             return callback
         return decorator
     
     def callback_query_handler(self, *filters: Filter):
         def decorator(callback: Callable):
-            handler = Handler(callback, list(filters))
+            # The first Payload filter is matched by the index instead of the filter loop
+            checks = list(filters)
+            payload = next((f for f in checks if isinstance(f, Payload)), None)
+            if payload is not None:
+                checks.remove(payload)
+            handler = self._new_handler(callback, checks, payload)
             self.handlers["callback_query"].append(handler)
+            self._callback_index.add(handler)
             self._logger.debug(f"Registered callback handler: {handler.name}")
             return callback
         return decorator
     
     async def process_update(self, update: Update):
-        """Process single update"""
+        """Process single update, inside its trace if it's sampled"""
+        chat_token = handling_chat.set(self._update_chat_id(update))
+        try:
+            trace = update.trace
+            if trace is None:
+                await self._dispatch(update)
+                return
+            trace.queued()
+            token = tracing.activate(trace)
+            try:
+                with tracing.span("dispatch"):
+                    await self._dispatch(update)
+            finally:
+                tracing.deactivate(token)
+                await self.tracer.finish(trace)
+        finally:
+            handling_chat.reset(chat_token)
+
+    @staticmethod
+    def _update_chat_id(update: Update) -> Optional[int]:
+        if update.message:
+            return update.message.chat_id
+        if update.callback_query and update.callback_query.message:
+            return update.callback_query.message.chat_id
+        return update.chat_id
+
+    async def _dispatch(self, update: Update):
         self._processed_updates += 1
         update_type = None
         
         if update.message:
             update_type = "message"
-            handlers = self.handlers["message"]
+            state = None
+            if self._message_index.uses_state:
+                state = await self.stateManager.get_state(update.message.chat_id)
+            handlers = self._message_index.resolve(state, update.message.text)
             user_id = update.effective_user.user_id if update.effective_user else "unknown"
             self._logger.debug(f"Processing message update {update.update_id} from user {user_id}")
         elif update.callback_query:
             update_type = "callback_query"
-            handlers = self.handlers["callback_query"]
+            handlers = self._callback_index.resolve(update.callback_query.payload)
             user_id = update.effective_user.user_id if update.effective_user else "unknown"
             self._logger.debug(f"Processing callback update {update.update_id} from user {user_id}")
         elif update.update_type == "bot_started":
@@ -78,58 +191,211 @@ class Dispatcher:
             self._logger.debug(f"Processing callback update {update.update_id} from user {user_id}")
         else:
             self._logger.debug(f"Unknown update type: {update.update_type}")
+            self._updates_total.inc(update.update_type or "unknown")
+            self._unhandled_total.inc(update.update_type or "unknown")
             return
+        self._updates_total.inc(update_type)
         
         handler_executed = False
+        traced = update.trace is not None  # spans only for sampled updates: no overhead otherwise
         for handler in handlers:
             try:
                 # Check filters
                 passed = True
-                for filter_obj in handler.filters:
-                    if not await filter_obj(update):
+                for filter_obj, filter_name in zip(handler.filters, handler.filter_names):
+                    start_time = time.perf_counter()
+                    if traced:
+                        with tracing.span("filter", handler=handler.name, filter=filter_name) as span:
+                            result = await filter_obj(update)
+                            span.set(passed=bool(result))
+                    else:
+                        result = await filter_obj(update)
+                    self._filter_seconds.observe(time.perf_counter() - start_time, handler.name, filter_name)
+                    if not result:
                         passed = False
                         break
                 
                 if passed:
-                    start_time = time.time()
+                    start_time = time.perf_counter()
                     self._logger.debug(f"Executing handler: {handler.name}")
                     
-                    await handler.callback(update, self.bot, self.stateManager, self._session)
-                    
-                    execution_time = (time.time() - start_time) * 1000
-                    self._logger.debug(f"Handler {handler.name} executed in {execution_time:.2f}ms")
+                    try:
+                        if traced:
+                            with tracing.span("handler", handler=handler.name):
+                                await self._call_handler(handler, update)
+                        else:
+                            await self._call_handler(handler, update)
+                    finally:
+                        execution_time = time.perf_counter() - start_time
+                        self._handler_seconds.observe(execution_time, handler.name)
+                    self._logger.debug(f"Handler {handler.name} executed in {execution_time * 1000:.2f}ms")
                     
                     handler_executed = True
                     break  # Only first matching handler
                     
             except Exception as e:
+                self._handler_errors.inc(handler.name)
                 self._logger.error(f"Error in handler {handler.name}: {e}", exc_info=True)
         
         if not handler_executed:
+            self._unhandled_total.inc(update_type)
             self._logger.debug(f"No handler found for update {update.update_id}")
 
-    
+    async def _call_handler(self, handler: Handler, update: Update):
+        """Call handler with its own short-lived DB session if it takes one"""
+        # AsyncSession checks out a pooled connection only on the first query,
+        # so handlers that never touch the DB never hold a connection.
+        if not handler.uses_session or self.sessionmaker is None:
+            args = (update, self.bot, self.stateManager, None)
+            await handler.callback(*args[:handler.arg_count])
+            return
+
+        async with self.sessionmaker() as session:
+            await handler.callback(update, self.bot, self.stateManager, session)
+
     async def start_polling(self, timeout: int = 30, limit: int = 100, 
-                           skip_updates: bool = False, reset_webhook: bool = True):
-        """Start long polling"""
+                           skip_updates: bool = False, reset_webhook: bool = True,
+                           workers: int = 8, queue_size: int = 100,
+                           high_watermark: Optional[int] = None, low_watermark: Optional[int] = None,
+                           prefetch: int = 2, max_consecutive_errors: int = 5,
+                           marker_store: Optional[MarkerStore] = None):
+        """Start long polling.
+
+        A separate poller task issues the next ``/updates`` request as soon
+        as the marker is known and hands batches over through a queue of
+        ``prefetch`` batches, so parsing and dispatch don't delay receiving.
+        Polling pauses while more than ``high_watermark`` updates wait in the
+        worker pool and resumes at ``low_watermark``; errors back off
+        exponentially with jitter.
+
+        Updates whose key is in the dedup window are skipped. With a
+        ``marker_store`` the marker of the last fully processed batch is
+        checkpointed together with keys of updates processed since, and
+        polling resumes from it after a restart without handling anything
+        twice.
+
+        If the poller task dies, the pool is stopped and its exception is
+        raised from here.
+        """
         self._running = True
-        marker = None
         self._start_time = time.time()
         self._processed_updates = 0
+        drain = True
         
         self._logger.info("Starting polling...")
+        await self.stateManager.open()
+        marker = None
+        if marker_store is not None:
+            marker, processed = marker_store.load()
+            self.dedup.update(processed)
+            self._processed_keys.extend(processed)
+            self._logger.info(f"Resuming polling from marker {marker}")
+        self._track_keys = marker_store is not None
+        self._unsaved_keys.clear()
+        self.pool = WorkerPool(self._process_polled, workers=workers, queue_size=queue_size)
+        self.pool.start()
+        if high_watermark is None:
+            high_watermark = workers * queue_size // 2
+        if low_watermark is None:
+            low_watermark = high_watermark // 2
         
         if skip_updates:
             self._logger.info("Skipping pending updates")
         
         if reset_webhook:
             self._logger.debug("Webhook reset is enabled")
-        
+
+        batches: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+        poller = asyncio.create_task(self._poll(batches, marker, timeout, limit, high_watermark, low_watermark,
+                                                max_consecutive_errors))
+        # (marker, pool checkpoint, update keys) of batches not yet fully processed, oldest first
+        pending: List[tuple] = []
+        error = None
+        try:
+            while True:
+                try:
+                    batch = await self._next_batch(batches, poller, 1 if pending else None)
+                except asyncio.TimeoutError:
+                    await self._save_marker(marker_store, pending)
+                    continue
+                if batch is None:
+                    break
+                updates, batch_marker = batch
+                batch_keys = []
+                for update_data in updates:
+                    update = self._parse_update(update_data)
+                    if update is None:
+                        continue
+                    if not self.dedup.add(update.key):
+                        self._logger.debug(f"Skipping duplicate update {update.key}")
+                        continue
+                    batch_keys.append(update.key)
+                    await self.pool.submit(update)
+                if marker_store is not None:
+                    pending.append((batch_marker, self.pool.checkpoint(), batch_keys))
+                    await self._save_marker(marker_store, pending)
+        except asyncio.CancelledError:
+            self._logger.info("Polling cancelled")
+            drain = False
+        except Exception as e:
+            self._logger.error(f"Polling failed: {e}", exc_info=True)
+            error = e
+        finally:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+
+        await self.pool.stop(drain=drain)
+        await self._save_marker(marker_store, pending)
+        await self.stateManager.close()
+        if error is not None:
+            raise error
+
+    @staticmethod
+    async def _next_batch(batches: asyncio.Queue, poller: asyncio.Task, timeout: Optional[float]):
+        """Next batch from the poller; raises the poller's exception if it died, TimeoutError after timeout"""
+        getter = asyncio.ensure_future(batches.get())
+        try:
+            await asyncio.wait((getter, poller), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not getter.done():
+                getter.cancel()
+        if getter.done() and not getter.cancelled():
+            return getter.result()
+        if poller.done():
+            # The poller puts None before returning, so it can only end without it by raising
+            poller.result()
+            return None
+        raise asyncio.TimeoutError
+
+    async def _process_polled(self, update: Update):
+        await self.process_update(update)
+        self._processed_keys.append(update.key)
+        if self._track_keys:
+            self._unsaved_keys[update.key] = None
+
+    async def _save_marker(self, marker_store: Optional[MarkerStore], pending: List[tuple]):
+        """Checkpoint the marker of the newest batch whose updates were all processed"""
+        marker = None
+        while pending and self.pool.reached(pending[0][1]):
+            marker, _, batch_keys = pending.pop(0)
+            for key in batch_keys:
+                self._unsaved_keys.pop(key, None)
+        if marker_store is not None and marker is not None:
+            await marker_store.save(marker, list(dict.fromkeys([*self._processed_keys, *self._unsaved_keys])))
+
+    async def _poll(self, batches: asyncio.Queue, marker: Optional[int], timeout: int, limit: int,
+                    high_watermark: int, low_watermark: int, max_consecutive_errors: int):
+        """Poller task: fetch (updates, marker) batches into the queue until stopped; None marks the end"""
         poll_attempts = 0
         consecutive_errors = 0
-        max_consecutive_errors = 5
-        
+        backoff = RetryPolicy(base_delay=1, max_delay=60)
+
         while self._running:
+            if self.pool.queue_depth > high_watermark:
+                self._logger.warning(f"Dispatch queue above {high_watermark} updates, pausing polling")
+                await self.pool.wait_for_depth(low_watermark)
+                self._logger.info(f"Dispatch queue down to {self.pool.queue_depth} updates, resuming polling")
+                continue
             try:
                 poll_attempts += 1
                 self._logger.debug(f"Polling attempt #{poll_attempts}, timeout: {timeout}s")
@@ -139,29 +405,8 @@ class Dispatcher:
                     limit=limit,
                     marker=marker
                 )
-                
-                consecutive_errors = 0  # Reset error counter on success
-                
-                if "updates" in updates_data:
-                    updates = updates_data["updates"]
-                    self._logger.info(f"Received {len(updates)} updates")
-                    
-                    for update_data in updates:
-                        update = self._parse_update(update_data)
-                        # print(update) #!!!
-                        if update:
-                            asyncio.create_task(self.process_update(update))
-                    
-                    # Update marker for next request
-                    if "marker" in updates_data:
-                        marker = updates_data["marker"]
-                        self._logger.debug(f"Updated marker to: {marker}")
-                else:
-                    self._logger.debug("No updates in response")
-                        
             except asyncio.CancelledError:
-                self._logger.info("Polling cancelled")
-                break
+                raise
             except Exception as e:
                 consecutive_errors += 1
                 self._logger.error(f"Polling error (attempt {consecutive_errors}): {e}")
@@ -170,10 +415,69 @@ class Dispatcher:
                     self._logger.error(f"Too many consecutive errors ({consecutive_errors}), stopping polling")
                     break
                 
-                await asyncio.sleep(5)
-    
+                await asyncio.sleep(backoff.backoff(consecutive_errors - 1))
+                continue
+
+            consecutive_errors = 0  # Reset error counter on success
+            # Update marker for next request
+            if "marker" in updates_data:
+                marker = updates_data["marker"]
+                self._logger.debug(f"Updated marker to: {marker}")
+
+            updates = updates_data.get("updates")
+            if updates:
+                self._logger.info(f"Received {len(updates)} updates")
+                await batches.put((updates, marker))
+            else:
+                self._logger.debug("No updates in response")
+
+        await batches.put(None)
+
+    async def start_webhook(self, path: str = "/webhook", secret: Optional[str] = None,
+                            host: str = "0.0.0.0", port: int = 8080, reuse_port: bool = False,
+                            url: Optional[str] = None, workers: int = 8, queue_size: int = 100):
+        """Receive updates via webhook until stopped; subscribes url when given.
+
+        Start one process per CPU with ``reuse_port=True`` to share the port.
+        That requires StateManager storage shared between processes (KVStorage
+        with a networked client), otherwise a chat's FSM state would be split
+        between them; ValueError is raised without it. Updates of one chat may
+        still reach different processes, so their order is kept per process only.
+        """
+        if reuse_port and not self.stateManager.storage.shared:
+            raise ValueError(f"reuse_port needs FSM storage shared between processes, "
+                             f"not {type(self.stateManager.storage).__name__}.")
+        self._running = True
+        self._start_time = time.time()
+        self._processed_updates = 0
+        self._stopped = asyncio.Event()
+
+        await self.stateManager.open()
+        self.pool = WorkerPool(self.process_update, workers=workers, queue_size=queue_size)
+        self.pool.start()
+        server = WebhookServer(self, path=path, secret=secret, host=host, port=port, reuse_port=reuse_port)
+        await server.start()
+        try:
+            if url:
+                await self.bot.subscribe(url, secret=secret)
+            await self._stopped.wait()
+        except asyncio.CancelledError:
+            self._logger.info("Webhook cancelled")
+        finally:
+            await server.stop()
+            await self.pool.stop()
+            await self.stateManager.close()
+
+    async def serve_metrics(self, host: str = "127.0.0.1", port: int = 9090, path: str = "/metrics") -> MetricsServer:
+        """Serve ``self.metrics`` in the Prometheus text format until ``metrics_server.stop()``"""
+        self.metrics_server = MetricsServer(self.metrics, host, port, path)
+        await self.metrics_server.start()
+        return self.metrics_server
+
     def stop_polling(self):
-        """Stop polling"""
+        """Stop polling (or webhook)"""
+        if self._stopped is not None:
+            self._stopped.set()
         if self._running:
             self._running = False
             runtime = time.time() - self._start_time if self._start_time else 0
@@ -184,37 +488,25 @@ class Dispatcher:
         else:
             self._logger.warning("Polling is not running")
     
-    def _parse_update(self, update_data: Dict[str, Any]) -> Optional[Update]:
-        """Parse update from API response"""
+    def _parse_update(self, update_data: Union[Dict[str, Any], str, bytes]) -> Optional[Update]:
+        """Parse update from API response (decoded, or raw JSON decoded with the bot's codec)"""
         try:
+            if not isinstance(update_data, dict):
+                update_data = self.bot.json_loads(update_data)
             update_type = update_data.get("update_type")
-            
-            message = None
-            callback_query = None
-            payload = None
-            chat_id = None
-            
+            timestamp = update_data.get("timestamp", 0)
+            update = Update(next(self._update_ids), update_type, timestamp)
+            update.trace = self.tracer.start("update", type=update_type)
+
             if update_type == "message_created":
-                message_data = update_data.get("message", {})
-                message = self._parse_message(message_data)
+                update.message = self._parse_message(update_data.get("message") or {})
             elif update_type == "message_callback":
-                callback_data = update_data.get("callback", {})
-                message_data = update_data.get("message")
-                callback_query = self._parse_callback_query(callback_data, message_data)
+                update.callback_query = self._parse_callback_query(update_data.get("callback") or {},
+                                                                   update_data.get("message"))
             elif update_type == "bot_started":
-                payload = update_data.get("payload")
-                chat_id = update_data.get("chat_id")
-
-            
-            return Update(
-                update_id=update_data.get("timestamp", 0),
-                update_type=update_type,
-                timestamp=update_data.get("timestamp", 0),
-                message=message,
-                callback_query=callback_query,
-                chat_id=chat_id,
-                payload=payload
-            )
+                update.payload = update_data.get("payload")
+                update.chat_id = update_data.get("chat_id")
+            return update
         except Exception as e:
             self._logger.error(f"Error parsing update: {e}")
             return None
@@ -222,33 +514,7 @@ class Dispatcher:
     def _parse_message(self, message_data: Dict[str, Any]) -> Optional[Message]:
         """Parse message from API response"""
         try:
-            body = message_data.get("body", {})
-            sender = message_data.get("sender", {})
-            recipient = message_data.get("recipient", {})
-            
-            chat = Chat(
-                chat_id=recipient.get("chat_id", 0),
-                type=recipient.get("chat_type", "chat"),
-                status="active",
-                title=None
-            )
-            
-            user = User(
-                user_id=sender.get("user_id", 0),
-                first_name=sender.get("first_name", ""),
-                last_name=sender.get("last_name"),
-                username=sender.get("username"),
-                is_bot=sender.get("is_bot", False)
-            )
-            
-            return Message(
-                message_id=body.get("mid", ""),
-                chat=chat,
-                from_user=user,
-                text=body.get("text"),
-                timestamp=message_data.get("timestamp", 0),
-                attachments=body.get("attachments")
-            )
+            return Message.from_raw(message_data)
         except Exception as e:
             self._logger.error(f"Error parsing message: {e}")
             return None
@@ -257,24 +523,8 @@ class Dispatcher:
                             message_data: Optional[Dict[str, Any]]) -> Optional[CallbackQuery]:
         """Parse callback query from API response"""
         try:
-            user_data = callback_data.get("user", {})
             message = self._parse_message(message_data) if message_data else None
-            
-            user = User(
-                user_id=user_data.get("user_id", 0),
-                first_name=user_data.get("first_name", ""),
-                last_name=user_data.get("last_name"),
-                username=user_data.get("username"),
-                is_bot=user_data.get("is_bot", False)
-            )
-            
-            return CallbackQuery(
-                callback_id=callback_data.get("callback_id", ""),
-                from_user=user,
-                message=message,
-                payload=callback_data.get("payload"),
-                timestamp=callback_data.get("timestamp", 0)
-            )
+            return CallbackQuery.from_raw(callback_data, message, decode_payload(callback_data.get("payload")))
         except Exception as e:
             self._logger.error(f"Error parsing callback query: {e}")
             return None
\ No newline at end of file
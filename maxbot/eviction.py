@@ -0,0 +1,42 @@
+import sys
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+# reason is "ttl", "entries" or "memory"
+EvictionHook = Callable[[int, list, str], Awaitable[Any]]
+
+
+@dataclass
+class EvictionPolicy:
+    """Limits on FSM sessions kept by StateManager.
+
+    ``ttl`` evicts chats idle for that many seconds (checked by the sweeper
+    every ``sweep_interval`` seconds); ``max_entries`` and ``max_bytes``
+    evict least recently used chats as soon as the budget is exceeded.
+    ``on_evict(chat_id, record, reason)`` is awaited for every eviction.
+    """
+
+    ttl: Optional[float] = None
+    max_entries: Optional[int] = None
+    max_bytes: Optional[int] = None
+    sweep_interval: float = 60
+    on_evict: Optional[EvictionHook] = None
+
+
+def approx_size(obj: Any, depth: int = 4) -> int:
+    """Rough deep size of a record in bytes: containers and object attributes a few levels down"""
+    size = sys.getsizeof(obj)
+    if depth == 0:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(approx_size(key, depth - 1) + approx_size(value, depth - 1) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(approx_size(item, depth - 1) for item in obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    attributes = getattr(obj, "__dict__", None)
+    if attributes is not None:
+        # Private attributes (e.g. SQLAlchemy's _sa_instance_state) point at shared objects
+        return size + sum(approx_size(value, depth - 1) for name, value in attributes.items()
+                          if not name.startswith("_"))
+    return size
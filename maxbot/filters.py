@@ -7,19 +7,21 @@ class Filter:
         return True
 
 
+def parse_command(text: Optional[str]) -> Optional[str]:
+    """Command name from message text ("/Start@bot arg" -> "start")"""
+    if not text or not text.startswith('/'):
+        return None
+    return text[1:].lower().split(' ')[0].split('@')[0]
+
+
 class Command(Filter):
     def __init__(self, command: str):
         self.command = command.lower().lstrip('/')
 
     async def __call__(self, update: Update) -> bool:
-        if not update.message or not update.message.text:
+        if not update.message:
             return False
-
-        text = update.message.text.lower()
-        if text.startswith('/'):
-            command = text[1:].split(' ')[0].split('@')[0]
-            return command == self.command
-        return False
+        return parse_command(update.message.text) == self.command
 
 
 class Text(Filter):
@@ -58,6 +60,24 @@ class CallbackQueryFilter(Filter):
             return False
         return True
 
+class Payload(Filter):
+    """Callback payload filter: exact value, or prefix when ending with '*'.
+
+    Dispatcher indexes handlers registered with it, so they are found by a
+    dict lookup instead of a scan over every callback handler.
+    """
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.prefix = pattern[:-1] if pattern.endswith('*') else None
+
+    async def __call__(self, update: Update) -> bool:
+        if not update.callback_query or update.callback_query.payload is None:
+            return False
+        payload = update.callback_query.payload
+        if self.prefix is not None:
+            return payload.startswith(self.prefix)
+        return payload == self.pattern
+
 # class BotStarted(Filter):
 #     def __init__(self):
 #         super().__init__()
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+from .log import get_logger
+from .pool import WorkerPool
+
+
+@dataclass
+class OutboxEntry:
+    """Queued Bot call: method name, its arguments, the ordering key and failed attempts so far"""
+    entry_id: int
+    method: str
+    kwargs: Dict[str, Any]
+    key: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    attempts: int = 0
+
+
+class MemoryOutboxStore:
+    """Outbox kept in memory: fast, but pending sends are lost on restart"""
+
+    def __init__(self, delivered_keys: int = 10000):
+        self._entries: Dict[int, OutboxEntry] = {}
+        self._dead: List[OutboxEntry] = []
+        self._delivered: OrderedDict[str, Any] = OrderedDict()
+        self.delivered_keys = delivered_keys
+        self._ids = count(1)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def add(self, method: str, kwargs: Dict[str, Any], key: Optional[str]) -> OutboxEntry:
+        entry = OutboxEntry(next(self._ids), method, kwargs, key)
+        self._entries[entry.entry_id] = entry
+        return entry
+
+    async def pending(self) -> List[OutboxEntry]:
+        return sorted(self._entries.values(), key=lambda entry: entry.entry_id)
+
+    async def done(self, entry_id: int, dedup_key: Optional[str] = None, response: Any = None):
+        self._entries.pop(entry_id, None)
+        if dedup_key is not None:
+            self._delivered[dedup_key] = response
+            if len(self._delivered) > self.delivered_keys:
+                self._delivered.popitem(last=False)
+
+    async def delivered(self, dedup_key: str) -> Optional[Any]:
+        """Response of an already delivered call with this dedup key, or None"""
+        return self._delivered.get(dedup_key)
+
+    async def failed(self, entry: OutboxEntry):
+        if entry.entry_id in self._entries:
+            self._entries[entry.entry_id].attempts = entry.attempts
+
+    async def dead(self, entry: OutboxEntry, error: str):
+        """Move an entry that ran out of attempts to the dead letters"""
+        if self._entries.pop(entry.entry_id, None) is not None:
+            self._dead.append(entry)
+
+    async def dead_letters(self) -> List[OutboxEntry]:
+        return list(self._dead)
+
+
+class SQLiteOutboxStore:
+    """Outbox table in SQLite: sends not delivered before a restart are replayed.
+
+    Entries that ran out of attempts are moved to ``outbox_dead`` with the last error.
+    Dedup keys of delivered calls (the last ``delivered_keys``) are kept in
+    ``outbox_delivered``, written in the transaction that removes the entry.
+    """
+
+    def __init__(self, path: str = "outbox.db", delivered_keys: int = 10000):
+        self.path = path
+        self.delivered_keys = delivered_keys
+        self._db: Optional[aiosqlite.Connection] = None
+
+    async def open(self):
+        self._db = await aiosqlite.connect(self.path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, method TEXT NOT NULL, kwargs TEXT NOT NULL, "
+            "key TEXT, created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        async with self._db.execute("PRAGMA table_info(outbox)") as cursor:
+            columns = {row[1] async for row in cursor}
+        if "attempts" not in columns:
+            await self._db.execute("ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_dead ("
+            "id INTEGER PRIMARY KEY, method TEXT NOT NULL, kwargs TEXT NOT NULL, key TEXT, created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL, error TEXT, failed REAL NOT NULL)"
+        )
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_delivered ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, dedup_key TEXT NOT NULL UNIQUE, response TEXT)"
+        )
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def add(self, method: str, kwargs: Dict[str, Any], key: Optional[str]) -> OutboxEntry:
+        created = time.time()
+        cursor = await self._db.execute(
+            "INSERT INTO outbox (method, kwargs, key, created) VALUES (?, ?, ?, ?)",
+            (method, json.dumps(kwargs, ensure_ascii=False), key, created)
+        )
+        await self._db.commit()
+        return OutboxEntry(cursor.lastrowid, method, kwargs, key, created)
+
+    async def pending(self) -> List[OutboxEntry]:
+        async with self._db.execute(
+                "SELECT id, method, kwargs, key, created, attempts FROM outbox ORDER BY id") as cursor:
+            return [OutboxEntry(row[0], row[1], json.loads(row[2]), row[3], row[4], row[5]) async for row in cursor]
+
+    async def done(self, entry_id: int, dedup_key: Optional[str] = None, response: Any = None):
+        await self._db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+        if dedup_key is not None:
+            cursor = await self._db.execute(
+                "INSERT OR REPLACE INTO outbox_delivered (dedup_key, response) VALUES (?, ?)",
+                (dedup_key, json.dumps(response, ensure_ascii=False, default=str))
+            )
+            await self._db.execute("DELETE FROM outbox_delivered WHERE seq <= ?",
+                                   (cursor.lastrowid - self.delivered_keys,))
+        await self._db.commit()
+
+    async def delivered(self, dedup_key: str) -> Optional[Any]:
+        """Response of an already delivered call with this dedup key, or None"""
+        async with self._db.execute("SELECT response FROM outbox_delivered WHERE dedup_key = ?",
+                                    (dedup_key,)) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    async def failed(self, entry: OutboxEntry):
+        await self._db.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (entry.attempts, entry.entry_id))
+        await self._db.commit()
+
+    async def dead(self, entry: OutboxEntry, error: str):
+        """Move an entry that ran out of attempts to outbox_dead"""
+        await self._db.execute(
+            "INSERT OR REPLACE INTO outbox_dead (id, method, kwargs, key, created, attempts, error, failed) "
+            "SELECT id, method, kwargs, key, created, ?, ?, ? FROM outbox WHERE id = ?",
+            (entry.attempts, error, time.time(), entry.entry_id)
+        )
+        await self._db.execute("DELETE FROM outbox WHERE id = ?", (entry.entry_id,))
+        await self._db.commit()
+
+    async def dead_letters(self) -> List[OutboxEntry]:
+        async with self._db.execute(
+                "SELECT id, method, kwargs, key, created, attempts FROM outbox_dead ORDER BY id") as cursor:
+            return [OutboxEntry(row[0], row[1], json.loads(row[2]), row[3], row[4], row[5]) async for row in cursor]
+
+
+class Outbox:
+    """Background delivery of Bot calls.
+
+    ``put`` stores the call and returns a future right away; a pool of
+    senders drains the store, one sender per ordering key, so calls for
+    the same chat are delivered in order. Entries are removed from the
+    store only after delivery, and whatever is left is replayed on start.
+
+    A call with a ``dedup_key`` that the store has already delivered (e.g.
+    replayed after a restart, or sent again by a re-processed update) is
+    not sent again and resolves to the stored response. A crash between
+    the API's response and the store's commit can still resend it.
+
+    A failed delivery stays in the store and is retried by the same sender
+    (so later calls for the chat wait) after an exponential backoff from
+    ``retry_delay`` up to ``max_retry_delay``; after ``max_attempts`` the
+    entry is moved to the store's dead letters and its future fails.
+    """
+
+    def __init__(self, bot, store=None, senders: int = 4, max_attempts: int = 5,
+                 retry_delay: float = 1.0, max_retry_delay: float = 60.0):
+        self.bot = bot
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.store = store if store is not None else MemoryOutboxStore()
+        self.pool = WorkerPool(self._deliver, workers=senders, queue_size=0,
+                               key=lambda entry: hash(entry.key), name="outbox")
+        self._futures: Dict[int, asyncio.Future] = {}
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self._logger = get_logger("outbox")
+
+    @property
+    def running(self) -> bool:
+        return self.pool.running
+
+    async def start(self):
+        """Open the store, start senders and replay undelivered entries"""
+        if self.running:
+            return
+        await self.store.open()
+        self.pool.start()
+        pending = await self.store.pending()
+        for entry in pending:
+            await self.pool.submit(entry)
+        if pending:
+            self._logger.info(f"Replaying {len(pending)} undelivered outbox entries")
+
+    async def stop(self, drain: bool = True):
+        """Stop senders, by default after delivering everything queued"""
+        await self.pool.stop(drain=drain)
+        await self.store.close()
+
+    async def put(self, method: str, kwargs: Dict[str, Any], key: Optional[str] = None) -> asyncio.Future:
+        """Store a Bot call; the returned future resolves to the API response"""
+        entry = await self.store.add(method, kwargs, key)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[entry.entry_id] = future
+        await self.pool.submit(entry)
+        return future
+
+    @property
+    def pending(self) -> int:
+        return self.pool.queue_depth
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": self.pending, "delivered": self.delivered, "failed": self.failed, "retried": self.retried}
+
+    def _backoff(self, attempts: int) -> float:
+        return random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1)))
+
+    async def _deliver(self, entry: OutboxEntry):
+        dedup_key = entry.kwargs.get("dedup_key")
+        while True:
+            try:
+                response = await self.store.delivered(dedup_key) if dedup_key else None
+                if response is not None:
+                    self._logger.debug(f"Outbox entry {entry.entry_id} ({entry.method}) already delivered")
+                else:
+                    response = await self.bot.deliver(entry.method, entry.kwargs)
+            except Exception as e:
+                entry.attempts += 1
+                if entry.attempts < self.max_attempts:
+                    delay = self._backoff(entry.attempts)
+                    self.retried += 1
+                    self._logger.warning(f"Outbox entry {entry.entry_id} ({entry.method}) failed: {e}, "
+                                         f"attempt {entry.attempts} of {self.max_attempts}, retry in {delay:.2f}s")
+                    await self.store.failed(entry)
+                    await asyncio.sleep(delay)
+                    continue
+                self.failed += 1
+                self._logger.error(f"Outbox entry {entry.entry_id} ({entry.method}) failed "
+                                   f"{entry.attempts} times, moved to dead letters: {e}")
+                await self.store.dead(entry, f"{type(e).__name__}: {e}")
+                future = self._futures.pop(entry.entry_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                    # Nobody may be awaiting it: don't warn about unretrieved exceptions
+                    future.exception()
+                return
+            self.delivered += 1
+            await self.store.done(entry.entry_id, dedup_key, response)
+            future = self._futures.pop(entry.entry_id, None)
+            if future is not None and not future.done():
+                future.set_result(response)
+            return
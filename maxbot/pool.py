@@ -0,0 +1,119 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Any, Optional
+
+from ._types import Update
+from .log import get_logger
+
+logger = get_logger("pool")
+
+
+def chat_key(update: Update) -> int:
+    """Key used to shard updates: chat id, falling back to user id"""
+    chat = update.effective_chat
+    if chat:
+        return chat.chat_id
+    if update.chat_id:
+        return update.chat_id
+    user = update.effective_user
+    return user.user_id if user else 0
+
+
+class WorkerPool:
+    """Fixed number of workers, each draining its own ordered queue.
+
+    Updates are hashed by chat into a queue, so one chat is always handled
+    by the same worker in FIFO order while different chats run in parallel.
+    Queues are bounded (``queue_size=0`` means unbounded): ``submit`` waits
+    when a queue is full. ``key`` shards items other than updates.
+    """
+
+    def __init__(self, process: Callable[[Any], Awaitable[Any]],
+                 workers: int = 8, queue_size: int = 100, key: Callable[[Any], int] = chat_key,
+                 name: str = "pool"):
+        if workers < 1:
+            raise ValueError("Worker pool needs at least one worker.")
+        self.process = process
+        self.workers = workers
+        self.queue_size = queue_size
+        self.key = key
+        self.queues: List[asyncio.Queue] = []
+        self.busy_time: List[float] = [0.0] * workers
+        self.processed: List[int] = [0] * workers
+        self.submitted: List[int] = [0] * workers
+        self._tasks: List[asyncio.Task] = []
+        self._dequeued = asyncio.Event()
+        self._logger = get_logger(name)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        """Start worker tasks"""
+        if self._tasks:
+            return
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers)]
+        self._logger.info(f"Started {self.workers} workers (queue size {self.queue_size})")
+
+    async def submit(self, update: Any):
+        """Put update into its chat's queue, waiting if the queue is full"""
+        index = self.key(update) % self.workers
+        await self.queues[index].put(update)
+        self.submitted[index] += 1
+
+    async def stop(self, drain: bool = True):
+        """Stop workers, optionally processing everything already queued"""
+        if not self._tasks:
+            return
+        if drain:
+            await asyncio.gather(*(queue.join() for queue in self.queues))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._logger.info("Workers stopped")
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def checkpoint(self) -> List[int]:
+        """Items submitted so far to each worker"""
+        return list(self.submitted)
+
+    def reached(self, checkpoint: List[int]) -> bool:
+        """Whether everything submitted before checkpoint was processed (queues are FIFO)"""
+        return all(done >= target for done, target in zip(self.processed, checkpoint))
+
+    async def wait_for_depth(self, level: int):
+        """Wait until no more than level items are queued"""
+        while self.queue_depth > level:
+            self._dequeued.clear()
+            await self._dequeued.wait()
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and busy time (seconds) per worker"""
+        return {
+            "workers": self.workers,
+            "queue_depth": [queue.qsize() for queue in self.queues],
+            "busy_time": list(self.busy_time),
+            "processed": list(self.processed),
+        }
+
+    async def _worker(self, index: int):
+        queue = self.queues[index]
+        while True:
+            update: Optional[Any] = await queue.get()
+            self._dequeued.set()
+            start_time = time.monotonic()
+            try:
+                await self.process(update)
+            except Exception as e:
+                self._logger.error(f"Worker {index} failed on {type(update).__name__} "
+                                   f"{getattr(update, 'update_id', '')}: {e}", exc_info=True)
+            finally:
+                self.busy_time[index] += time.monotonic() - start_time
+                self.processed[index] += 1
+                queue.task_done()
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+from .log import get_logger
+
+
+class TokenBucket:
+    """Token bucket handing out reservations.
+
+    ``reserve`` always takes a token and returns how long the caller has to
+    wait for it, letting the balance go negative, so concurrent callers are
+    served in the order they reserved.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        if rate <= 0 or capacity < 1:
+            raise ValueError("Token bucket needs a positive rate and a capacity of at least one token.")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token, returning the delay (seconds) before it may be used"""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        """Give back a reserved token that won't be used"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    @property
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Retry-After header (seconds or HTTP date) -> seconds to wait"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    """Global token bucket plus one bucket per recipient.
+
+    Sends to the same recipient hold its lock for the whole request, so they
+    go out in call order; different recipients only share the global bucket.
+    A 429 pauses everyone until ``Retry-After`` has passed.
+    """
+
+    def __init__(self, rate: float = 30, burst: float = 30, chat_rate: float = 1, chat_burst: float = 5,
+                 max_retries: int = 5, max_buckets: int = 10000):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._buckets: Dict[Any, TokenBucket] = {}
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        self._users: Dict[Any, int] = {}
+        self._paused_until = 0.0
+        self.waiting = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._logger = get_logger("ratelimit")
+
+    def _chat_bucket(self, key: Any) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets = {k: b for k, b in self._buckets.items() if k in self._users or not b.idle}
+            bucket = self._buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def wait(self, key: Any = None):
+        """Wait for a recipient token (if key is given), then for a global one.
+
+        A global token reserved before a pause (or a cancellation) is given
+        back, and a new one is reserved once the pause is over.
+        """
+        if key is not None:
+            delay = self._chat_bucket(key).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self.bucket.reserve()
+            if delay:
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    self.bucket.refund()
+                    raise
+            if self._paused_until <= time.monotonic():
+                return
+            self.bucket.refund()
+
+    @asynccontextmanager
+    async def slot(self, key: Any = None) -> AsyncIterator[float]:
+        """Wait for the recipient's turn and a token; yields the queue time in seconds"""
+        start = time.monotonic()
+        lock = None
+        if key is not None:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = asyncio.Lock()
+            self._users[key] = self._users.get(key, 0) + 1
+        self.waiting += 1
+        locked = False
+        try:
+            if lock is not None:
+                await lock.acquire()
+                locked = True
+            await self.wait(key)
+            waited = time.monotonic() - start
+            self.waiting -= 1
+            start = None
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            yield waited
+        finally:
+            if locked:
+                lock.release()
+            if start is not None:
+                self.waiting -= 1
+            if key is not None:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+                    del self._locks[key]
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for given number of seconds (after a 429)"""
+        self.throttled += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._logger.warning(f"Rate limited by API, pausing sends for {seconds:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue time and throttling counters"""
+        return {
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "total_wait": self.total_wait,
+            "max_wait": self.max_wait,
+            "avg_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+        }
@@ -0,0 +1,44 @@
+import asyncio
+import random
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet
+
+import aiohttp
+
+
+@dataclass
+class RetryPolicy:
+    """How a Bot method is retried.
+
+    Delays grow exponentially from ``base_delay`` up to ``max_delay`` with
+    full jitter. Failed connects and ``retry_statuses`` are retryable;
+    timeouts and dropped connections only when ``retry_ambiguous`` is set,
+    because the request may already have been processed. Everything else
+    is fatal.
+    """
+
+    attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 10
+    retry_statuses: FrozenSet[int] = field(default_factory=lambda: frozenset({500, 502, 503, 504}))
+    retry_ambiguous: bool = True
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before the retry following given (zero-based) attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def retryable_error(self, error: BaseException) -> bool:
+        if isinstance(error, aiohttp.ClientConnectorError):
+            return True
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+            return self.retry_ambiguous
+        return False
+
+
+# send_message is not idempotent and the API isn't known to de-duplicate
+# it: only retry failed connects, where the message can't have been
+# accepted (a 502/503 may come after it was)
+DEFAULT_RETRY_POLICIES: Dict[str, RetryPolicy] = {
+    "get_updates": RetryPolicy(attempts=1),
+    "send_message": RetryPolicy(retry_statuses=frozenset(), retry_ambiguous=False),
+}
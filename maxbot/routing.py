@@ -0,0 +1,91 @@
+from typing import Any, Dict, List, Optional
+
+from .filters import Command, parse_command
+from .state import State
+
+
+def _merge(matched: List[Any], fallback: List[Any]) -> List[Any]:
+    """Indexed candidates plus fallback handlers, in registration order"""
+    if not matched:
+        return fallback
+    if fallback or len(matched) > 1:
+        matched.extend(fallback)
+        matched.sort(key=lambda handler: handler.order)
+    return matched
+
+
+class PayloadIndex:
+    """Callback handlers compiled into dicts keyed by payload.
+
+    Exact payloads live in one dict, prefixes in one dict per prefix length,
+    so resolving a payload costs a handful of dict lookups. Handlers without
+    a payload pattern are kept as fallback and merged back in registration
+    order, so the first-match semantics of the plain scan are preserved.
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, List[Any]] = {}
+        self._prefixes: Dict[int, Dict[str, List[Any]]] = {}
+        self._lengths: List[int] = []
+        self._fallback: List[Any] = []
+
+    def add(self, handler: Any):
+        payload = handler.route
+        if payload is None:
+            self._fallback.append(handler)
+        elif payload.prefix is None:
+            self._exact.setdefault(payload.pattern, []).append(handler)
+        else:
+            length = len(payload.prefix)
+            self._prefixes.setdefault(length, {}).setdefault(payload.prefix, []).append(handler)
+            self._lengths = sorted(self._prefixes)
+
+    def resolve(self, payload: Optional[str]) -> List[Any]:
+        """Handlers that may match payload, in registration order"""
+        if payload is None:
+            return self._fallback
+
+        matched = list(self._exact.get(payload, ()))
+        for length in self._lengths:
+            if length > len(payload):
+                break
+            group = self._prefixes[length].get(payload[:length])
+            if group:
+                matched.extend(group)
+        return _merge(matched, self._fallback)
+
+
+class MessageIndex:
+    """Message handlers keyed by FSM state uuid and by command name.
+
+    Handlers whose only filter is a StateFilter or a Command are indexed;
+    everything else is fallback, merged back in registration order.
+    """
+
+    def __init__(self):
+        self._states: Dict[Any, List[Any]] = {}
+        self._commands: Dict[str, List[Any]] = {}
+        self._fallback: List[Any] = []
+
+    @property
+    def uses_state(self) -> bool:
+        return bool(self._states)
+
+    def add(self, handler: Any):
+        route = handler.route
+        if route is None:
+            self._fallback.append(handler)
+        elif isinstance(route, Command):
+            self._commands.setdefault(route.command, []).append(handler)
+        else:
+            self._states.setdefault(route.state.uuid, []).append(handler)
+
+    def resolve(self, state: Any, text: Optional[str]) -> List[Any]:
+        """Handlers that may match a message in given state, in registration order"""
+        matched = []
+        if type(state) is State:
+            matched.extend(self._states.get(state.uuid, ()))
+        command = parse_command(text)
+        if command is not None:
+            matched.extend(self._commands.get(command, ()))
+        return _merge(matched, self._fallback)
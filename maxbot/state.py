@@ -1,44 +1,334 @@
-from typing import Any
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
 from uuid import uuid8
 
+from .eviction import EvictionPolicy, approx_size
+from .log import get_logger
+from .storage import MemoryStorage, StateStorage
+
+
+def _state_by_id(uuid: str) -> "State":
+    """Unpickle a named State as the instance registered under its id"""
+    state = State._registry.get(uuid)
+    if state is None:
+        state = State.__new__(State)
+        state.uuid = uuid
+        state.named = True
+    return state
+
+
 class State:
-    def __init__(self):
-        self.uuid = uuid8()
+    """FSM state.
+
+    A named state (``State("city")``, or a class attribute such as
+    ``ShelterRegistration.name`` of a module-level class, named after its
+    owner) has a stable id, so it survives restarts and is shared between
+    processes. An unnamed state gets a random id valid only in this process.
+    """
+
+    _registry: Dict[str, "State"] = {}
+
+    def __init__(self, name: Optional[str] = None):
+        self.named = name is not None
+        self.uuid = name if self.named else uuid8()
+        if self.named:
+            self._register()
+
+    def __set_name__(self, owner, name: str):
+        # Classes defined inside functions may be created many times: keep those unnamed
+        if not self.named and "<locals>" not in owner.__qualname__:
+            self.named = True
+            self.uuid = f"{owner.__qualname__}.{name}"
+            self._register()
+
+    def _register(self):
+        if State._registry.get(self.uuid, self) is not self:
+            raise ValueError(f"State '{self.uuid}' is already defined.")
+        State._registry[self.uuid] = self
+
+    def __reduce_ex__(self, protocol):
+        if self.named:
+            return _state_by_id, (self.uuid,)
+        return super().__reduce_ex__(protocol)
+
+    def __repr__(self) -> str:
+        return f"State({self.uuid!r})" if self.named else f"State(<{self.uuid}>)"
+
+
+class StateTransaction:
+    """A chat's state and data inside ``StateManager.transaction``.
+
+    Reads and writes go to a private copy; the record is stored once when
+    the transaction exits without an exception.
+    """
+
+    def __init__(self, chat_id: int, record: Optional[list[Any]]):
+        self.chat_id = chat_id
+        self.exists = record is not None
+        self.state: State | Any = record[0] if record is not None else None
+        self.data: Dict[str, Any] = dict(record[1]) if record is not None else {}
+        self.changed = False
+        self.erased = False
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self.data.get(name, default)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.data[name]
+
+    def set(self, name: str, value: Any):
+        self.data[name] = value
+        self.changed = True
+        self.erased = False
+
+    __setitem__ = set
+
+    def update(self, **values: Any):
+        self.data.update(values)
+        self.changed = True
+        self.erased = False
+
+    def set_state(self, state: State | Any):
+        self.state = state
+        self.changed = True
+        self.erased = False
+
+    def erase(self):
+        """Drop the chat's state and data on commit"""
+        self.state = None
+        self.data = {}
+        self.changed = False
+        self.erased = True
+
 
 class StateManager:
-    states: dict[int, list[Any]] = {}
-    _instance = None
+    """Per-chat FSM state and data, kept in a pluggable StateStorage.
 
-    async def set_data(self, chat_id: int, name: str, value: Any):
-        self.states[chat_id][1][name] = value
+    The manager is a process-wide singleton; ``use_storage`` switches
+    the backend (MemoryStorage by default) and ``use_eviction`` limits
+    how many idle sessions are kept.
 
-    async def get_data(self, chat_id: int, name: str):
-        return self.states[chat_id][1][name]
+    ``transaction`` gives a handler exclusive access to one chat's record;
+    the single-call methods below are not serialised with it.
+    """
+    storage: StateStorage = MemoryStorage()
+    eviction: EvictionPolicy = EvictionPolicy()
+    _instance = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
+            cls._instance._reset_tracking()
         return cls._instance
-    
+
+    def _reset_tracking(self):
+        # chat_id -> last touch (monotonic), least recently used first
+        self._touched: OrderedDict[int, float] = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self.memory_used = 0
+        self.evicted: Dict[str, int] = {"ttl": 0, "entries": 0, "memory": 0}
+        self._sweeper: Optional[asyncio.Task] = None
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}  # holder and waiters per lock
+        self.transactions = 0
+        self.lock_waits = 0
+        self.lock_wait_time = 0.0
+        self.max_lock_wait = 0.0
+        self._logger = get_logger("state")
+
+    def use_storage(self, storage: StateStorage):
+        StateManager.storage = storage
+        self._touched.clear()
+        self._sizes.clear()
+        self.memory_used = 0
+
+    def use_eviction(self, policy: EvictionPolicy):
+        StateManager.eviction = policy
+
+    async def open(self):
+        await self.storage.open()
+        now = time.monotonic()
+        for chat_id in self.storage.chat_ids():
+            self._touched.setdefault(chat_id, now)
+        if self.eviction.ttl is not None and self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        await self.storage.close()
+
+    def _touch(self, chat_id: int):
+        self._touched[chat_id] = time.monotonic()
+        self._touched.move_to_end(chat_id)
+
+    def _forget(self, chat_id: int):
+        self._touched.pop(chat_id, None)
+        self.memory_used -= self._sizes.pop(chat_id, 0)
+
+    def locked(self, chat_id: int) -> bool:
+        """Whether a transaction on the chat is running"""
+        lock = self._locks.get(chat_id)
+        return lock is not None and lock.locked()
+
+    @asynccontextmanager
+    async def transaction(self, chat_id: int) -> AsyncIterator[StateTransaction]:
+        """Exclusive read-modify-write of a chat's record.
+
+        Other transactions on the chat wait until this one exits; changes
+        are committed in one storage write, or dropped on an exception.
+        The chat is not evicted while the transaction runs.
+        """
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+        try:
+            if lock.locked():
+                started = time.monotonic()
+                await lock.acquire()
+                waited = time.monotonic() - started
+                self.lock_waits += 1
+                self.lock_wait_time += waited
+                self.max_lock_wait = max(self.max_lock_wait, waited)
+            else:
+                await lock.acquire()
+        except BaseException:
+            self._release(chat_id, None)
+            raise
+        try:
+            self.transactions += 1
+            transaction = StateTransaction(chat_id, await self.storage.get(chat_id))
+            if transaction.exists:
+                self._touch(chat_id)
+            yield transaction
+            if transaction.erased:
+                await self.erase_state(chat_id)
+            elif transaction.changed:
+                record = [transaction.state, transaction.data]
+                await self.storage.set(chat_id, record)
+                await self._written(chat_id, record)
+        finally:
+            self._release(chat_id, lock)
+
+    def _release(self, chat_id: int, lock: Optional[asyncio.Lock]):
+        if lock is not None:
+            lock.release()
+        self._waiters[chat_id] -= 1
+        # The lock is dropped once nobody holds or waits for it
+        if not self._waiters[chat_id]:
+            del self._waiters[chat_id]
+            del self._locks[chat_id]
+
+    def _lru_unlocked(self) -> Optional[int]:
+        """Least recently used chat that is not inside a transaction"""
+        for chat_id in self._touched:
+            if not self.locked(chat_id):
+                return chat_id
+        return None
+
+    async def _written(self, chat_id: int, record: list[Any]):
+        """Track a stored record and enforce entry and memory budgets"""
+        self._touch(chat_id)
+        if self.eviction.max_bytes is not None:
+            size = approx_size(record)
+            self.memory_used += size - self._sizes.get(chat_id, 0)
+            self._sizes[chat_id] = size
+        while self.eviction.max_entries is not None and len(self._touched) > self.eviction.max_entries:
+            victim = self._lru_unlocked()
+            if victim is None or victim == chat_id:
+                break
+            await self._evict(victim, "entries")
+        while (self.eviction.max_bytes is not None and self.memory_used > self.eviction.max_bytes
+               and len(self._touched) > 1):
+            victim = self._lru_unlocked()
+            if victim is None or victim == chat_id:
+                break
+            await self._evict(victim, "memory")
+
+    async def _evict(self, chat_id: int, reason: str):
+        record = await self.storage.get(chat_id)
+        await self.storage.delete(chat_id)
+        self._forget(chat_id)
+        self.evicted[reason] += 1
+        self._logger.debug(f"Evicted FSM session of chat {chat_id} ({reason})")
+        if record is not None and self.eviction.on_evict is not None:
+            try:
+                await self.eviction.on_evict(chat_id, record, reason)
+            except Exception as e:
+                self._logger.error(f"Eviction hook failed for chat {chat_id}: {e}", exc_info=True)
+
+    async def sweep(self) -> int:
+        """Evict chats idle longer than the TTL; returns how many were evicted"""
+        if self.eviction.ttl is None:
+            return 0
+        deadline = time.monotonic() - self.eviction.ttl
+        expired = []
+        for chat_id, touched in self._touched.items():
+            if touched > deadline:
+                break
+            if not self.locked(chat_id):
+                expired.append(chat_id)
+        for chat_id in expired:
+            await self._evict(chat_id, "ttl")
+        return len(expired)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.eviction.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                self._logger.error(f"FSM sweep failed: {e}", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sessions": len(self._touched), "memory_used": self.memory_used, "evicted": dict(self.evicted),
+                "transactions": self.transactions, "locked_chats": len(self._locks),
+                "lock_waits": self.lock_waits, "lock_wait_time": self.lock_wait_time,
+                "max_lock_wait": self.max_lock_wait}
+
+    async def _record(self, chat_id: int) -> list[Any]:
+        record = await self.storage.get(chat_id)
+        if record is None:
+            raise KeyError(chat_id)
+        self._touch(chat_id)
+        return record
+
+    async def set_data(self, chat_id: int, name: str, value: Any):
+        record = await self._record(chat_id)
+        record[1][name] = value
+        await self.storage.set(chat_id, record)
+        await self._written(chat_id, record)
+
+    async def get_data(self, chat_id: int, name: str):
+        return (await self._record(chat_id))[1][name]
+
     async def set_state(self, chat_id: int, state: State | Any):
-        if chat_id in self.states.keys() and self.states[chat_id][1]:
-            self.states[chat_id] = [state, self.states[chat_id][1]]
+        record = await self.storage.get(chat_id)
+        if record is not None and record[1]:
+            record = [state, record[1]]
         else:
-            self.states[chat_id] = [state, dict()]
-    
+            record = [state, dict()]
+        await self.storage.set(chat_id, record)
+        await self._written(chat_id, record)
+
     async def get_state(self, chat_id: int) -> State | Any:
-        if chat_id in self.states.keys():
-            return self.states[chat_id][0]
+        record = await self.storage.get(chat_id)
+        if record is not None:
+            self._touch(chat_id)
+            return record[0]
         else:
             return None
-    
+
     async def erase_state(self, chat_id: int):
-        if chat_id in self.states.keys():
-            del self.states[chat_id]
-    
+        await self.storage.delete(chat_id)
+        self._forget(chat_id)
+
     async def update(self, chat_id: int, name: str, data: Any):
-        self.states[chat_id][1][name] = data
-    
+        await self.set_data(chat_id, name, data)
+
     async def get_all_data(self, chat_id: int) -> dict[str, Any]:
-        return self.states[chat_id][1]
-        
\ No newline at end of file
+        return (await self._record(chat_id))[1]
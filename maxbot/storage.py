@@ -0,0 +1,237 @@
+import asyncio
+import pickle
+from abc import ABC, abstractmethod
+import time
+from typing import Any, Dict, List, Optional, Protocol, Set
+
+import aiosqlite
+
+from .log import get_logger
+
+# A chat's FSM record: [state, data dict]
+Record = List[Any]
+
+
+def dump_record(record: Record) -> bytes:
+    """Serialise a record; named States are stored by id (see State.__reduce_ex__)"""
+    return pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_record(raw: bytes) -> Record:
+    return pickle.loads(raw)
+
+
+class StateStorage(ABC):
+    """Where StateManager keeps per-chat records.
+
+    ``get`` returns the record or None, ``set`` stores it, ``delete`` drops it.
+    ``open``/``close`` are called when the dispatcher starts and stops.
+    ``shared`` tells whether other processes see the same records.
+    """
+
+    shared = False
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def get(self, chat_id: int) -> Optional[Record]:
+        ...
+
+    @abstractmethod
+    async def set(self, chat_id: int, record: Record):
+        ...
+
+    @abstractmethod
+    async def delete(self, chat_id: int):
+        ...
+
+    @abstractmethod
+    def chat_ids(self) -> List[int]:
+        """Chats with a record known to this process"""
+
+    def __len__(self) -> int:
+        return len(self.chat_ids())
+
+
+class MemoryStorage(StateStorage):
+    """Records in a dict of this process; lost on restart"""
+
+    def __init__(self):
+        self.records: Dict[int, Record] = {}
+
+    async def get(self, chat_id: int) -> Optional[Record]:
+        return self.records.get(chat_id)
+
+    async def set(self, chat_id: int, record: Record):
+        self.records[chat_id] = record
+
+    async def delete(self, chat_id: int):
+        self.records.pop(chat_id, None)
+
+    def chat_ids(self) -> List[int]:
+        return list(self.records)
+
+
+class SQLiteStorage(MemoryStorage):
+    """Records served from memory and persisted to SQLite.
+
+    Write-behind: changed chats are collected and written in one
+    transaction every ``flush_interval`` seconds. With ``snapshot=True``
+    nothing is written while running; all records are saved on close.
+    Either way records are restored on open.
+    """
+
+    def __init__(self, path: str = "states.db", flush_interval: float = 1.0, snapshot: bool = False):
+        super().__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+        self.snapshot = snapshot
+        self._dirty: Set[int] = set()
+        self._db: Optional[aiosqlite.Connection] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self._logger = get_logger("storage")
+
+    async def open(self):
+        if self._db is not None:
+            return
+        self._db = await aiosqlite.connect(self.path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm_states (chat_id INTEGER PRIMARY KEY, record BLOB NOT NULL, updated REAL)"
+        )
+        await self._db.commit()
+        async with self._db.execute("SELECT chat_id, record FROM fsm_states") as cursor:
+            async for chat_id, raw in cursor:
+                self.records[chat_id] = load_record(raw)
+        self._logger.info(f"Restored {len(self.records)} FSM states from {self.path}")
+        if not self.snapshot:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._db is None:
+            return
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self.snapshot:
+            # Replace the whole table in one transaction (committed even when no records are left)
+            await self._db.execute("DELETE FROM fsm_states")
+            self._dirty = set(self.records)
+            await self.flush(force=True)
+        else:
+            await self.flush()
+        await self._db.close()
+        self._db = None
+
+    async def set(self, chat_id: int, record: Record):
+        self.records[chat_id] = record
+        self._dirty.add(chat_id)
+
+    async def delete(self, chat_id: int):
+        self.records.pop(chat_id, None)
+        self._dirty.add(chat_id)
+
+    async def flush(self, force: bool = False):
+        """Write changed records in one transaction; ``force`` commits even with nothing changed.
+
+        A record that can't be pickled is logged and skipped, so it doesn't block other chats.
+        """
+        if self._db is None or (not self._dirty and not force):
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            now = time.time()
+            changed, deleted = [], []
+            for chat_id in dirty:
+                if chat_id not in self.records:
+                    deleted.append((chat_id,))
+                    continue
+                try:
+                    changed.append((chat_id, dump_record(self.records[chat_id]), now))
+                except Exception as e:
+                    self._logger.error(f"Skipping FSM state of chat {chat_id}: can't serialise it: {e}")
+            if changed:
+                await self._db.executemany(
+                    "INSERT OR REPLACE INTO fsm_states (chat_id, record, updated) VALUES (?, ?, ?)", changed)
+            if deleted:
+                await self._db.executemany("DELETE FROM fsm_states WHERE chat_id = ?", deleted)
+            await self._db.commit()
+        except Exception:
+            self._dirty |= dirty
+            raise
+        self.flushes += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self._logger.error(f"Failed to flush FSM states: {e}", exc_info=True)
+
+
+class KVClient(Protocol):
+    """Async key-value client (e.g. a Redis wrapper) usable by KVStorage.
+
+    A client that keeps its data in this process sets ``shared = False``.
+    """
+
+    async def get(self, key: str) -> Optional[bytes]: ...
+
+    async def set(self, key: str, value: bytes): ...
+
+    async def delete(self, key: str): ...
+
+
+class LocalKV:
+    """In-process KVClient stand-in for tests and single-process runs"""
+
+    shared = False
+
+    def __init__(self):
+        self.data: Dict[str, bytes] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.data.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self.data[key] = value
+
+    async def delete(self, key: str):
+        self.data.pop(key, None)
+
+
+class KVStorage(StateStorage):
+    """Records in a shared key-value store, read and written through on every
+    call, so several bot processes see the same FSM state"""
+
+    def __init__(self, client: KVClient, prefix: str = "maxbot:fsm:"):
+        self.client = client
+        self.prefix = prefix
+        self._known: Set[int] = set()
+
+    @property
+    def shared(self) -> bool:
+        return getattr(self.client, "shared", True)
+
+    async def get(self, chat_id: int) -> Optional[Record]:
+        raw = await self.client.get(f"{self.prefix}{chat_id}")
+        return load_record(raw) if raw is not None else None
+
+    async def set(self, chat_id: int, record: Record):
+        await self.client.set(f"{self.prefix}{chat_id}", dump_record(record))
+        self._known.add(chat_id)
+
+    async def delete(self, chat_id: int):
+        await self.client.delete(f"{self.prefix}{chat_id}")
+        self._known.discard(chat_id)
+
+    def chat_ids(self) -> List[int]:
+        """Chats written by this process (the store may hold more)"""
+        return list(self._known)
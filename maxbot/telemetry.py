@@ -0,0 +1,132 @@
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from .metrics import Counter, Gauge, Histogram, Metric
+
+# Seconds; long polls take up to their timeout, so total latency goes higher
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288)
+
+
+class RequestTiming:
+    """Timings of one HTTP attempt, filled in by the session's trace callbacks"""
+
+    __slots__ = ("start", "connect", "ttfb", "sent", "received")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.connect: Optional[float] = None
+        self.ttfb: Optional[float] = None
+        self.sent = 0
+        self.received = 0
+
+
+class ApiTelemetry:
+    """Per-method statistics of the Bot's calls to the MAX API.
+
+    Every HTTP attempt records connect time (new connections only), time to
+    the response headers, total time including the body, status (or the
+    exception type), request and response body sizes. ``retries`` counts
+    repeated attempts, ``in_flight`` attempts currently running.
+    """
+
+    def __init__(self):
+        self.connect_seconds = Histogram("maxbot_api_connect_seconds", "Time to open a new connection to the API",
+                                         ("method",), LATENCY_BUCKETS)
+        self.ttfb_seconds = Histogram("maxbot_api_ttfb_seconds", "Time from sending a request to its response headers",
+                                      ("method",), LATENCY_BUCKETS)
+        self.total_seconds = Histogram("maxbot_api_request_seconds", "Total time of an API request attempt",
+                                       ("method",), LATENCY_BUCKETS)
+        self.responses = Counter("maxbot_api_responses_total", "API responses by status, or exception type",
+                                 ("method", "status"))
+        self.request_bytes = Histogram("maxbot_api_request_bytes", "Request body size", ("method",), SIZE_BUCKETS)
+        self.response_bytes = Histogram("maxbot_api_response_bytes", "Response body size", ("method",), SIZE_BUCKETS)
+        self.in_flight = Gauge("maxbot_api_in_flight", "API requests in progress", ("method",))
+        self.retries = Counter("maxbot_api_retries_total", "Repeated attempts (errors and 429)", ("method",))
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Trace callbacks for a ClientSession; requests pass a RequestTiming as trace_request_ctx"""
+        trace = aiohttp.TraceConfig(trace_config_ctx_factory=SimpleNamespace)
+
+        async def connection_create_start(session, context, params):
+            context.connect_start = time.perf_counter()
+
+        async def connection_create_end(session, context, params):
+            timing = context.trace_request_ctx
+            if isinstance(timing, RequestTiming):
+                timing.connect = time.perf_counter() - context.connect_start
+
+        async def request_end(session, context, params):
+            timing = context.trace_request_ctx
+            if isinstance(timing, RequestTiming):
+                timing.ttfb = time.perf_counter() - timing.start
+
+        async def chunk_sent(session, context, params):
+            timing = context.trace_request_ctx
+            if isinstance(timing, RequestTiming):
+                timing.sent += len(params.chunk)
+
+        async def chunk_received(session, context, params):
+            timing = context.trace_request_ctx
+            if isinstance(timing, RequestTiming):
+                timing.received += len(params.chunk)
+
+        trace.on_connection_create_start.append(connection_create_start)
+        trace.on_connection_create_end.append(connection_create_end)
+        trace.on_request_end.append(request_end)
+        trace.on_request_chunk_sent.append(chunk_sent)
+        trace.on_response_chunk_received.append(chunk_received)
+        return trace
+
+    def started(self, method: str) -> RequestTiming:
+        self.in_flight.inc(method)
+        return RequestTiming()
+
+    def finished(self, method: str, timing: RequestTiming, status: Any):
+        """Record an attempt; ``status`` is the HTTP status or the exception raised"""
+        self.in_flight.dec(method)
+        self.total_seconds.observe(time.perf_counter() - timing.start, method)
+        if timing.connect is not None:
+            self.connect_seconds.observe(timing.connect, method)
+        if timing.ttfb is not None:
+            self.ttfb_seconds.observe(timing.ttfb, method)
+        self.request_bytes.observe(timing.sent, method)
+        self.response_bytes.observe(timing.received, method)
+        self.responses.inc(method, type(status).__name__ if isinstance(status, BaseException) else str(status))
+
+    def retried(self, method: str):
+        self.retries.inc(method)
+
+    def metrics(self) -> List[Metric]:
+        return [self.connect_seconds, self.ttfb_seconds, self.total_seconds, self.responses,
+                self.request_bytes, self.response_bytes, self.in_flight, self.retries]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Statistics by Bot method: counts, statuses, latency (avg and bucket p50/p95) and sizes"""
+        methods = {labels[0] for labels in self.total_seconds.values} | {labels[0] for labels in self.in_flight.values}
+        result = {}
+        for method in sorted(methods):
+            latency = {}
+            for name, histogram in (("connect", self.connect_seconds), ("ttfb", self.ttfb_seconds),
+                                    ("total", self.total_seconds)):
+                count = histogram.count(method)
+                latency[name] = {
+                    "count": count,
+                    "avg": histogram.total(method) / count if count else None,
+                    "p50": histogram.quantile(0.5, method),
+                    "p95": histogram.quantile(0.95, method),
+                }
+            result[method] = {
+                "requests": self.total_seconds.count(method),
+                "in_flight": self.in_flight.get(method),
+                "retries": self.retries.get(method),
+                "statuses": {status: count for (name, status), count in self.responses.values.items()
+                             if name == method},
+                "latency": latency,
+                "request_bytes": self.request_bytes.total(method),
+                "response_bytes": self.response_bytes.total(method),
+            }
+        return result
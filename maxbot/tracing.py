@@ -0,0 +1,186 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional
+
+from .log import get_logger
+
+# Innermost open span of the current update's trace
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+
+class Span:
+    """Timed step of a trace; use as a context manager, ``set`` adds attributes"""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "attrs", "_token")
+
+    def __init__(self, trace: "Trace", parent_id: Optional[int], name: str, attrs: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = len(trace.spans)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self._token: Optional[Token] = None
+        trace.spans.append(self)
+
+    def set(self, **attrs: Any):
+        self.attrs.update(attrs)
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.end = time.perf_counter()
+        if error is not None:
+            self.attrs["error"] = type(error).__name__
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+        _current.reset(self._token)
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.end if self.end is not None else time.perf_counter()
+        return {"id": self.span_id, "parent": self.parent_id, "name": self.name,
+                "start_ms": round((self.start - self.trace.root.start) * 1000, 3),
+                "duration_ms": round((end - self.start) * 1000, 3), **self.attrs}
+
+
+class _NoopSpan:
+    """Returned by ``span`` outside a sampled trace"""
+
+    __slots__ = ()
+
+    def set(self, **attrs: Any):
+        pass
+
+    def finish(self, error: Optional[BaseException] = None):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """Spans of one update, from parsing until its handler returns"""
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.trace_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.spans: List[Span] = []
+        self.root = Span(self, None, name, attrs)
+
+    def queued(self):
+        """Record the wait from parsing until a worker picks the update up"""
+        wait = Span(self, self.root.span_id, "queue", {})
+        wait.start = self.root.start
+        wait.finish()
+
+    def to_dict(self) -> Dict[str, Any]:
+        root = self.root.to_dict()
+        return {"trace_id": self.trace_id, "time": self.started_at, "name": self.root.name,
+                "duration_ms": root["duration_ms"], "spans": [span.to_dict() for span in self.spans]}
+
+
+def span(name: str, **attrs: Any):
+    """Child of the current span, or a no-op when the update isn't traced"""
+    parent = _current.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, parent.span_id, name, attrs)
+
+
+def current_trace_id() -> Optional[str]:
+    parent = _current.get()
+    return parent.trace.trace_id if parent is not None else None
+
+
+def activate(trace: Trace) -> Token:
+    """Make the trace's root the current span (in this task)"""
+    return _current.set(trace.root)
+
+
+def deactivate(token: Token):
+    _current.reset(token)
+
+
+class JSONLSink:
+    """Appends finished traces to a file, one JSON object per line"""
+
+    def __init__(self, path: str = "traces.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _append(self, line: str):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    async def write(self, trace: Dict[str, Any]):
+        await asyncio.to_thread(self._append, json.dumps(trace, ensure_ascii=False, default=str) + "\n")
+
+
+class Tracer:
+    """Starts traces for a ``sample_rate`` share of updates and writes them to ``sink``.
+
+    With ``sample_rate=0`` (default) no trace is created, and every
+    ``span`` call returns the shared no-op span.
+    """
+
+    def __init__(self, sink: Optional[JSONLSink] = None, sample_rate: float = 0.0):
+        self.sink = sink
+        self.sample_rate = sample_rate if sink is not None else 0.0
+        self.traces = 0
+        self._logger = get_logger("tracing")
+
+    def start(self, name: str, **attrs: Any) -> Optional[Trace]:
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        return Trace(name, attrs)
+
+    async def finish(self, trace: Trace):
+        trace.root.finish()
+        self.traces += 1
+        try:
+            await self.sink.write(trace.to_dict())
+        except Exception as e:
+            self._logger.error(f"Failed to write trace {trace.trace_id}: {e}")
+
+
+def instrument_engine(engine, statement_length: int = 200):
+    """Record a span for every SQL statement of a (sync or async) SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        if parent is not None and context is not None:
+            context._trace_span = Span(parent.trace, parent.span_id, "sql",
+                                       {"statement": statement[:statement_length], "executemany": executemany})
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        sql_span = getattr(context, "_trace_span", None)
+        if sql_span is not None:
+            sql_span.finish()
+            sql_span.set(rows=cursor.rowcount)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        sql_span = getattr(exception_context.execution_context, "_trace_span", None)
+        if sql_span is not None:
+            sql_span.finish(exception_context.original_exception)
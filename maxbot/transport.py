@@ -0,0 +1,62 @@
+from dataclasses import dataclass, field
+from typing import Dict
+
+import aiohttp
+
+# Total time budget (seconds) per Bot method
+DEFAULT_TIMEOUTS: Dict[str, float] = {
+    "get_me": 5,
+    "get_chat": 5,
+    "send_message": 10,
+    "answer_callback": 5,
+    "edit_message": 10,
+    "delete_message": 5,
+}
+
+
+@dataclass
+class TransportConfig:
+    """HTTP transport settings for Bot.
+
+    Outbound calls share one pooled connector; long polling gets its own
+    single-connection session, so a parked ``/updates`` request never takes
+    a connection away from ``send_message`` or ``answer_callback``.
+    """
+
+    limit: int = 100
+    limit_per_host: int = 30
+    keepalive_timeout: float = 30
+    ttl_dns_cache: int = 300
+    connect_timeout: float = 5
+    default_timeout: float = 15
+    timeouts: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_TIMEOUTS))
+    # Added on top of the long poll timeout to get the request budget
+    poll_margin: float = 10
+    dedicated_poll_connection: bool = True
+    warm_up: bool = False
+
+    def connector(self) -> aiohttp.TCPConnector:
+        """Pooled connector for outbound API calls"""
+        return aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.ttl_dns_cache,
+        )
+
+    def poll_connector(self) -> aiohttp.TCPConnector:
+        """Single kept-alive connection for long polling"""
+        return aiohttp.TCPConnector(
+            limit=1,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.ttl_dns_cache,
+        )
+
+    def timeout_for(self, method: str) -> aiohttp.ClientTimeout:
+        """ClientTimeout for a Bot method"""
+        return aiohttp.ClientTimeout(total=self.timeouts.get(method, self.default_timeout),
+                                     sock_connect=self.connect_timeout)
+
+    def poll_timeout(self, timeout: float) -> aiohttp.ClientTimeout:
+        """ClientTimeout for a long poll parked for up to timeout seconds"""
+        return aiohttp.ClientTimeout(total=timeout + self.poll_margin, sock_connect=self.connect_timeout)
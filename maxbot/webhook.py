@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import hmac
+import json
+from typing import Any, Dict, Iterable, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from .log import get_logger
+
+# Header carrying the secret given to POST /subscriptions
+SECRET_HEADER = "X-Max-Bot-Api-Secret"
+
+
+class WebhookServer:
+    """aiohttp server receiving update POSTs from MAX.
+
+    A request is checked against the shared secret, parsed and put into the
+    dispatcher's worker pool (redeliveries are dropped by the dispatcher's
+    dedup window); the response is sent as soon as the update is
+    queued, not after it's handled. With ``reuse_port`` several processes can
+    listen on the same port (SO_REUSEPORT) and the kernel spreads connections
+    between them.
+    """
+
+    def __init__(self, dispatcher, path: str = "/webhook", secret: Optional[str] = None,
+                 host: str = "0.0.0.0", port: int = 8080, reuse_port: bool = False):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.received = 0
+        self.rejected = 0
+        self._runner: Optional[web.AppRunner] = None
+        self._logger = get_logger("webhook")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Bytes: compare_digest rejects non-ASCII str, which a client controls
+        if self.secret is not None and not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(),
+                                                               self.secret.encode()):
+            self.rejected += 1
+            self._logger.warning(f"Rejected webhook request from {request.remote}: bad secret")
+            return web.Response(status=403)
+
+        update = self.dispatcher._parse_update(await request.read())
+        if update is None:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self.received += 1
+        if self.dispatcher.dedup.add(update.key):
+            await self.dispatcher.pool.submit(update)
+        return web.Response(status=200)
+
+    async def start(self):
+        """Start listening"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port, reuse_port=self.reuse_port or None)
+        await site.start()
+        self._logger.info(f"Webhook listening on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Stop accepting requests"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            self._logger.info(f"Webhook stopped. Received {self.received}, rejected {self.rejected}")
+
+
+async def replay(url: str, updates: Iterable[Dict[str, Any]], secret: Optional[str] = None,
+                 concurrency: int = 10) -> List[int]:
+    """Test harness: POST recorded updates to a webhook, returning response statuses"""
+    headers = {SECRET_HEADER: secret} if secret is not None else {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, json=update) as response:
+                    return response.status
+
+        return await asyncio.gather(*(post(update) for update in updates))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="POST recorded updates (one JSON object per line) to a webhook")
+    parser.add_argument("file")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret")
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    statuses = asyncio.run(replay(args.url, recorded, args.secret, args.concurrency))
+    print(f"Sent {len(statuses)} updates: " + ", ".join(f"{status}: {statuses.count(status)}"
+                                                        for status in sorted(set(statuses))))
@@ -3,9 +3,9 @@ from datetime import datetime
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.orm import declared_attr
-from sqlalchemy import ForeignKey, func
+from sqlalchemy import ForeignKey, Index, func
 
 from sqlalchemy import String, Integer
 from typing import Optional
@@ -25,6 +25,11 @@ class Base(AsyncAttrs, DeclarativeBase):
 
 
 class Shelter(Base):
+    __table_args__ = (
+        Index("ix_shelters_location_verified", "location", "verified"),
+        Index("ix_shelters_verified", "verified"),
+    )
+
     verified: Mapped[int] = mapped_column()  # 1/0 верифицирован/нет  -1 требует правок
     get_messages: Mapped[bool] = mapped_column()  # 1/0 можно писать/нет
     max_id: Mapped[int] = mapped_column(unique=True)
@@ -43,6 +48,12 @@ class Shelter(Base):
 
 
 class Pet(Base):
+    __table_args__ = (
+        Index("ix_pets_location_type", "location", "type"),
+        Index("ix_pets_location", "location"),
+        Index("ix_pets_shelter_id", "shelter_id"),
+    )
+
     shelter_id: Mapped[int] = mapped_column(ForeignKey("shelters.id"))
     location: Mapped[str] = mapped_column(ForeignKey("shelters.location"))
 
@@ -53,15 +64,26 @@ class Pet(Base):
 
     description: Mapped[Optional[str]] = mapped_column(String(1024))
 
+    shelter: Mapped["Shelter"] = relationship(foreign_keys=[shelter_id])
+    photos: Mapped[list["Photo"]] = relationship(back_populates="pet", cascade="all, delete-orphan",
+                                                 order_by="Photo.id")
+
     def __repr__(self):
         return (f"<Pet(id={self.id}, shelter_id={self.shelter_id},"
                 f" type={self.type}, name={self.name}, description={self.description})>")
 
 
 class Photo(Base):
+    __table_args__ = (
+        Index("ix_photos_pet_id", "pet_id"),
+        Index("ix_photos_token", "token"),
+    )
+
     pet_id: Mapped[int] = mapped_column(ForeignKey("pets.id"))
     token: Mapped[str] = mapped_column(String(2048))
 
+    pet: Mapped["Pet"] = relationship(back_populates="photos")
+
 
 class User(Base):
     max_id: Mapped[int] = mapped_column(unique=True)
@@ -1,15 +1,37 @@
+import asyncio
+import dataclasses
+import json
 import pytest
 import logging
 from unittest.mock import AsyncMock, patch
 import sys
 import os
+import tracemalloc
 
 # Добавляем путь к модулю
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from maxbot import Bot, Dispatcher, Router, configure_logging
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Optional
+
+from maxbot import Bot, StateManager, EvictionPolicy, TransportConfig, RateLimiter, RetryPolicy, SQLiteOutboxStore, get_codec, Dispatcher, Router, WorkerPool, State, StateFilter, CallbackData, configure_logging
 from maxbot._types import Message, User, Chat, Update, CallbackQuery
-from maxbot.filters import Command, CallbackQueryFilter
+from maxbot.bot import handling_chat
+from maxbot.filters import Command, CallbackQueryFilter, Payload
+from maxbot.webhook import WebhookServer, replay
+from maxbot.metrics import MetricsServer
+from maxbot import tracing
+from maxbot.tracing import Tracer, JSONLSink, instrument_engine
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from create_db import (create_db, pool_options, create_tables, create_shelter, create_pet, get_pets_page,
+                       create_photos_bulk, replace_pet_photos, delete_photos_by_pet_id, get_photos_by_pet_id)
+from maxbot.checkpoint import MarkerStore
+from maxbot.storage import StateStorage, MemoryStorage, SQLiteStorage, KVStorage, LocalKV, dump_record, load_record
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 class TestMaxBotFixed:
     @pytest.fixture
@@ -36,6 +58,814 @@ class TestMaxBotFixed:
         assert bot.session is not None
         await bot.close()
     
+    @pytest.mark.asyncio
+    async def test_transport_config(self):
+        """Тест отдельного соединения для long polling и таймаутов по методам"""
+        bot = Bot("test_token", transport=TransportConfig(limit_per_host=7, timeouts={"send_message": 3}))
+        await bot.setup()
+        assert bot.session.connector.limit_per_host == 7
+        assert bot.poll_session is not bot.session
+        assert bot.poll_session.connector.limit == 1
+        assert bot.transport.timeout_for("send_message").total == 3
+        assert bot.transport.timeout_for("get_chat").total == bot.transport.default_timeout
+        assert bot.transport.poll_timeout(30).total == 30 + bot.transport.poll_margin
+
+        with patch('aiohttp.ClientSession.get') as mock_get:
+            mock_response = AsyncMock()
+            mock_response.json.return_value = {"updates": []}
+            mock_get.return_value.__aenter__.return_value = mock_response
+            await bot.get_updates(timeout=30)
+            assert mock_get.call_args.kwargs["timeout"].total == 30 + bot.transport.poll_margin
+        await bot.close()
+
+    @pytest.mark.asyncio
+    async def test_rate_limiter(self):
+        """Тест очереди отправки: порядок по чату и повтор после 429"""
+        limiter = RateLimiter(rate=1000, burst=1000, chat_rate=1000, chat_burst=1)
+        bot = Bot("test_token", rate_limiter=limiter)
+        def response(status):
+            mock_response = AsyncMock()
+            mock_response.status = status
+            mock_response.headers = {"Retry-After": "0.01"}
+            mock_response.json.return_value = {}
+            return mock_response
+
+        responses = iter([response(429)] + [response(200) for _ in range(5)])
+
+        async def enter(*args):
+            await asyncio.sleep(0)
+            return next(responses)
+
+        with patch('aiohttp.ClientSession.post') as mock_post:
+            mock_post.return_value.__aenter__.side_effect = enter
+            await bot.setup()
+            await asyncio.gather(*(bot.send_message(chat_id=1, text=str(i)) for i in range(5)))
+            await bot.close()
+
+        sent = [call.kwargs["json"]["text"] for call in mock_post.call_args_list]
+        assert sent == ["0", "0", "1", "2", "3", "4"]
+        assert mock_post.call_count == 6
+        stats = limiter.stats()
+        assert stats["throttled"] == 1
+        assert stats["acquired"] == 5
+        assert stats["waiting"] == 0
+        assert not limiter._locks
+
+        # Правки, удаления и ответы на колбэки тоже идут через корзину чата
+        keys = []
+        slot = limiter.slot
+
+        def recording_slot(key=None):
+            keys.append(key)
+            return slot(key)
+
+        with patch.object(limiter, "slot", side_effect=recording_slot), \
+                patch('aiohttp.ClientSession.put') as mock_put, patch('aiohttp.ClientSession.delete') as mock_delete, \
+                patch('aiohttp.ClientSession.post') as mock_post:
+            for mock in (mock_put, mock_delete, mock_post):
+                mock.return_value.__aenter__.return_value = response(200)
+            await bot.setup()
+            await bot.edit_message("m1", "text", chat_id=1)
+            await bot.delete_message("m1", chat_id=1)
+            token = handling_chat.set(2)
+            try:
+                await bot.answer_callback("cb1", "text")
+            finally:
+                handling_chat.reset(token)
+            await bot.close()
+        assert keys == [("chat", 1), ("chat", 1), ("chat", 2)]
+
+        # Пауза после 429, пока ожидающий спит на резерве: токен возвращается, а не теряется
+        limiter = RateLimiter(rate=20, burst=1)
+        limiter.bucket.reserve()
+        with patch.object(limiter.bucket, "reserve", wraps=limiter.bucket.reserve) as reserve, \
+                patch.object(limiter.bucket, "refund", wraps=limiter.bucket.refund) as refund:
+            waiter = asyncio.create_task(limiter.wait())
+            await asyncio.sleep(0.01)
+            limiter.pause(0.2)
+            await waiter
+        assert (reserve.call_count, refund.call_count) == (2, 1)
+        assert limiter.bucket.tokens <= 0
+
+    @pytest.mark.asyncio
+    async def test_retry_policy(self):
+        """Тест повторов с backoff: 5xx повторяется, 4xx и 5xx отправки сообщения нет, ключ дедупликации не отправляет дважды"""
+        bot = Bot("test_token", retry_policies={"default": RetryPolicy(attempts=3, base_delay=0.001)})
+
+        def response(status):
+            mock_response = AsyncMock()
+            mock_response.status = status
+            mock_response.json.return_value = {"status": status}
+            return mock_response
+
+        with patch('aiohttp.ClientSession.put') as mock_put:
+            mock_put.return_value.__aenter__.side_effect = [response(502), response(200)]
+            await bot.setup()
+            assert await bot.edit_message("mid", "text") == {"status": 200}
+            assert mock_put.call_count == 2
+
+            mock_put.return_value.__aenter__.side_effect = [response(400)]
+            assert await bot.edit_message("mid", "text") == {"status": 400}
+            assert mock_put.call_count == 3
+
+        with patch('aiohttp.ClientSession.post') as mock_post:
+            mock_post.return_value.__aenter__.side_effect = [response(200)]
+            await bot.send_message(chat_id=1, text="text", dedup_key="key")
+            await bot.send_message(chat_id=1, text="text", dedup_key="key")
+            assert mock_post.call_count == 1
+            assert mock_post.call_args.kwargs["headers"]["Idempotency-Key"] == "key"
+
+            # 502 после отправки неоднозначен: сообщение могло быть принято, повтора нет
+            mock_post.return_value.__aenter__.side_effect = [response(502), response(200)]
+            assert await bot.send_message(chat_id=1, text="text") == {"status": 502}
+            assert mock_post.call_count == 2
+
+            # Сгенерированный ключ запоминается для доставленной отправки
+            mock_post.return_value.__aenter__.side_effect = [response(200)]
+            await bot.send_message(chat_id=1, text="text")
+            assert mock_post.call_args.kwargs["headers"]["Idempotency-Key"] in bot._delivered
+        await bot.close()
+
+    @pytest.mark.asyncio
+    async def test_outbox(self, tmp_path):
+        """Тест outbox: отправка в фоне по порядку и доставка записей, оставшихся после перезапуска"""
+        path = str(tmp_path / "outbox.db")
+        store = SQLiteOutboxStore(path)
+        await store.open()
+        await store.add("send_message", {"chat_id": 1, "text": "replayed"}, "chat:1")
+        await store.close()
+
+        bot = Bot("test_token")
+        bot.enable_outbox(SQLiteOutboxStore(path), senders=2)
+        with patch('aiohttp.ClientSession.post') as mock_post:
+            mock_response = AsyncMock()
+            mock_response.status = 200
+            mock_response.json.return_value = {"message": {"body": {"mid": "mid"}}}
+            mock_post.return_value.__aenter__.return_value = mock_response
+
+            await bot.setup()
+            futures = [await bot.send_message(chat_id=1, text=str(i)) for i in range(3)]
+            assert all(isinstance(future, asyncio.Future) for future in futures)
+            responses = await asyncio.gather(*futures)
+            await bot.close()
+
+        assert responses[0]["message"]["body"]["mid"] == "mid"
+        sent = [call.kwargs["json"]["text"] for call in mock_post.call_args_list]
+        assert sent == ["replayed", "0", "1", "2"]
+        assert all(call.kwargs["headers"]["Idempotency-Key"] for call in mock_post.call_args_list[1:])
+
+        await store.open()
+        assert await store.pending() == []
+        assert await store.delivered(mock_post.call_args.kwargs["headers"]["Idempotency-Key"]) == responses[-1]
+        await store.close()
+
+        # Ключ доставленной отправки переживает перезапуск: повтор не уходит в API
+        for attempt in range(2):
+            bot = Bot("test_token")
+            bot.enable_outbox(SQLiteOutboxStore(path))
+            with patch('aiohttp.ClientSession.post') as mock_post:
+                mock_response = AsyncMock()
+                mock_response.status = 200
+                mock_response.json.return_value = {"message": {"body": {"mid": "once"}}}
+                mock_post.return_value.__aenter__.return_value = mock_response
+                await bot.setup()
+                response = await (await bot.send_message(chat_id=1, text="once", dedup_key="update:1"))
+                await bot.close()
+            assert response["message"]["body"]["mid"] == "once"
+            assert mock_post.call_count == (1 if attempt == 0 else 0)
+
+    @pytest.mark.asyncio
+    async def test_outbox_retry(self, tmp_path):
+        """Тест outbox: неудачная отправка остаётся в очереди и повторяется, после всех попыток — в dead letters"""
+        seen = []
+
+        async def request(http_method, method, path, **kwargs):
+            text = kwargs["json"]["text"]
+            seen.append((text, [(entry.kwargs["text"], entry.attempts) for entry in await store.pending()]))
+            if text == "dead" or len(seen) == 1:
+                raise aiohttp.ClientConnectionError("connection reset")
+            return {"message": {"body": {"mid": text}}}
+
+        bot = Bot("test_token")
+        store = SQLiteOutboxStore(str(tmp_path / "outbox.db"))
+        outbox = bot.enable_outbox(store, senders=1, max_attempts=2)
+        outbox.retry_delay = 0.01
+        with patch.object(bot, "_request", side_effect=request):
+            await bot.setup()
+            sent = await bot.send_message(chat_id=1, text="retried")
+            assert (await sent)["message"]["body"]["mid"] == "retried"
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await (await bot.send_message(chat_id=1, text="dead"))
+            assert await store.pending() == []
+            dead = await store.dead_letters()
+            await bot.close()
+
+        # Запись не удаляется после ошибки: повтор видит её в очереди с числом попыток
+        assert seen[:2] == [("retried", [("retried", 0)]), ("retried", [("retried", 1)])]
+        assert [(entry.kwargs["text"], entry.attempts) for entry in dead] == [("dead", 2)]
+        assert (outbox.delivered, outbox.retried, outbox.failed) == (1, 2, 1)
+
+    @pytest.mark.asyncio
+    async def test_outbox_chat_order(self, dispatcher):
+        """Тест outbox: правки, удаления и ответы на колбэки идут по порядку с отправками в тот же чат"""
+        calls = []
+
+        async def request(http_method, method, path, **kwargs):
+            calls.append(method)
+            # Первые вызовы медленнее: при разных шардах отправка их обогнала бы
+            await asyncio.sleep(0.03 if method != "send_message" else 0)
+            return {"message": {"body": {"mid": "mid"}}}
+
+        bot = dispatcher.bot
+        bot.enable_outbox(senders=4)
+        futures = []
+
+        @dispatcher.callback_query_handler()
+        async def next_card(update, bot):
+            futures.append(await bot.answer_callback(update.callback_query.callback_id, "Карточка"))
+            futures.append(await bot.send_message(chat_id=7, text="Следующая"))
+
+        with patch.object(bot, "_request", side_effect=request):
+            await bot.setup()
+            for i in range(4):
+                futures.append(await bot.edit_message(f"m{i}", "Изменено", chat_id=7))
+                futures.append(await bot.send_message(chat_id=7, text=str(i)))
+            futures.append(await bot.delete_message("m0", chat_id=7))
+            await dispatcher.process_update(Update(
+                update_id=1, update_type="message_callback", timestamp=0,
+                callback_query=CallbackQuery(callback_id="cb1", from_user=User(user_id=1, first_name="Test"),
+                                             message=Message(message_id="m0", chat=Chat(chat_id=7, type="dialog",
+                                                                                        status="active"),
+                                                             from_user=User(user_id=2, first_name="Bot")),
+                                             payload="next")))
+            await asyncio.gather(*futures)
+            await bot.close()
+
+        assert calls == ["edit_message", "send_message"] * 4 + ["delete_message", "answer_callback", "send_message"]
+
+    @pytest.mark.asyncio
+    async def test_json_codec(self):
+        """Тест подключаемого JSON-кодека: stdlib всегда доступен, сырой апдейт разбирается кодеком бота"""
+        codec = get_codec("json")
+        assert codec.loads(codec.dumps({"text": "Привет"})) == {"text": "Привет"}
+        with pytest.raises(ValueError):
+            get_codec("unknown")
+
+        loads_calls = []
+
+        def loads(raw):
+            loads_calls.append(raw)
+            return codec.loads(raw)
+
+        bot = Bot("test_token", json_dumps=codec.dumps, json_loads=loads)
+        assert bot.json_dumps is codec.dumps
+        raw = b'{"update_type": "bot_started", "timestamp": 5, "chat_id": 7, "payload": "ref"}'
+        update = Dispatcher(bot)._parse_update(raw)
+        assert loads_calls == [raw]
+        assert update.chat_id == 7 and update.payload == "ref"
+
+    @pytest.mark.asyncio
+    async def test_lazy_update_parsing(self, dispatcher):
+        """Тест разбора апдейтов: типы без __dict__, чат и отправитель создаются при первом обращении"""
+        update = dispatcher._parse_update({
+            "update_type": "message_callback",
+            "timestamp": 10,
+            "callback": {"callback_id": "cb1", "payload": "next", "user": {"user_id": 5, "first_name": "Иван"}},
+            "message": {"sender": {"user_id": 1, "first_name": "Бот", "is_bot": True},
+                        "recipient": {"chat_id": 42, "chat_type": "dialog"},
+                        "body": {"mid": "m1", "text": "Карточка"}},
+        })
+        query = update.callback_query
+        untouched = dispatcher._parse_update({"update_type": "message_callback", "timestamp": 10,
+                                              "callback": {"callback_id": "cb1", "payload": "next"},
+                                              "message": {"body": {"mid": "m1", "text": "Карточка"}}})
+        assert not hasattr(update, "__dict__") and not hasattr(query, "__dict__")
+        assert not hasattr(query.message, "__dict__")
+        assert query.message.chat_id == 42 and query.message._chat is None
+        assert query._from_user is None
+        assert query.from_user == User(user_id=5, first_name="Иван")
+        assert query.from_user is query.from_user
+        assert update.effective_chat == Chat(chat_id=42, type="dialog", status="active")
+        assert query.message.from_user.is_bot
+        assert update.key == "callback:cb1"
+
+        # Кэш чата и отправителя не входит в поля: сравнение и repr не зависят от обращений
+        assert query == untouched.callback_query and query.message == untouched.callback_query.message
+        assert "_chat" not in repr(query.message) and "_from_user" not in repr(query)
+        assert [f.name for f in dataclasses.fields(Message)] == ["message_id", "text", "timestamp", "attachments"]
+        edited = dataclasses.replace(query.message, text="Изменено")
+        assert (edited.message_id, edited.text) == ("m1", "Изменено")
+        assert dataclasses.replace(query, payload="prev").payload == "prev"
+
+    @pytest.mark.asyncio
+    async def test_webhook(self, dispatcher):
+        """Тест вебхука: проверка секрета и передача апдейтов в очередь диспетчера"""
+        received = []
+
+        @dispatcher.bot_started_handler()
+        async def started(update, bot):
+            received.append(update.chat_id)
+
+        dispatcher.pool = WorkerPool(dispatcher.process_update, workers=2)
+        dispatcher.pool.start()
+        server = WebhookServer(dispatcher, secret="secret")
+        async with TestServer(server.app()) as test_server:
+            url = str(test_server.make_url("/webhook"))
+            updates = [{"update_type": "bot_started", "timestamp": i, "chat_id": i} for i in range(5)]
+            assert await replay(url, updates, secret="secret") == [200] * 5
+            assert await replay(url, updates[:1], secret="wrong") == [403]
+            assert await replay(url, updates[:1], secret="секрет") == [403]
+            assert await replay(url, ["not an update"], secret="secret") == [400]
+        await dispatcher.pool.stop()
+
+        assert sorted(received) == [0, 1, 2, 3, 4]
+        assert (server.received, server.rejected) == (5, 3)
+
+        # Несколько процессов на одном порту — только с общим хранилищем состояний
+        with pytest.raises(ValueError):
+            await dispatcher.start_webhook(port=0, reuse_port=True)
+        assert not MemoryStorage.shared and not KVStorage(LocalKV()).shared
+        assert KVStorage(SimpleNamespace()).shared
+
+    @pytest.mark.asyncio
+    async def test_dispatcher_metrics(self, dispatcher):
+        """Тест метрик диспетчера: гистограммы обработчиков и фильтров, ошибки, необработанные апдейты, /metrics"""
+        @dispatcher.message_handler(Command("start"))
+        async def start(update, bot):
+            pass
+
+        async def allowed(update):
+            return True
+
+        @dispatcher.message_handler(Command("fail"), allowed)
+        async def fail(update, bot):
+            raise RuntimeError("boom")
+
+        def message(text):
+            return Update(update_id=1, update_type="message_created", timestamp=0,
+                          message=Message(message_id="1", chat=Chat(chat_id=1, type="chat", status="active"),
+                                          from_user=User(user_id=1, first_name="Test"), text=text))
+
+        for text in ("/start", "/start", "/fail", "hello"):
+            await dispatcher.process_update(message(text))
+        await dispatcher.process_update(Update(update_id=2, update_type="chat_title_changed", timestamp=0))
+
+        metrics = dispatcher.metrics
+        assert metrics.metrics["maxbot_updates_total"].get("message") == 4
+        assert metrics.metrics["maxbot_handler_seconds"].count("start") == 2
+        assert metrics.metrics["maxbot_handler_errors_total"].get("fail") == 1
+        assert metrics.metrics["maxbot_unhandled_updates_total"].get("message") == 2
+        assert metrics.metrics["maxbot_unhandled_updates_total"].get("chat_title_changed") == 1
+
+        async with TestServer(MetricsServer(metrics).app()) as test_server:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(str(test_server.make_url("/metrics"))) as response:
+                    text = await response.text()
+                    content_type = response.headers["Content-Type"]
+        assert content_type == "text/plain; version=0.0.4; charset=utf-8"
+        assert 'maxbot_handler_seconds_count{handler="start"} 2' in text
+        assert 'maxbot_handler_seconds_bucket{handler="start",le="+Inf"} 2' in text
+        assert 'maxbot_filter_seconds_count{handler="fail",filter="allowed"} 1' in text
+        assert "maxbot_queue_depth 0" in text
+
+    @pytest.mark.asyncio
+    async def test_api_telemetry(self):
+        """Тест телеметрии вызовов API: задержки, статусы, размеры, повторы и вывод в /metrics"""
+        answers = []
+
+        async def messages(request):
+            return web.json_response({"message": {"body": {"mid": "m1"}}})
+
+        async def answer(request):
+            answers.append(await request.json())
+            return web.json_response({"success": len(answers) > 1}, status=503 if len(answers) == 1 else 200)
+
+        app = web.Application()
+        app.router.add_post("/messages", messages)
+        app.router.add_post("/answers", answer)
+        async with TestServer(app) as server:
+            bot = Bot("test_token", base_url=str(server.make_url("")),
+                      retry_policies={"answer_callback": RetryPolicy(base_delay=0.01)})
+            async with bot:
+                await bot.send_message(chat_id=1, text="Привет")
+                await bot.answer_callback("cb1", "Ответ")
+
+        stats = bot.telemetry.snapshot()
+        assert stats["send_message"]["statuses"] == {"200": 1}
+        assert stats["send_message"]["latency"]["connect"]["count"] == 1
+        assert stats["send_message"]["latency"]["ttfb"]["count"] == 1
+        assert stats["send_message"]["request_bytes"] > 0 and stats["send_message"]["response_bytes"] > 0
+        assert stats["answer_callback"]["statuses"] == {"503": 1, "200": 1}
+        assert stats["answer_callback"]["retries"] == 1
+        assert stats["answer_callback"]["in_flight"] == 0
+
+        text = Dispatcher(bot).metrics.render()
+        assert 'maxbot_api_responses_total{method="answer_callback",status="503"} 1' in text
+        assert 'maxbot_api_request_seconds_count{method="send_message"} 1' in text
+
+    @pytest.mark.asyncio
+    async def test_update_tracing(self, tmp_path):
+        """Тест трассировки: спаны фильтра, обработчика, SQL и HTTP одной трассы в JSONL, без выборки — ничего"""
+        async def messages(request):
+            return web.json_response({"message": {"body": {"mid": "m1"}}})
+
+        app = web.Application()
+        app.router.add_post("/messages", messages)
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+        instrument_engine(engine)
+        path = tmp_path / "traces.jsonl"
+
+        async with TestServer(app) as server:
+            bot = Bot("test_token", base_url=str(server.make_url("")))
+            dispatcher = Dispatcher(bot)
+
+            async def allowed(update):
+                return True
+
+            @dispatcher.bot_started_handler(allowed)
+            async def started(update, bot):
+                assert tracing.current_trace_id() == update.trace.trace_id
+                async with engine.connect() as connection:
+                    await connection.execute(text("SELECT 1"))
+                await bot.send_message(chat_id=update.chat_id, text="Привет")
+
+            raw = {"update_type": "bot_started", "timestamp": 1, "chat_id": 7}
+            async with bot:
+                update = dispatcher._parse_update(raw)
+                assert update.trace is None
+                await dispatcher.process_update(update)
+
+                dispatcher.tracer = Tracer(JSONLSink(str(path)), sample_rate=1.0)
+                await dispatcher.process_update(dispatcher._parse_update(raw))
+        await engine.dispose()
+
+        traces = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+        assert len(traces) == 1
+        spans = {span["name"]: span for span in traces[0]["spans"]}
+        assert ["update", "queue", "dispatch", "filter", "handler", "sql", "http"] == [span["name"] for span in traces[0]["spans"]]
+        assert spans["filter"]["passed"] and spans["filter"]["filter"] == "allowed"
+        assert spans["sql"]["statement"] == "SELECT 1" and spans["sql"]["parent"] == spans["handler"]["id"]
+        assert spans["http"]["method"] == "send_message" and spans["http"]["status"] == 200
+        assert spans["handler"]["parent"] == spans["dispatch"]["id"]
+        assert spans["queue"]["start_ms"] == 0 and spans["queue"]["parent"] == spans["update"]["id"]
+
+    @pytest.mark.asyncio
+    async def test_pipelined_polling(self, dispatcher):
+        """Тест конвейерного polling: маркер передаётся сразу, при переполнении очереди опрос приостанавливается"""
+        handled = []
+
+        @dispatcher.bot_started_handler()
+        async def started(update, bot):
+            await asyncio.sleep(0.005)
+            handled.append(update.timestamp)
+
+        markers, depths = [], []
+
+        async def get_updates(timeout, limit, marker):
+            markers.append(marker)
+            depths.append(dispatcher.pool.queue_depth)
+            batch = len(markers)
+            if batch > 3:
+                dispatcher.stop_polling()
+                return {"updates": []}
+            return {"marker": batch,
+                    "updates": [{"update_type": "bot_started", "timestamp": batch * 10 + i, "chat_id": 1}
+                                for i in range(4)]}
+
+        with patch.object(dispatcher.bot, "get_updates", side_effect=get_updates):
+            await dispatcher.start_polling(workers=1, high_watermark=2, low_watermark=1)
+
+        assert markers == [None, 1, 2, 3]
+        assert max(depths) <= 2
+        assert handled == [batch * 10 + i for batch in (1, 2, 3) for i in range(4)]
+
+    @pytest.mark.asyncio
+    async def test_polling_failure(self, dispatcher):
+        """Тест polling: ошибка задачи опроса вне её обработки ошибок доходит до вызывающего, а не вешает бота"""
+        handled = []
+
+        @dispatcher.bot_started_handler()
+        async def started(update, bot):
+            handled.append(update.timestamp)
+
+        responses = iter([{"marker": 1, "updates": [{"update_type": "bot_started", "timestamp": 1, "chat_id": 1}]},
+                          ["not a response"]])
+        with patch.object(dispatcher.bot, "get_updates", side_effect=lambda **kwargs: next(responses)):
+            with pytest.raises(AttributeError):
+                await asyncio.wait_for(dispatcher.start_polling(workers=1), 2)
+        assert handled == [1]
+
+    @pytest.mark.asyncio
+    async def test_update_identity(self, dispatcher):
+        """Тест идентичности апдейтов: номера не совпадают при одинаковом времени, пустой mid не склеивает апдейты"""
+        raw = [{"update_type": "message_created", "timestamp": 5,
+                "message": {"recipient": {"chat_id": chat_id}, "sender": {"user_id": 1}, "body": {"mid": "", "text": "a"}}}
+               for chat_id in (1, 2)]
+        first, second = (dispatcher._parse_update(data) for data in raw)
+        assert first.update_id != second.update_id
+        assert (first.key, second.key) == ("message_created:1:5", "message_created:2:5")
+        assert dispatcher._parse_update(dict(raw[0], message={"body": {"mid": "m1"}})).key == "message:m1"
+
+    @pytest.mark.asyncio
+    async def test_polling_checkpoint(self, tmp_path):
+        """Тест сохранения маркера: после перезапуска опрос продолжается с него, повторы не обрабатываются"""
+        store = MarkerStore(str(tmp_path / "marker.json"))
+        handled = []
+
+        def started_update(timestamp):
+            return {"update_type": "bot_started", "timestamp": timestamp, "chat_id": 1}
+
+        async def run(batches):
+            dispatcher = Dispatcher(Bot("test_token"))
+            markers = []
+
+            @dispatcher.bot_started_handler()
+            async def started(update, bot):
+                handled.append(update.timestamp)
+
+            async def get_updates(timeout, limit, marker):
+                markers.append(marker)
+                if not batches:
+                    dispatcher.stop_polling()
+                    return {"updates": []}
+                return batches.pop(0)
+
+            with patch.object(dispatcher.bot, "get_updates", side_effect=get_updates):
+                await dispatcher.start_polling(workers=2, marker_store=store)
+            return markers
+
+        first = [{"marker": 1, "updates": [started_update(1), started_update(2)]},
+                 {"marker": 2, "updates": [started_update(2), started_update(3)]}]
+        assert await run(first) == [None, 1, 2]
+        assert store.load()[0] == 2
+        assert handled == [1, 2, 3]
+
+        # Сервер прислал батч повторно: уже обработанные апдейты пропускаются
+        second = [{"marker": 3, "updates": [started_update(3), started_update(4)]}]
+        assert await run(second) == [2, 3]
+        assert handled == [1, 2, 3, 4]
+        assert store.load()[0] == 3
+
+        # Ключи всех обработанных апдейтов выше маркера сохраняются, даже если их больше окна в 1000
+        dispatcher = Dispatcher(Bot("test_token"))
+        dispatcher._track_keys = True
+        dispatcher.pool = SimpleNamespace(reached=lambda done: done)
+        updates = [Update(update_id=i, update_type="bot_started", timestamp=i, chat_id=1) for i in range(1500)]
+        for update in updates:
+            await dispatcher._process_polled(update)
+        pending = [(4, True, []), (5, False, [update.key for update in updates])]
+        await dispatcher._save_marker(store, pending)
+        marker, processed = store.load()
+        assert marker == 4 and len(processed) == 1500
+        pending[0] = (5, True, pending[0][2])
+        await dispatcher._save_marker(store, pending)
+        assert store.load() == (5, [update.key for update in updates[-1000:]])
+
+    @pytest.mark.asyncio
+    async def test_state_storage(self, tmp_path):
+        """Тест хранилищ FSM: стабильный id состояния, SQLite с отложенной записью и снимком, KV"""
+        named = State("test_storage_named")
+        assert load_record(dump_record([named, {"a": 1}]))[0] is named
+        with pytest.raises(ValueError):
+            State("test_storage_named")
+
+        class Incomplete(StateStorage):
+            async def get(self, chat_id):
+                return None
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+        path = str(tmp_path / "states.db")
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        await storage.open()
+        await storage.set(1, [named, {"name": "Барсик"}])
+        await storage.set(2, [named, {}])
+        await storage.delete(2)
+        await asyncio.sleep(0.05)
+        assert storage.flushes >= 1
+        await storage.close()
+
+        snapshot = SQLiteStorage(path, snapshot=True)
+        await snapshot.open()
+        assert snapshot.records == {1: [named, {"name": "Барсик"}]}
+        await snapshot.set(3, [named, {}])
+        await snapshot.close()
+        await snapshot.open()
+        assert set(snapshot.records) == {1, 3}
+        await snapshot.delete(1)
+        await snapshot.delete(3)
+        await snapshot.close()
+        await snapshot.open()
+        assert snapshot.records == {}
+        await snapshot.close()
+
+        # Непиклируемая запись пропускается, остальные сохраняются
+        storage = SQLiteStorage(path, flush_interval=60)
+        await storage.open()
+        await storage.set(4, [named, {"callback": lambda: None}])
+        await storage.set(5, [named, {"name": "Мурка"}])
+        await storage.flush()
+        await storage.close()
+        restored = SQLiteStorage(path)
+        await restored.open()
+        assert restored.records == {5: [named, {"name": "Мурка"}]}
+        await restored.close()
+
+        manager = StateManager()
+        manager.use_storage(KVStorage(LocalKV()))
+        try:
+            await manager.set_state(5, named)
+            await manager.set_data(5, "city", "Пермь")
+            assert await manager.get_state(5) is named
+            assert await manager.get_all_data(5) == {"city": "Пермь"}
+            await manager.erase_state(5)
+            assert await manager.get_state(5) is None
+        finally:
+            manager.use_storage(MemoryStorage())
+
+    @pytest.mark.asyncio
+    async def test_state_eviction(self):
+        """Тест вытеснения сессий FSM: лимит записей (LRU), TTL и лимит памяти с хуком"""
+        manager = StateManager()
+        state = State()
+        evicted = []
+
+        async def on_evict(chat_id, record, reason):
+            evicted.append((chat_id, reason))
+
+        manager.use_storage(MemoryStorage())
+        manager.use_eviction(EvictionPolicy(ttl=0.05, max_entries=2, on_evict=on_evict))
+        try:
+            for chat_id in (1, 2, 3):
+                await manager.set_state(chat_id, state)
+            assert evicted == [(1, "entries")]
+
+            await manager.get_state(2)
+            await manager.set_state(4, state)
+            assert evicted[-1] == (3, "entries")
+
+            await asyncio.sleep(0.06)
+            await manager.get_state(4)
+            assert await manager.sweep() == 1
+            assert evicted[-1] == (2, "ttl")
+            assert await manager.get_state(2) is None
+
+            manager.use_eviction(EvictionPolicy(max_bytes=2000, on_evict=on_evict))
+            await manager.set_state(5, state)
+            await manager.set_data(5, "text", "x" * 1500)
+            await manager.set_state(6, state)
+            await manager.set_data(6, "text", "x" * 1500)
+            assert evicted[-2:] == [(4, "memory"), (5, "memory")]
+            assert manager.stats()["memory_used"] <= 2000
+        finally:
+            manager.use_eviction(EvictionPolicy())
+            manager.use_storage(MemoryStorage())
+
+    @pytest.mark.asyncio
+    async def test_create_db_in_memory(self, tmp_path):
+        """Тест create_db: параметры пула передаются только движкам с QueuePool, база в памяти открывается"""
+        assert pool_options("sqlite+aiosqlite:///:memory:", 5, 10, 30) == {}
+        assert pool_options(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}", 5, 10, 30) == {
+            "pool_size": 5, "max_overflow": 10, "pool_timeout": 30}
+
+        tracing_memory = tracemalloc.is_tracing()
+        session = await create_db("sqlite+aiosqlite:///:memory:", pool_size=2)
+        try:
+            async with session() as db:
+                shelter = await create_shelter(db, 1, "Дом", "ул. Ленина, 1", "Москва")
+                assert (await get_pets_page(db)) == [] and shelter.location == "москва"
+        finally:
+            await session.kw["bind"].dispose()
+            if not tracing_memory:
+                tracemalloc.stop()
+
+    @pytest.mark.asyncio
+    async def test_get_pets_page(self):
+        """Тест постраничной выборки питомцев по курсору: порядок, фильтры и пустая последняя страница"""
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+        await create_tables(engine)
+        session = async_sessionmaker(engine, expire_on_commit=False)
+        try:
+            async with session() as db:
+                moscow = await create_shelter(db, 1, "Дом", "ул. Ленина, 1", "Москва")
+                kazan = await create_shelter(db, 2, "Лапы", "ул. Баумана, 2", "Казань")
+                rows = [(moscow, "cat"), (kazan, "dog"), (moscow, "dog"), (moscow, "cat"), (kazan, "cat"), (moscow, "cat")]
+                pets = [await create_pet(db, shelter.id, pet_type, f"pet{i}", i, shelter.location, True)
+                        for i, (shelter, pet_type) in enumerate(rows)]
+
+                async def pages(**filters):
+                    ids, cursor = [], 0
+                    while True:
+                        page = await get_pets_page(db, after_id=cursor, limit=2, **filters)
+                        if not page:
+                            return ids
+                        assert len(page) <= 2 and all(pet.shelter is not None for pet in page)
+                        ids.extend(pet.id for pet in page)
+                        cursor = page[-1].id
+
+                assert await pages() == [pet.id for pet in pets]
+                assert await pages(location="москва", pet_type="cat") == [pets[0].id, pets[3].id, pets[5].id]
+                assert await pages(shelter_id=kazan.id) == [pets[1].id, pets[4].id]
+                assert await pages(location="москва", pet_type="hamster") == []
+                assert await get_pets_page(db, after_id=pets[-1].id) == []
+        finally:
+            await engine.dispose()
+
+    async def _pets_db(self):
+        """База в памяти с приютом и двумя питомцами"""
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+        await create_tables(engine)
+        db = async_sessionmaker(engine, expire_on_commit=False)()
+        shelter = await create_shelter(db, 1, "Дом", "ул. Ленина, 1", "Москва")
+        pets = [await create_pet(db, shelter.id, "cat", name, 1, shelter.location, True) for name in ("Мурка", "Барсик")]
+        return engine, db, pets
+
+    async def _tokens(self, db, pet):
+        return sorted(photo.token for photo in await get_photos_by_pet_id(db, pet.id))
+
+    @pytest.mark.asyncio
+    async def test_create_photos_bulk(self):
+        """Тест добавления всех фото питомца одним запросом"""
+        engine, db, (murka, barsik) = await self._pets_db()
+        try:
+            assert await create_photos_bulk(db, murka.id, ["a", "b", "c"]) == 3
+            assert await create_photos_bulk(db, barsik.id, []) == 0
+            assert await self._tokens(db, murka) == ["a", "b", "c"]
+            assert await self._tokens(db, barsik) == []
+        finally:
+            await db.close()
+            await engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_replace_pet_photos(self):
+        """Тест замены фото: старые фото питомца удаляются, фото других питомцев не трогаются"""
+        engine, db, (murka, barsik) = await self._pets_db()
+        try:
+            await create_photos_bulk(db, murka.id, ["a", "b"])
+            await create_photos_bulk(db, barsik.id, ["x"])
+            assert await replace_pet_photos(db, murka.id, ["c", "d", "e"]) == 3
+            assert await self._tokens(db, murka) == ["c", "d", "e"]
+            assert await self._tokens(db, barsik) == ["x"]
+            assert await replace_pet_photos(db, murka.id, []) == 0
+            assert await self._tokens(db, murka) == []
+        finally:
+            await db.close()
+            await engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_delete_photos_by_pet_id(self):
+        """Тест удаления всех фото питомца одним запросом"""
+        engine, db, (murka, barsik) = await self._pets_db()
+        try:
+            await create_photos_bulk(db, murka.id, ["a", "b"])
+            await create_photos_bulk(db, barsik.id, ["x"])
+            assert await delete_photos_by_pet_id(db, murka.id) == 2
+            assert await self._tokens(db, murka) == []
+            assert await self._tokens(db, barsik) == ["x"]
+            assert await delete_photos_by_pet_id(db, murka.id) == 0
+        finally:
+            await db.close()
+            await engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_state_transaction(self):
+        """Тест транзакций FSM: двойное нажатие не теряет запись, откат при ошибке, без вытеснения под замком"""
+        manager = StateManager()
+        state = State()
+        manager.use_storage(MemoryStorage())
+        try:
+            await manager.set_state(1, state)
+            await manager.set_data(1, "cursor", 0)
+
+            async def next_card():
+                async with manager.transaction(1) as st:
+                    cursor = st["cursor"]
+                    await asyncio.sleep(0.01)
+                    st.set("cursor", cursor + 1)
+
+            await asyncio.gather(next_card(), next_card())
+            assert await manager.get_data(1, "cursor") == 2
+            assert manager.stats()["lock_waits"] == 1
+            assert manager.stats()["locked_chats"] == 0
+
+            with pytest.raises(RuntimeError):
+                async with manager.transaction(1) as st:
+                    st.update(cursor=10, city="Москва")
+                    raise RuntimeError
+            assert await manager.get_all_data(1) == {"cursor": 2}
+
+            manager.use_eviction(EvictionPolicy(max_entries=1))
+            async with manager.transaction(1) as st:
+                await manager.set_state(2, state)
+                assert await manager.get_state(1) is state
+                st.erase()
+            assert await manager.get_state(1) is None
+            assert await manager.get_state(2) is state
+        finally:
+            manager.use_eviction(EvictionPolicy())
+            manager.use_storage(MemoryStorage())
+
     @pytest.mark.asyncio
     async def test_get_me(self, bot):
         """Тест получения информации о боте"""
@@ -60,6 +890,7 @@ class TestMaxBotFixed:
         """Тест отправки сообщения"""
         with patch('aiohttp.ClientSession.post') as mock_post:
             mock_response = AsyncMock()
+            mock_response.status = 200
             mock_response.json.return_value = {
                 "message": {"mid": "test_message_id"}
             }
@@ -207,6 +1038,225 @@ class TestMaxBotFixed:
         await dispatcher.process_update(update)
         assert handler_called
 
+    @pytest.mark.asyncio
+    async def test_session_per_update(self, dispatcher):
+        """Тест отдельной сессии БД на каждый апдейт"""
+        opened, closed, seen = [], [], []
+
+        class FakeSession:
+            async def __aenter__(self):
+                opened.append(self)
+                return self
+
+            async def __aexit__(self, *exc):
+                closed.append(self)
+
+        dispatcher.sessionmaker = FakeSession
+
+        @dispatcher.message_handler(Command("db"))
+        async def db_handler(update, bot, stateManager, session):
+            seen.append(session)
+
+        @dispatcher.message_handler(Command("nodb"))
+        async def no_db_handler(update, bot):
+            pass
+
+        def make_update(text):
+            return Update(
+                update_id=1,
+                update_type="message_created",
+                timestamp=123456789,
+                message=Message(
+                    message_id="1",
+                    chat=Chat(chat_id=1, type="chat", status="active"),
+                    from_user=User(user_id=1, first_name="Test"),
+                    text=text
+                )
+            )
+
+        await dispatcher.process_update(make_update("/db"))
+        await dispatcher.process_update(make_update("/db"))
+        await dispatcher.process_update(make_update("/nodb"))
+
+        assert len(seen) == 2 and seen[0] is not seen[1]
+        assert opened == closed == seen
+
+    @pytest.mark.asyncio
+    async def test_worker_pool_keeps_chat_order(self):
+        """Тест пула воркеров: порядок внутри чата и ограничение параллелизма"""
+        processed = []
+        in_flight = 0
+        max_in_flight = 0
+
+        async def process(update):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.001 * (update.update_id % 3))
+            processed.append((update.message.chat_id, update.update_id))
+            in_flight -= 1
+
+        pool = WorkerPool(process, workers=2, queue_size=4)
+        pool.start()
+        for update_id in range(20):
+            await pool.submit(Update(
+                update_id=update_id,
+                update_type="message_created",
+                timestamp=update_id,
+                message=Message(
+                    message_id=str(update_id),
+                    chat=Chat(chat_id=update_id % 4, type="chat", status="active"),
+                    from_user=User(user_id=1, first_name="Test"),
+                    text="hi"
+                )
+            ))
+        await pool.stop()
+
+        assert len(processed) == 20
+        assert max_in_flight <= 2
+        for chat_id in range(4):
+            ids = [update_id for chat, update_id in processed if chat == chat_id]
+            assert ids == sorted(ids)
+        assert sum(pool.stats()["processed"]) == 20
+
+    @pytest.mark.asyncio
+    async def test_payload_routing(self, dispatcher):
+        """Тест индексированной маршрутизации callback по payload"""
+        called = []
+
+        @dispatcher.callback_query_handler(Payload("search:*"))
+        async def search_handler(update, bot):
+            called.append("search")
+
+        async def starts_with_search(update):
+            return update.callback_query.payload.startswith("search")
+
+        @dispatcher.callback_query_handler(starts_with_search)
+        async def fallback_handler(update, bot):
+            called.append("fallback")
+
+        @dispatcher.callback_query_handler(Payload("search:like:*"))
+        async def like_handler(update, bot):
+            called.append("like")
+
+        @dispatcher.callback_query_handler(Payload("volunteer"))
+        async def volunteer_handler(update, bot):
+            called.append("volunteer")
+
+        def make_update(payload):
+            return Update(
+                update_id=1,
+                update_type="message_callback",
+                timestamp=123456789,
+                callback_query=CallbackQuery(
+                    callback_id="1",
+                    from_user=User(user_id=1, first_name="Test"),
+                    payload=payload
+                )
+            )
+
+        for payload in ("search:like:dog:1", "volunteer", "searching", "search"):
+            await dispatcher.process_update(make_update(payload))
+
+        # Registration order wins between indexed and fallback handlers
+        assert called == ["search", "volunteer", "fallback", "fallback"]
+
+    @pytest.mark.asyncio
+    async def test_state_routing(self, dispatcher):
+        """Тест маршрутизации сообщений по состоянию FSM и команде"""
+        first, second = State(), State()
+        called = []
+
+        @dispatcher.message_handler(StateFilter(first))
+        async def first_handler(update, bot):
+            called.append("first")
+
+        @dispatcher.message_handler(StateFilter(second))
+        async def second_handler(update, bot):
+            called.append("second")
+
+        @dispatcher.message_handler(Command("cancel"))
+        async def cancel_handler(update, bot):
+            called.append("cancel")
+
+        def make_update(text):
+            return Update(
+                update_id=1,
+                update_type="message_created",
+                timestamp=123456789,
+                message=Message(
+                    message_id="1",
+                    chat=Chat(chat_id=77, type="chat", status="active"),
+                    from_user=User(user_id=1, first_name="Test"),
+                    text=text
+                )
+            )
+
+        await dispatcher.process_update(make_update("hello"))
+        await dispatcher.stateManager.set_state(77, second)
+        await dispatcher.process_update(make_update("hello"))
+        # State handler registered first wins over the command
+        await dispatcher.process_update(make_update("/cancel"))
+        await dispatcher.stateManager.erase_state(77)
+        await dispatcher.process_update(make_update("/Cancel@bot"))
+
+        assert called == ["second", "second", "cancel"]
+
+    @pytest.mark.asyncio
+    async def test_callback_data(self, dispatcher):
+        """Тест типизированных payload: сборка, разбор и кэш в CallbackQuery"""
+        @dataclass
+        class PetCb(CallbackData, prefix="test_pet"):
+            action: str
+            pet_id: Optional[int] = None
+            male: bool = False
+
+        assert PetCb("like", 42, True).pack() == "test_pet:like:42:1"
+        assert PetCb("_").pack() == "test_pet:_::0"
+        assert PetCb.unpack("test_pet:_::0") == PetCb("_")
+        assert PetCb.unpack("test_pet:next:7") == PetCb("next", 7)
+
+        @dataclass
+        class NoteCb(CallbackData, prefix="test_note"):
+            text: Optional[str] = None
+            page: Optional[int] = None
+
+        # None и пустая строка различаются, без полей payload всё равно содержит разделитель
+        assert NoteCb().pack() == "test_note:" and NoteCb.unpack("test_note:") == NoteCb()
+        for note in (NoteCb(""), NoteCb("~"), NoteCb("~x", 2), NoteCb(None, 3), NoteCb("x")):
+            assert NoteCb.unpack(note.pack()) == note
+        assert NoteCb("").pack() == "test_note:~"
+
+        update = dispatcher._parse_update({
+            "update_type": "message_callback",
+            "timestamp": 1,
+            "callback": {"callback_id": "1", "user": {"user_id": 1}, "payload": "test_pet:like:42:1"},
+        })
+        assert update.callback_query.data == PetCb("like", 42, True)
+
+        received = []
+
+        @dispatcher.callback_query_handler(PetCb.filter())
+        async def pet_handler(update, bot):
+            received.append(update.callback_query.data)
+
+        @dispatcher.callback_query_handler(NoteCb.filter())
+        async def note_handler(update, bot):
+            received.append(update.callback_query.data)
+
+        await dispatcher.process_update(update)
+        await dispatcher.process_update(dispatcher._parse_update({
+            "update_type": "message_callback",
+            "callback": {"callback_id": "3", "user": {"user_id": 1}, "payload": NoteCb().pack()},
+        }))
+        assert received == [PetCb("like", 42, True), NoteCb()]
+
+        broken = dispatcher._parse_update({
+            "update_type": "message_callback",
+            "callback": {"callback_id": "2", "user": {"user_id": 1}, "payload": "test_pet:like:abc"},
+        })
+        assert broken.callback_query.data is None
+
 class TestLoggingFixed:
     """Тесты для логирования"""
     